@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Bulk aperture extraction (DataCube.get_spectra) against a loop of
+get_1dSpec calls, for several numbers of sources.
+
+    python benchmarks/bench_bulk_spectra.py
+    python benchmarks/bench_bulk_spectra.py --shape 3700 320 320 --nsources 200 2000 --radius 5
+
+Both are timed on a freshly opened cube with the file in the page cache
+(after a first untimed full read) and the channel prefetcher off, on the
+same random source positions; the median of --repeat calls is kept.  The
+results are stored as JSON in --output, and the exit status is 1 if the
+bulk extraction is not faster than the loop for some number of sources.
+"""
+import argparse
+import gc
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pyqtcube  # noqa: E402
+from common import make_cube, walltime, save_results  # noqa: E402
+
+
+def run(ifile, nsources, r, repeat):
+    cube = pyqtcube.read(ifile)
+    nz, ny, nx = cube.shape
+    # warm the page cache
+    for k1, k2 in cube.channel_chunks(0, nz):
+        np.asarray(cube.data[k1:k2]).sum()
+    cube.close()
+
+    def timed(func):
+        times = []
+        for i in range(repeat):
+            gc.collect()
+            cube = pyqtcube.read(ifile)
+            cube.channel_cache.prefetch = 0
+            times.append(walltime(lambda: func(cube)))
+            cube.close()
+        return float(np.median(times))
+
+    results = {}
+    rng = np.random.default_rng(1)
+    for n in nsources:
+        x, y = rng.integers(0, nx, n), rng.integers(0, ny, n)
+        bulk = timed(lambda cube: cube.get_spectra(x, y, r=r))
+        loop = timed(lambda cube: [cube.get_1dSpec(xi, yi, r=r) for xi, yi in zip(x, y)])
+        key = "%dx%dx%d r=%g %d sources" % (nz, ny, nx, r, n)
+        results[key] = {'shape': [nz, ny, nx], 'r': r, 'nsources': n, 'bulk_s': bulk, 'loop_s': loop}
+        print("%-40s bulk %8.3f s   loop %8.3f s   speed-up %5.2fx%s" %
+              (key, bulk, loop, loop / bulk, '' if bulk < loop else '  <-- SLOWER'))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shape', type=int, nargs=3, default=(3700, 150, 150), metavar=('NZ', 'NY', 'NX'))
+    parser.add_argument('--nsources', type=int, nargs='+', default=[200, 2000, 10000])
+    parser.add_argument('--radius', type=float, default=3)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workdir', default=tempfile.gettempdir())
+    parser.add_argument('--output', default=os.path.join(os.path.dirname(__file__), 'results'))
+    args = parser.parse_args()
+
+    nz, ny, nx = args.shape
+    ifile = make_cube(os.path.join(args.workdir, "pyqtcube_bench_%dx%dx%d.fits" % (nz, ny, nx)), nz, ny, nx)
+    results = run(ifile, args.nsources, args.radius, args.repeat)
+
+    print("\nresults written to", save_results(results, args.output, 'bulk_spectra'))
+    sys.exit(0 if all(r['bulk_s'] < r['loop_s'] for r in results.values()) else 1)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Cold and warm timings, and peak memory, of the DataCube accessors on
+synthetic cubes of several sizes.
+
+    python benchmarks/bench_datacube.py --sizes small medium muse
+    python benchmarks/bench_datacube.py --compare benchmarks/results/datacube-0.9.1-<date>.json
+
+The synthetic cubes have a STAT (variance) extension.  "cold" is the
+first call on a freshly opened cube after dropping the file from the
+page cache (POSIX systems); "warm" are the following calls with the
+same arguments, with the file in the page cache but the caches of
+DataCube (channels, moment maps, smoothed copies) cleared before every
+call and the channel prefetcher off.  Peak memory is what Python and
+NumPy allocate during a separate cold call under tracemalloc (memory
+mapped pages are not counted), not timed.  The results are stored as JSON in
+--output, together with the versions of numpy, astropy, pyqtgraph and
+spectral_cube; with --compare the warm medians are compared with a
+previous run and the exit status is 1 if any got slower than --threshold.
+"""
+import argparse
+import gc
+import os
+import sys
+import tempfile
+
+import astropy.units as u
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pyqtcube  # noqa: E402
+from common import make_cube, evict, walltime, peak_memory, summary, save_results, compare_results  # noqa: E402
+
+SIZES = {
+    'small': (400, 64, 64),
+    'medium': (1800, 160, 160),
+    'muse': (3700, 320, 320),
+}
+
+# at most this many warm calls of the slow cases
+MAX_REPEAT = {
+    'smoothed sigma 2': 2,
+    'fit_lines Ha': 1,
+}
+
+
+def cases(cube):
+    """name -> func(cube) of the benchmarked calls, sized on the cube"""
+    nz, ny, nx = cube.shape
+    lam = cube.spectral_axis.quantity
+    c = nz // 2
+    x, y = nx // 2, ny // 2
+
+    def band(k1, k2):
+        k1, k2 = max(k1, 0), min(k2, nz - 1)
+        return lam[k1], lam[k2]
+
+    line = band(c - 8, c + 8)
+    blue = band(c - 40, c - 24)
+    red = band(c + 24, c + 40)
+    wide = band(c - 40, c + 40)
+    rng = np.random.default_rng(1)
+    sx, sy = rng.integers(0, nx, 100), rng.integers(0, ny, 100)
+    # H alpha at the centre of the cube
+    z = lam[c].to_value(u.AA) / 6562.80 - 1
+    return {
+        'get_channel': lambda cube: cube.get_channel(c),
+        'get_1dSpec r=0': lambda cube: cube.get_1dSpec(x, y),
+        'get_1dSpec r=3': lambda cube: cube.get_1dSpec(x, y, r=3),
+        'get_1dSpec r=3 annulus': lambda cube: cube.get_1dSpec(x, y, r=3, annulus=(5, 8)),
+        'get_image_band 80 channels': lambda cube: cube.get_image_band(*wide),
+        'get_image_continuum_subtracted': lambda cube: cube.get_image_continuum_subtracted(line, blue, red),
+        'get_moments 80 channels': lambda cube: cube.get_moments(*wide),
+        'get_spectra 100 apertures r=3': lambda cube: cube.get_spectra(sx, sy, r=3),
+        'get_1dSpec r=3 variance': lambda cube: cube.get_1dSpec(x, y, r=3, variance=True),
+        'get_image_snr': lambda cube: cube.get_image_snr(line, blue, red),
+        'smoothed sigma 2': lambda cube: cube.smoothed(2, cache=False),
+        'fit_lines Ha': lambda cube: cube.fit_lines([6562.80], z),
+    }
+
+
+def run(ifile, size, repeat):
+    results = {}
+    cube = pyqtcube.read(ifile)
+    names = list(cases(cube))
+    cube.close()
+
+    def fresh(name):
+        # a cold cube: file out of the page cache, no prefetching
+        gc.collect()
+        evicted = evict(ifile)
+        cube = pyqtcube.read(ifile)
+        cube.channel_cache.prefetch = 0
+        return cube, cases(cube)[name], evicted
+
+    for name in names:
+        cube, func, evicted = fresh(name)
+        cold = walltime(lambda: func(cube))
+        warm = []
+        for i in range(min(repeat, MAX_REPEAT.get(name, repeat))):
+            cube.clear_caches()
+            warm.append(walltime(lambda: func(cube)))
+        cube.close()
+        del cube, func
+
+        # memory in a separate cold call: tracemalloc slows the call down
+        cube, func, evicted = fresh(name)
+        peak = peak_memory(lambda: func(cube))
+        key = "%s %s" % (size, name)
+        results[key] = {
+            'shape': list(cube.shape),
+            'cold_s': cold,
+            'cold_evicted': evicted,
+            'warm_median_s': float(np.median(warm)),
+            'warm_p90_s': float(np.percentile(warm, 90)),
+            'peak_mb': peak,
+        }
+        print("%-50s cold %9.3f ms  peak %8.1f MB" % (key, cold * 1e3, peak))
+        summary("%-50s warm" % key, warm)
+        cube.close()
+        del cube, func
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=sorted(SIZES))
+    parser.add_argument('--shape', type=int, nargs=3, metavar=('NZ', 'NY', 'NX'),
+                        help="benchmark a cube of this shape instead of --sizes")
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--workdir', default=tempfile.gettempdir())
+    parser.add_argument('--output', default=os.path.join(os.path.dirname(__file__), 'results'))
+    parser.add_argument('--compare', help="results file of a previous run")
+    parser.add_argument('--threshold', type=float, default=1.2)
+    args = parser.parse_args()
+
+    sizes = {'custom': tuple(args.shape)} if args.shape else {k: SIZES[k] for k in args.sizes}
+    results = {}
+    for size, (nz, ny, nx) in sizes.items():
+        ifile = make_cube(os.path.join(args.workdir, "pyqtcube_bench_%dx%dx%d_stat.fits" % (nz, ny, nx)), nz, ny, nx,
+                          variance=True)
+        results.update(run(ifile, size, args.repeat))
+
+    print("\nresults written to", save_results(results, args.output, 'datacube'))
+    if args.compare:
+        sys.exit(1 if compare_results(results, args.compare, threshold=args.threshold) else 0)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+End-to-end interaction latencies of the pycube window, under the
+offscreen Qt platform.
+
+    python benchmarks/bench_interaction.py --shape 1800 160 160
+    python benchmarks/bench_interaction.py --cube cube.fits --budget channel=100 continuum=300
+
+Synthetic key and mouse events are sent to the SpecViewer and
+PyCubeImageViewerPanel widgets of a pycubeApp.Window and the latency is
+measured from the event to the end of the first paint of the widget that
+shows the result, after every DataCube query it started has been applied:
+
+    position    mouse move + Space on the image -> spectrum redrawn
+    hover       mouse move on the image -> magnifier redrawn
+    channel     Right in the spectrum -> channel image redrawn (zscale, smoothing 2)
+    continuum   Ctrl+3 -> continuum subtracted image redrawn
+
+The exit status is 1 if the --percentile latency of any scenario exceeds
+its budget (ms), so the script can gate releases on responsiveness.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np  # noqa: E402
+from PyQt5 import QtCore  # noqa: E402
+from PyQt5.QtCore import Qt, QPointF  # noqa: E402
+from PyQt5.QtTest import QTest  # noqa: E402
+from PyQt5.QtWidgets import QApplication  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pyqtcube  # noqa: E402
+from pyqtcube import pycubeApp  # noqa: E402
+from common import make_cube, save_results  # noqa: E402
+
+# default budgets (ms) of the --percentile latency
+BUDGETS = {
+    'position': 150.,
+    'hover': 100.,
+    'channel': 200.,
+    'continuum': 1000.,
+}
+
+
+class LatencyProbe(QtCore.QObject):
+    """
+    Watches the paint events of the viewport of a GraphicsView and the
+    queries of a QueryDispatcher: measure() returns the time from an event
+    to the end of the first paint after all the queries are done.
+    """
+
+    def __init__(self, dispatcher, view):
+        super().__init__()
+        self.dispatcher = dispatcher
+        self.view = view
+        self.armed = False
+        self.loop = None
+        self.t1 = None
+        view.viewport().installEventFilter(self)
+        dispatcher.sigBusy.connect(self.busyChanged)
+
+    def busyChanged(self, busy):
+        self.armed = not busy
+
+    def eventFilter(self, obj, ev):
+        if ev.type() == QtCore.QEvent.Paint and self.armed and self.loop is not None:
+            # the paint event is filtered before it is handled: stop at the
+            # next iteration of the event loop, when the paint is done
+            QtCore.QTimer.singleShot(0, self.painted)
+        return False
+
+    def painted(self):
+        if self.loop is not None and self.t1 is None:
+            self.t1 = time.perf_counter()
+            self.loop.quit()
+
+    def measure(self, send, timeout=30.):
+        """latency (s) of the interaction send(), None on timeout"""
+        self.loop = QtCore.QEventLoop()
+        self.t1 = None
+        self.armed = False
+        timer = QtCore.QTimer()
+        timer.setSingleShot(True)
+        timer.timeout.connect(self.loop.quit)
+        timer.start(int(timeout * 1000))
+        t0 = time.perf_counter()
+        send()
+        if not self.dispatcher.busy:
+            self.armed = True
+        if self.t1 is None:
+            self.loop.exec_()
+        timer.stop()
+        self.loop = None
+        return None if self.t1 is None else self.t1 - t0
+
+
+class InteractionHarness:
+
+    def __init__(self, cube, seed=1):
+        self.app = QApplication.instance() or QApplication(sys.argv)
+        self.window = w = pycubeApp.Window()
+        w.showError = lambda s: sys.stderr.write("error: %s\n" % s)
+        w.resize(1200, 900)
+        w.setCube(cube)
+        w.activateWindow()
+        self.cube = cube
+        self.rng = np.random.default_rng(seed)
+        self.wait()
+
+    def wait(self):
+        self.window.queries.waitForDone()
+        self.app.processEvents()
+
+    def imagePos(self, x, y):
+        """viewport coordinates of the centre of the pixel (x, y) of the main image"""
+        img = self.window.imageviewer.wid_image
+        return img.mapFromScene(img.img.mapToScene(QPointF(x + .5, y + .5)))
+
+    def focus(self, view, item):
+        view.setFocus()
+        view.scene().setFocusItem(item)
+
+    def randomPixel(self):
+        nz, ny, nx = self.cube.shape
+        return self.rng.integers(0, nx), self.rng.integers(0, ny)
+
+    def scenarios(self):
+        """name -> (setup(), event(i), GraphicsView showing the result)"""
+        w = self.window
+        iv, sv = w.imageviewer, w.specviewer
+        image = iv.wid_image
+
+        def position_setup():
+            self.focus(image, image.vb)
+
+        def position(i):
+            QTest.mouseMove(image.viewport(), self.imagePos(*self.randomPixel()))
+            QTest.keyClick(image.viewport(), Qt.Key_Space)
+
+        def hover(i):
+            QTest.mouseMove(image.viewport(), self.imagePos(*self.randomPixel()))
+
+        def channel_setup():
+            w.setmode(0)
+            iv.sb_smooth.setValue(2)
+            self.focus(sv.plotWidget, sv.vb.vb)
+            sv.idx = w.z = len(self.cube.spectral_axis) // 4
+            self.wait()
+
+        def channel(i):
+            QTest.keyClick(sv.plotWidget.viewport(), Qt.Key_Right)
+
+        def continuum_setup():
+            iv.sb_smooth.setValue(0)
+            wav = sv.wav
+            c = len(wav) // 2
+            for region, k in [(sv.regionC, 0), (sv.regionB, -40), (sv.regionR, 40)]:
+                k1, k2 = np.clip([c + k - 8, c + k + 8], 0, len(wav) - 1)
+                region.setRegion((wav[k1], wav[k2]))
+
+        def continuum(i):
+            QTest.keyClick(w, Qt.Key_3, Qt.ControlModifier)
+
+        return {
+            'position': (position_setup, position, sv.plotWidget),
+            'hover': (position_setup, hover, iv.wid_magnifier),
+            'channel': (channel_setup, channel, image),
+            'continuum': (continuum_setup, continuum, image),
+        }
+
+    def run(self, names, repeat, timeout=30.):
+        """latencies (s, None for timeouts) of `repeat` events of every scenario"""
+        out = {}
+        scenarios = self.scenarios()
+        for name in names:
+            setup, event, view = scenarios[name]
+            setup()
+            probe = LatencyProbe(self.window.queries, view)
+            # one warm-up event (first paint, lazy initializations)
+            probe.measure(lambda: event(-1), timeout)
+            out[name] = [probe.measure(lambda: event(i), timeout) for i in range(repeat)]
+            view.viewport().removeEventFilter(probe)
+            self.wait()
+        return out
+
+
+def parse_budgets(items):
+    budgets = dict(BUDGETS)
+    for item in items or []:
+        name, ms = item.split('=')
+        if name not in BUDGETS:
+            raise SystemExit("unknown scenario %r (expected one of %s)" % (name, ", ".join(BUDGETS)))
+        budgets[name] = float(ms)
+    return budgets
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cube', help="FITS file (default: a synthetic cube of --shape)")
+    parser.add_argument('--extn', type=int, default=1)
+    parser.add_argument('--shape', type=int, nargs=3, default=[1800, 160, 160], metavar=('NZ', 'NY', 'NX'))
+    parser.add_argument('--workdir', default=tempfile.gettempdir())
+    parser.add_argument('--scenarios', nargs='+', default=list(BUDGETS), choices=list(BUDGETS))
+    parser.add_argument('--repeat', type=int, default=30)
+    parser.add_argument('--timeout', type=float, default=30., help="seconds")
+    parser.add_argument('--percentile', type=float, default=95.)
+    parser.add_argument('--budget', nargs='+', metavar='NAME=MS', help="override the default budgets")
+    parser.add_argument('--output', default=os.path.join(os.path.dirname(__file__), 'results'))
+    args = parser.parse_args()
+    budgets = parse_budgets(args.budget)
+
+    ifile = args.cube
+    if ifile is None:
+        nz, ny, nx = args.shape
+        ifile = make_cube(os.path.join(args.workdir, "pyqtcube_bench_%dx%dx%d.fits" % (nz, ny, nx)), nz, ny, nx)
+    harness = InteractionHarness(pyqtcube.read(ifile, extn=args.extn))
+    latencies = harness.run(args.scenarios, args.repeat, timeout=args.timeout)
+
+    results = {}
+    failed = []
+    print("%-10s %9s %9s %9s %9s %9s %9s" % ('scenario', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+                                           'p%g ms' % args.percentile, 'budget'))
+    for name, times in latencies.items():
+        timeouts = sum(t is None for t in times)
+        t = np.array([np.inf if v is None else v for v in times]) * 1e3
+        p = np.percentile(t, [50, 90, 99, args.percentile])
+        ok = p[3] <= budgets[name]
+        if not ok:
+            failed.append(name)
+        print("%-10s %9.1f %9.1f %9.1f %9.1f %9.1f %9.1f  %s%s" % (name, p[0], p[1], p[2], t.max(), p[3], budgets[name],
+                                                              'ok' if ok else 'OVER BUDGET',
+                                                              "  (%d timeouts)" % timeouts if timeouts else ''))
+        results[name] = {
+            'shape': list(harness.cube.shape),
+            'latencies_ms': [None if v is None else v * 1e3 for v in times],
+            'p50_ms': p[0], 'p90_ms': p[1], 'p99_ms': p[2],
+            'budget_ms': budgets[name], 'percentile': args.percentile, 'ok': bool(ok),
+        }
+    print("\nresults written to", save_results(results, args.output, 'interaction'))
+    harness.window.close()
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""
+Spectrum read latency of DataCube.get_1dSpec with and without the
+spectrum-contiguous sidecar.
+
+    python benchmarks/bench_sidecar.py --shape 3700 300 300
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pyqtcube  # noqa: E402
+from common import make_cube, timeit, summary  # noqa: E402
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shape', type=int, nargs=3, default=[3700, 300, 300], metavar=('NZ', 'NY', 'NX'))
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--workdir', default=tempfile.gettempdir())
+    args = parser.parse_args()
+
+    nz, ny, nx = args.shape
+    ifile = make_cube(os.path.join(args.workdir, "pyqtcube_bench_%dx%dx%d.fits" % (nz, ny, nx)), nz, ny, nx)
+    rng = np.random.default_rng(1)
+    pos = rng.integers(0, [nx, ny], size=(args.repeat, 2))
+
+    cube = pyqtcube.DataCube.read(ifile)
+    summary("get_1dSpec r=0 native layout", timeit(lambda i: cube.get_1dSpec(*pos[i]), args.repeat))
+    summary("get_1dSpec r=5 native layout", timeit(lambda i: cube.get_1dSpec(*pos[i], r=5), args.repeat))
+
+    t0 = time.perf_counter()
+    cube.build_spectrum_sidecar(cache=True, background=False)
+    print("sidecar build/load: %.2f s" % (time.perf_counter() - t0))
+    summary("get_1dSpec r=0 sidecar", timeit(lambda i: cube.get_1dSpec(*pos[i]), args.repeat))
+    summary("get_1dSpec r=5 sidecar", timeit(lambda i: cube.get_1dSpec(*pos[i], r=5), args.repeat))
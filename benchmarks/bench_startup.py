@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Time to first pixel of the viewer: from the import of pyqtcube to the
+first channel image painted, in a fresh interpreter under the offscreen
+Qt platform, with the cube dropped from the page cache before each run.
+
+    python benchmarks/bench_startup.py --shape 3700 320 320
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from common import make_cube, evict, summary
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# the startup path of the pycube script, stopped at the first pixel
+CHILD = """
+import sys, time, json
+import pyqtcube
+from PyQt5.QtCore import QEventLoop
+from PyQt5.QtWidgets import QApplication
+from pyqtcube import pycubeApp
+app = QApplication(sys.argv)
+w = pycubeApp.Window()
+app.processEvents()
+shown = time.perf_counter() - pyqtcube.STARTUP
+w.openCube(sys.argv[1], setup=lambda cube: cube.build_channel_stats(background=True))
+while w.timeToFirstPixel is None and time.perf_counter() - pyqtcube.STARTUP < 120:
+    app.processEvents(QEventLoop.AllEvents, 10)
+print(json.dumps(dict(window=shown, first_pixel=w.timeToFirstPixel)))
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shape', type=int, nargs=3, default=[3700, 320, 320], metavar=('NZ', 'NY', 'NX'))
+    parser.add_argument('--cube', help="FITS file (default: a synthetic cube of --shape)")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--workdir', default=tempfile.gettempdir())
+    args = parser.parse_args()
+
+    ifile = args.cube
+    if ifile is None:
+        nz, ny, nx = args.shape
+        ifile = make_cube(os.path.join(args.workdir, "pyqtcube_bench_%dx%dx%d.fits" % (nz, ny, nx)), nz, ny, nx)
+
+    env = dict(os.environ, QT_QPA_PLATFORM='offscreen', PYTHONPATH=ROOT)
+    window, first, total = [], [], []
+    for i in range(args.repeat):
+        evict(ifile)
+        t0 = time.perf_counter()
+        # the exit status is not checked: Qt may abort when the process exits
+        # with the indexing thread still running, after the result is printed
+        out = subprocess.run([sys.executable, '-c', CHILD, ifile], env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+        total.append(time.perf_counter() - t0)
+        r = json.loads(out.strip().splitlines()[-1])
+        window.append(r['window'])
+        first.append(r['first_pixel'])
+
+    summary("window shown (since import)", window)
+    summary("first pixel (since import)", first)
+    summary("process wall time", total)
+    print("median time to first pixel: %.2f s" % np.median(first))
@@ -0,0 +1,170 @@
+import importlib
+import json
+import os
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+from astropy.io import fits
+
+
+def cube_header(nz, ny, nx, extname='DATA'):
+    """a MUSE-like header: celestial TAN projection plus a linear AWAV axis in Angstrom"""
+    h = fits.Header()
+    h['XTENSION'] = 'IMAGE'
+    h['BITPIX'] = -32
+    h['NAXIS'] = 3
+    h['NAXIS1'] = nx
+    h['NAXIS2'] = ny
+    h['NAXIS3'] = nz
+    h['PCOUNT'] = 0
+    h['GCOUNT'] = 1
+    h['EXTNAME'] = extname
+    h['BUNIT'] = '10**(-20)*erg/s/cm**2/Angstrom'
+    h['CTYPE1'] = 'RA---TAN'
+    h['CTYPE2'] = 'DEC--TAN'
+    h['CTYPE3'] = 'AWAV'
+    h['CUNIT1'] = 'deg'
+    h['CUNIT2'] = 'deg'
+    h['CUNIT3'] = 'Angstrom'
+    h['CRPIX1'] = nx / 2
+    h['CRPIX2'] = ny / 2
+    h['CRPIX3'] = 1.
+    h['CRVAL1'] = 150.
+    h['CRVAL2'] = 2.
+    h['CRVAL3'] = 4750.
+    h['CD1_1'] = -5.55555555555556E-05
+    h['CD1_2'] = 0.
+    h['CD2_1'] = 0.
+    h['CD2_2'] = 5.55555555555556E-05
+    h['CD3_3'] = 1.25
+    return h
+
+
+def make_cube(path, nz, ny, nx, seed=0, variance=False):
+    """
+    write a synthetic (nz, ny, nx) float32 cube to extension 1 of `path`
+    (and, with variance=True, a STAT extension in extension 2).
+    The data are streamed to disk one channel block at a time, so survey
+    size cubes can be written without holding them in memory.
+    """
+    if os.path.isfile(path):
+        return path
+    rng = np.random.default_rng(seed)
+    wav = 4750 + 1.25 * np.arange(nz)
+    yy, xx = np.mgrid[:ny, :nx]
+    # a few emission line sources at a common redshift
+    src = np.zeros((ny, nx), dtype='f4')
+    for i in range(20):
+        x0, y0 = rng.uniform(0, nx), rng.uniform(0, ny)
+        src += rng.uniform(5, 50) * np.exp(-((xx - x0) ** 2 + (yy - y0) ** 2) / 8.)
+
+    fits.PrimaryHDU().writeto(path, overwrite=True)
+    for extname in (['DATA', 'STAT'] if variance else ['DATA']):
+        shdu = fits.StreamingHDU(path, cube_header(nz, ny, nx, extname=extname))
+        step = max(1, 2 ** 24 // (ny * nx))
+        for k in range(0, nz, step):
+            w = wav[k:k + step, None, None]
+            if extname == 'DATA':
+                prof = np.exp(-0.5 * ((w - 6562.8 * 1.01) / 2.5) ** 2)
+                block = 1 + rng.normal(0, 0.1, (len(w), ny, nx)) + prof * src
+                block[:, :2, :2] = np.nan
+            else:
+                block = np.full((len(w), ny, nx), 0.01)
+            shdu.write(block.astype('>f4'))
+        shdu.close()
+    return path
+
+
+def timeit(func, repeat=20):
+    """return the list of wall times (s) of `repeat` calls of func()"""
+    out = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        func(i)
+        out.append(time.perf_counter() - t0)
+    return out
+
+
+def summary(name, times):
+    t = np.array(times) * 1e3
+    print("%-40s median %9.3f ms   p90 %9.3f ms   n=%d" % (name, np.median(t), np.percentile(t, 90), len(t)))
+
+
+def evict(path):
+    """drop the pages of `path` from the OS page cache, so the next read is cold (POSIX only)"""
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return True
+
+
+def walltime(func):
+    """wall time (s) of one call of func()"""
+    t0 = time.perf_counter()
+    func()
+    return time.perf_counter() - t0
+
+
+def peak_memory(func):
+    """
+    peak memory allocated by Python and NumPy (MB) during one call of
+    func(); tracemalloc slows the call down, so time it separately
+    """
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak / 2 ** 20
+
+
+def environment():
+    """versions of the packages whose upgrades the benchmarks are meant to catch"""
+    env = {'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count()}
+    for name in ['pyqtcube', 'numpy', 'astropy', 'pyqtgraph', 'spectral_cube']:
+        try:
+            env[name] = importlib.import_module(name).__version__
+        except Exception:
+            env[name] = None
+    return env
+
+
+def save_results(results, outdir, prefix):
+    """write the results to <outdir>/<prefix>-<pyqtcube version>-<date>.json and return the path"""
+    os.makedirs(outdir, exist_ok=True)
+    doc = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'environment': environment(), 'results': results}
+    path = os.path.join(outdir, "%s-%s-%s.json" % (prefix, doc['environment']['pyqtcube'],
+                                                  time.strftime('%Y%m%d-%H%M%S')))
+    with open(path, 'w') as ff:
+        json.dump(doc, ff, indent=1)
+    return path
+
+
+def compare_results(results, ifile, key='warm_median_s', threshold=1.2):
+    """
+    print the ratio of every timing `key` to the one stored in the results
+    file `ifile`; returns the names slower than `threshold` times the reference
+    """
+    with open(ifile) as ff:
+        ref = json.load(ff)
+    print("\ncompared with %s (%s)" % (ifile, ref['date']))
+    slower = []
+    for name, r in results.items():
+        old = ref['results'].get(name)
+        if old is None or not old.get(key) or r.get(key) is None:
+            continue
+        ratio = r[key] / old[key]
+        flag = ''
+        if ratio > threshold:
+            flag = '  <-- SLOWER'
+            slower.append(name)
+        print("%-50s %8.2fx%s" % (name, ratio, flag))
+    return slower
@@ -0,0 +1,315 @@
+import numpy as np
+
+# candidate sides of the image tiles binning the groups of PixelGroups
+TILES = (4, 8, 16, 32, 64)
+
+
+def _tiling(y1, y2, x1, x2, nx, tile):
+    """
+    tile index of the bounding boxes (y1, y2, x1, x2) binned by the corner
+    in tiles of the given side, and the estimated cost of their windows:
+    the pixels read, the weights multiplied and a constant per window
+    """
+    index = (y1 // tile) * (nx // tile + 1) + x1 // tile
+    _, inv, m = np.unique(index, return_inverse=True, return_counts=True)
+    wy1, wx1 = np.full(len(m), y1.max()), np.full(len(m), x1.max())
+    wy2, wx2 = np.zeros(len(m), dtype=int), np.zeros(len(m), dtype=int)
+    np.minimum.at(wy1, inv, y1)
+    np.minimum.at(wx1, inv, x1)
+    np.maximum.at(wy2, inv, y2)
+    np.maximum.at(wx2, inv, x2)
+    area = (wy2 - wy1) * (wx2 - wx1)
+    return index, np.sum(area + 0.05 * m * area + 16)
+
+
+def _quadrant_area(x, y, r):
+    """area of the circle of radius r (centred in 0) within [0, x] x [0, y], for x, y >= 0"""
+    x = np.minimum(x, r)
+    y = np.minimum(y, r)
+    # below xc the circle is higher than y
+    xc = np.minimum(np.sqrt(np.maximum(r ** 2 - y ** 2, 0)), x)
+
+    def G(t):
+        return 0.5 * (t * np.sqrt(np.maximum(r ** 2 - t ** 2, 0)) + r ** 2 * np.arcsin(t / r))
+
+    return xc * y + G(x) - G(xc)
+
+
+def _signed_area(x, y, r):
+    return np.sign(x) * np.sign(y) * _quadrant_area(np.abs(x), np.abs(y), r)
+
+
+def circular_weights(r, exact=True):
+    """
+    (2n+1, 2n+1) weights of a circular aperture of radius r centred on the
+    central pixel, n = ceil(r).  With exact=True each weight is the
+    fraction of the pixel area covered by the circle, otherwise it is 1
+    for the pixels whose centre lies within the circle.
+    """
+    if r <= 0:
+        return np.ones((1, 1))
+    n = int(np.ceil(r))
+    d = np.arange(-n, n + 1, dtype=float)
+    if not exact:
+        return ((d[:, None] ** 2 + d[None, :] ** 2) <= r ** 2).astype(float)
+    y0, x0 = np.meshgrid(d - .5, d - .5, indexing='ij')
+    y1, x1 = y0 + 1, x0 + 1
+    return (_signed_area(x1, y1, r) - _signed_area(x0, y1, r)
+            - _signed_area(x1, y0, r) + _signed_area(x0, y0, r))
+
+
+class ApertureEngine:
+    """
+    Aperture spectra computed directly on the data array.
+
+    The weight kernels are cached per radius; the aperture (and the
+    optional background annulus) are clipped at the edges of the cube and
+    the weighted means ignore NaN values.  With a variance cube, the
+    variance of the means is propagated from the same sub cubes.
+    """
+
+    def __init__(self, read_block, shape, exact=True, read_variance=None):
+        """
+        read_block(x1, x2, y1, y2) must return the (nz, y2-y1, x2-x1) sub cube,
+        read_variance(x1, x2, y1, y2) the same sub cube of the variance
+        """
+        self.read_block = read_block
+        self.read_variance = read_variance
+        self.shape = shape
+        self.exact = exact
+        self.__kernels = {}
+
+    def kernel(self, r):
+        key = (r, self.exact)
+        k = self.__kernels.get(key)
+        if k is None:
+            k = circular_weights(r, exact=self.exact)
+            k.setflags(write=False)
+            self.__kernels[key] = k
+        return k
+
+    def annulus_kernel(self, r_in, r_out):
+        """weights of the annulus r_in < r < r_out on the grid of kernel(r_out)"""
+        k_out = self.kernel(r_out)
+        if r_in <= 0:
+            return k_out
+        k_in = self.kernel(r_in)
+        n, m = k_out.shape[0] // 2, k_in.shape[0] // 2
+        k = k_out.copy()
+        k[n - m:n + m + 1, n - m:n + m + 1] -= k_in
+        return np.clip(k, 0, None)
+
+    @staticmethod
+    def _weighted_mean(block, w):
+        """NaN-aware weighted mean of the (nz, npix) block with weights (npix,)"""
+        good = np.isfinite(block)
+        num = np.where(good, block, 0) @ w
+        den = good @ w
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(den > 0, num / den, np.nan)
+
+    @staticmethod
+    def _weighted_mean_variance(block, var, w):
+        """weighted mean of the block and its variance sum(w^2 var) / sum(w)^2 over the valid pixels"""
+        good = np.isfinite(block) & np.isfinite(var)
+        num = np.where(good, block, 0) @ w
+        vnum = np.where(good, var, 0) @ (w * w)
+        den = good @ w
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(den > 0, num / den, np.nan), np.where(den > 0, vnum / den ** 2, np.nan)
+
+    def spectrum(self, x, y, r, annulus=None, variance=False):
+        """
+        mean spectrum within radius r of the pixel (x, y);
+        annulus=(r_in, r_out) subtracts the mean spectrum of the local
+        background in that annulus, read in the same pass.
+        With variance=True returns the spectrum and its variance.
+        """
+        nz, ny, nx = self.shape
+        kernels = [self.kernel(r)]
+        if annulus is not None:
+            kernels.append(self.annulus_kernel(*annulus))
+        n = max(k.shape[0] for k in kernels) // 2
+
+        x1, x2 = max(x - n, 0), min(x + n + 1, nx)
+        y1, y2 = max(y - n, 0), min(y + n + 1, ny)
+        if x1 >= x2 or y1 >= y2:
+            empty = np.full(nz, np.nan)
+            return (empty, empty.copy()) if variance else empty
+        # integer cubes (BITPIX 16, 32) are promoted, so the fractional weights are kept
+        block = self.read_block(x1, x2, y1, y2).reshape(nz, -1)
+        block = block.astype(np.result_type(block, np.float32), copy=False)
+        if variance:
+            var = self.read_variance(x1, x2, y1, y2).reshape(nz, -1)
+            var = var.astype(np.result_type(var, block), copy=False)
+
+        out = []
+        for k in kernels:
+            m = k.shape[0] // 2
+            # clip the kernel to the part of the aperture inside the cube
+            w = np.pad(k, n - m)[y1 - y + n:y2 - y + n, x1 - x + n:x2 - x + n]
+            w = w.ravel().astype(block.dtype)
+            out.append(self._weighted_mean_variance(block, var, w) if variance else self._weighted_mean(block, w))
+
+        if annulus is None:
+            return out[0]
+        if variance:
+            return out[0][0] - out[1][0], out[0][1] + out[1][1]
+        return out[0] - out[1]
+
+
+def aperture_pixels(shape, x, y, r, exact=True):
+    """
+    Flattened pixel indices, weights and aperture ids of circular apertures
+    of radius r (one, or one per position) centred on the pixels (x, y) of
+    an image of the given (ny, nx) shape, clipped at its edges.
+    """
+    ny, nx = shape
+    x = np.atleast_1d(np.asarray(x, dtype=int))
+    y = np.atleast_1d(np.asarray(y, dtype=int))
+    r = np.broadcast_to(np.asarray(r, dtype=float), x.shape)
+    kernels = {}
+    pix, w, ids = [], [], []
+    for i, (xi, yi, ri) in enumerate(zip(x, y, r)):
+        if ri not in kernels:
+            k = circular_weights(ri, exact=exact)
+            n = k.shape[0] // 2
+            dy, dx = np.mgrid[-n:n + 1, -n:n + 1]
+            good = k > 0
+            kernels[ri] = (dy[good], dx[good], k[good])
+        dy, dx, k = kernels[ri]
+        yy, xx = yi + dy, xi + dx
+        inside = (yy >= 0) & (yy < ny) & (xx >= 0) & (xx < nx)
+        pix.append(yy[inside] * nx + xx[inside])
+        w.append(k[inside])
+        ids.append(np.full(inside.sum(), i))
+    if not pix:
+        return np.zeros(0, dtype=int), np.zeros(0), np.zeros(0, dtype=int)
+    return np.concatenate(pix), np.concatenate(w), np.concatenate(ids)
+
+
+class PixelGroups:
+    """
+    n groups of weighted pixels of an (ny, nx) image (apertures, regions of
+    a label map) and their NaN-aware weighted mean spectra, computed for
+    all the groups and all the channels of a block at once.
+
+    The (n, npix) weight matrix is stored block-sparse: the groups are
+    binned by the image tile holding the corner of their bounding box
+    and every tile keeps the dense weights of its groups over the window
+    enclosing them, so the means are one matrix product per window, read
+    directly from the (possibly memory-mapped) block; only the groups
+    hitting non-finite values are recomputed with a NaN-aware sum.
+    """
+
+    def __init__(self, pix, w, ids, n, shape):
+        pix = np.asarray(pix, dtype=np.intp)
+        w = np.asarray(w, dtype=float)
+        ids = np.asarray(ids, dtype=np.intp)
+        self.n = n
+        self.shape = ny, nx = tuple(shape)
+        py, px = np.divmod(pix, nx)
+        # bounding boxes of the groups
+        y1, x1 = np.full(n, ny), np.full(n, nx)
+        y2, x2 = np.zeros(n, dtype=int), np.zeros(n, dtype=int)
+        np.minimum.at(y1, ids, py)
+        np.minimum.at(x1, ids, px)
+        np.maximum.at(y2, ids, py + 1)
+        np.maximum.at(x2, ids, px + 1)
+        used = np.flatnonzero(np.bincount(ids, minlength=n) > 0)
+        # the tile side giving the cheapest windows
+        tile = np.zeros(n, dtype=int)
+        if len(used):
+            tilings = [_tiling(y1[used], y2[used], x1[used], x2[used], nx, t) for t in TILES]
+            tile[used] = min(tilings, key=lambda tc: tc[1])[0]
+        # (groups, window, weights over the window, sum of weights) per tile;
+        # empty groups are in no window
+        self.windows = []
+        used = used[np.argsort(tile[used], kind='stable')]
+        order = np.argsort(tile[ids], kind='stable')
+        gsplit = np.flatnonzero(np.diff(tile[used])) + 1
+        psplit = np.flatnonzero(np.diff(tile[ids][order])) + 1
+        for groups, sel in zip(np.split(used, gsplit), np.split(order, psplit)):
+            if not len(groups):
+                continue
+            wy1, wy2 = y1[groups].min(), y2[groups].max()
+            wx1, wx2 = x1[groups].min(), x2[groups].max()
+            W = np.zeros((len(groups), (wy2 - wy1) * (wx2 - wx1)))
+            row = np.searchsorted(groups, ids[sel])
+            np.add.at(W, (row, (py[sel] - wy1) * (wx2 - wx1) + px[sel] - wx1), w[sel])
+            self.windows.append((groups, (wy1, wy2, wx1, wx2), W, W.sum(axis=1)))
+
+    @classmethod
+    def circles(cls, shape, x, y, r, exact=True):
+        """circular apertures (see aperture_pixels)"""
+        pix, w, ids = aperture_pixels(shape, x, y, r, exact=exact)
+        return cls(pix, w, ids, len(np.atleast_1d(x)), shape)
+
+    @classmethod
+    def labels(cls, labels):
+        """
+        the regions of a label map (0 is background), in increasing order
+        of label; the label values are in the attribute `values`
+        """
+        labels = np.asarray(labels)
+        pix = np.flatnonzero(labels.ravel() > 0)
+        values, ids = np.unique(labels.ravel()[pix], return_inverse=True)
+        groups = cls(pix, np.ones(len(pix)), ids, len(values), labels.shape)
+        groups.values = values
+        return groups
+
+    @staticmethod
+    def _nanmeans(v, W):
+        # v: (nz, npix) values, W: (m, npix) weights -> (nz, m)
+        good = np.isfinite(v)
+        num = np.where(good, v, 0) @ W.T
+        den = good.astype(float) @ W.T
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(den > 0, num / den, np.nan)
+
+    @staticmethod
+    def _nanmeans_variance(v, var, W):
+        # as _nanmeans, with the variance sum(w^2 var) / sum(w)^2 of the means
+        good = np.isfinite(v) & np.isfinite(var)
+        num = np.where(good, v, 0) @ W.T
+        vnum = np.where(good, var, 0) @ (W * W).T
+        den = good.astype(float) @ W.T
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(den > 0, num / den, np.nan), np.where(den > 0, vnum / den ** 2, np.nan)
+
+    def means(self, block, variance=None):
+        """
+        (n, nz) weighted means of the (nz, npix) or (nz, ny, nx) block, of
+        any dtype; given the variance of the block, returns the means and
+        their (n, nz) variance
+        """
+        nz = len(block)
+        block = block.reshape((nz,) + self.shape)
+        out = np.full((self.n, nz), np.nan)
+        if variance is not None:
+            variance = variance.reshape((nz,) + self.shape)
+            out_var = np.full_like(out, np.nan)
+        # the windows are read at the precision of the block (at least
+        # float32, as ApertureEngine), the products are float64
+        dtype = np.result_type(block, np.float32)
+        for groups, (y1, y2, x1, x2), W, wsum in self.windows:
+            v = np.asarray(block[:, y1:y2, x1:x2], dtype=dtype).reshape(nz, -1)
+            with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+                m = (v @ W.T) / wsum
+            bad = ~np.isfinite(m)
+            if variance is not None:
+                vv = np.asarray(variance[:, y1:y2, x1:x2], dtype=np.result_type(variance, v)).reshape(nz, -1)
+                with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+                    mv = (vv @ (W * W).T) / wsum ** 2
+                bad |= ~np.isfinite(mv)
+            cols = np.flatnonzero(bad.any(axis=0))
+            if len(cols) and variance is not None:
+                m[:, cols], mv[:, cols] = self._nanmeans_variance(v, vv, W[cols])
+            elif len(cols):
+                m[:, cols] = self._nanmeans(v, W[cols])
+            out[groups] = m.T
+            if variance is not None:
+                out_var[groups] = mv.T
+        if variance is not None:
+            return out, out_var
+        return out
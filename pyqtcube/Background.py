@@ -0,0 +1,74 @@
+import os
+import threading
+
+# maximum size of the blocks of a cube read (and processed) at once
+CHUNK_BYTES = 64 * 2 ** 20
+
+# largest structure built in memory when it cannot be written to its files
+MEMORY_FALLBACK_BYTES = 512 * 2 ** 20
+
+
+class BackgroundBuild:
+    """
+    Base class of the structures computed in one pass over a cube, in the
+    calling thread (build) or in a background thread (build_in_background).
+
+    `progress` goes from 0 to 1 and `ready` is set once the structure can
+    be used; when the build fails in the background, `failed` is True and
+    the exception is in `error`.
+
+    The structures stored in files (see _build_stored) are built in memory
+    when the files cannot be written (unwritable directory, full disk), as
+    long as they need at most MEMORY_FALLBACK_BYTES; the exception is then
+    kept in `error`, but `failed` is False.
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.failed = False
+        self.error = None
+        self.progress = 0.
+        self.__thread = None
+
+    def build(self):
+        """compute the structure, set `ready` and return self"""
+        raise NotImplementedError
+
+    def __build_or_fail(self):
+        try:
+            self.build()
+        except Exception as exc:
+            self.error = exc
+            self.failed = True
+
+    def build_in_background(self):
+        self.__thread = threading.Thread(target=self.__build_or_fail, daemon=True)
+        self.__thread.start()
+        return self
+
+    def wait(self):
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def _build_stored(self, compute, files, nbytes):
+        """
+        compute(True) writes the structure to `files` through their .tmp
+        copies, compute(False) builds it in memory (nbytes); without files,
+        or when they cannot be written, it is built in memory
+        """
+        if not files:
+            return compute(False)
+        try:
+            return compute(True)
+        except Exception as exc:
+            self.error = exc
+            for f in files:
+                if os.path.isfile(f + ".tmp"):
+                    try:
+                        os.remove(f + ".tmp")
+                    except OSError:
+                        pass
+            if nbytes > MEMORY_FALLBACK_BYTES:
+                raise
+        self.progress = 0.
+        return compute(False)
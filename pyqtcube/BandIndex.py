@@ -0,0 +1,145 @@
+import os
+
+import numpy as np
+
+from .Background import CHUNK_BYTES, BackgroundBuild
+
+
+class CumulativeBandIndex(BackgroundBuild):
+    """
+    Prefix sums of a (nz, ny, nx) cube along the spectral axis.
+
+    P[k] holds the integral of the flux density (NaN counted as 0) from
+    the lower edge of channel 0 to the lower edge of channel k, N[k] the
+    number of finite values in the same channels.  The integral over any
+    band [l1, l2] is then F(l2) - F(l1), where F interpolates linearly
+    within the edge channels, so its cost does not depend on the width
+    of the band.
+
+    The index is stored in `path` or, when it cannot be written there and
+    is small enough, built in memory (see BackgroundBuild).
+    """
+
+    def __init__(self, data, edges, path=None, source=None):
+        """
+        data: (nz, ny, nx) array
+        edges: the nz + 1 channel edges (SpectralAxis.edges, plain values
+               in the unit of the bands)
+        path: optional prefix of the two .npy files storing the index
+        """
+        super().__init__()
+        self.data = data
+        self.path = path
+        self.source = source
+        self.__P = None
+        self.__N = None
+
+        edges = np.asarray(edges, dtype=float)
+        nz = len(edges) - 1
+        self.dwav = np.abs(np.diff(edges))
+        self.__ndtype = np.dtype(np.uint16 if nz < 2 ** 16 else np.int32)
+        order = np.argsort(edges)
+        self.__edges = edges[order]
+        self.__edge_idx = np.arange(nz + 1, dtype=float)[order]
+
+    @staticmethod
+    def default_path(ifile, extn=1):
+        return "%s.%d.band" % (ifile, extn)
+
+    @property
+    def nbytes(self):
+        """size of the index (P and N)"""
+        nz, ny, nx = self.data.shape
+        return (nz + 1) * ny * nx * (8 + self.__ndtype.itemsize)
+
+    def __files(self):
+        return self.path + ".P.npy", self.path + ".N.npy"
+
+    def __cached(self):
+        if self.path is None:
+            return None
+        nz, ny, nx = self.data.shape
+        out = []
+        for f in self.__files():
+            if not os.path.isfile(f):
+                return None
+            if self.source is not None and os.path.getmtime(f) < os.path.getmtime(self.source):
+                return None
+            try:
+                a = np.load(f, mmap_mode='r')
+            except ValueError:
+                return None
+            if a.shape != (nz + 1, ny, nx):
+                return None
+            out.append(a)
+        return out
+
+    def __integrate(self, stored):
+        nz, ny, nx = self.data.shape
+        shape = (nz + 1, ny, nx)
+        ndtype = self.__ndtype
+        if not stored:
+            P = np.empty(shape)
+            N = np.empty(shape, dtype=ndtype)
+        else:
+            files = self.__files()
+            P = np.lib.format.open_memmap(files[0] + ".tmp", mode='w+', dtype=float, shape=shape)
+            N = np.lib.format.open_memmap(files[1] + ".tmp", mode='w+', dtype=ndtype, shape=shape)
+        P[0] = 0
+        N[0] = 0
+
+        step = max(1, CHUNK_BYTES // (nz * nx * 8))
+        w = self.dwav[:, None, None]
+        for y1 in range(0, ny, step):
+            y2 = min(y1 + step, ny)
+            block = np.asarray(self.data[:, y1:y2, :], dtype=float)
+            good = np.isfinite(block)
+            P[1:, y1:y2] = np.cumsum(np.where(good, block, 0) * w, axis=0)
+            N[1:, y1:y2] = np.cumsum(good, axis=0, dtype=ndtype)
+            self.progress = y2 / ny
+
+        if not stored:
+            return P, N
+        P.flush()
+        N.flush()
+        del P, N
+        for f in files:
+            os.replace(f + ".tmp", f)
+        return self.__cached()
+
+    def build(self):
+        cached = self.__cached()
+        if cached is None:
+            files = self.__files() if self.path is not None else None
+            cached = self._build_stored(self.__integrate, files, self.nbytes)
+
+        self.__P, self.__N = cached
+        self.progress = 1.
+        self.ready = True
+        return self
+
+    def __edge_pos(self, lam):
+        """fractional edge index of the wavelength lam"""
+        return float(np.interp(lam, self.__edges, self.__edge_idx))
+
+    def __F(self, t):
+        k = int(np.floor(t))
+        f = t - k
+        if f == 0:
+            return np.asarray(self.__P[k])
+        P1 = np.asarray(self.__P[k])
+        return P1 + f * (np.asarray(self.__P[k + 1]) - P1)
+
+    def integral(self, l1, l2):
+        """
+        integral of the flux density between l1 and l2 (edge channels
+        weighted by the fraction of the channel inside the band);
+        NaN where no channel touched by the band has valid data
+        """
+        t1, t2 = sorted([self.__edge_pos(l1), self.__edge_pos(l2)])
+        flux = self.__F(t2) - self.__F(t1)
+        k1, k2 = int(np.floor(t1)), int(np.ceil(t2))
+        if k2 == k1:
+            k2 = min(k1 + 1, len(self.dwav))
+        nvalid = self.__N[k2].astype(int) - self.__N[k1]
+        return np.where(nvalid > 0, flux, np.nan)
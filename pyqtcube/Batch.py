@@ -0,0 +1,261 @@
+"""
+Headless batch processing: band images, continuum subtracted images and
+aperture spectra of a cube, all computed in one pass over its channels.
+
+A job file is a JSON document:
+
+    {
+        "cube": "cube.fits",
+        "extn": 1,
+        "unit": "Angstrom",
+        "output_dir": "products",
+        "jobs": [
+            {"type": "band", "name": "ha", "band": [6620, 6640]},
+            {"type": "continuum_subtracted", "name": "ha_net",
+             "line": [6620, 6640], "blue": [6580, 6600], "red": [6660, 6680]},
+            {"type": "spectra", "name": "sources",
+             "positions": [[10, 20], [30, 40]], "r": 3}
+        ]
+    }
+
+"cube" and "extn" may be given on the command line instead; "unit" is the
+unit of all the wavelengths (default Angstrom); "r" is one radius (pixels)
+or one per position.  Every job writes <output_dir>/<name>.fits: images
+with the celestial WCS of the cube, spectra as a (nsource, nchannel) image
+with the spectral WCS plus a SOURCES table.
+"""
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import astropy.units as u
+import numpy as np
+from astropy.io import fits
+
+from .Aperture import PixelGroups
+from .Background import CHUNK_BYTES
+from .DataCube import read, interpolate_continuum
+
+JOB_TYPES = ('band', 'continuum_subtracted', 'spectra')
+
+
+def load_jobs(ifile):
+    with open(ifile) as ff:
+        spec = json.load(ff)
+    for job in spec.get('jobs', []):
+        if job.get('type') not in JOB_TYPES:
+            raise ValueError("unknown job type %r (expected one of %s)" % (job.get('type'), ", ".join(JOB_TYPES)))
+        if 'name' not in job:
+            raise ValueError("job without a name: %r" % job)
+    return spec
+
+
+class BatchPlan:
+    """
+    The channel ranges of all the bands and the aperture tables of all the
+    spectra requested by a list of jobs, computed once for a cube.
+    """
+
+    def __init__(self, cube, jobs, unit=u.AA):
+        self.shape = cube.shape
+        self.unit = u.Unit(unit)
+        axis = cube.spectral_axis
+        # (l1, l2) -> (i1, i2, dl, w): channels [i1, i2), band width in the axis unit
+        # and width of each channel inside the band (see SpectralAxis.band_weights)
+        self.bands = {}
+        # job name -> PixelGroups of its apertures
+        self.apertures = {}
+        for job in jobs:
+            if job['type'] == 'band':
+                self.add_band(axis, job['band'])
+            elif job['type'] == 'continuum_subtracted':
+                for k in ('line', 'blue', 'red'):
+                    self.add_band(axis, job[k])
+            else:
+                xy = np.asarray(job['positions'], dtype=int).reshape(-1, 2)
+                self.apertures[job['name']] = PixelGroups.circles(self.shape[1:], xy[:, 0], xy[:, 1], job.get('r', 0))
+
+    def quantity(self, band):
+        return tuple(v * self.unit for v in band)
+
+    def add_band(self, axis, band):
+        key = tuple(float(v) for v in band)
+        if key in self.bands:
+            return
+        l1, l2 = self.quantity(key)
+        i1, i2, w = axis.band_weights(l1, l2)
+        dl = (l2 - l1).to_value(axis.unit, equivalencies=u.spectral())
+        self.bands[key] = (i1, i2, dl, w)
+
+    def chunks(self, itemsize):
+        """(k1, k2) blocks of CHUNK_BYTES covering all the channels needed"""
+        nz, ny, nx = self.shape
+        if self.apertures:
+            intervals = [(0, nz)]
+        else:
+            intervals = []
+            for i1, i2 in sorted((b[0], b[1]) for b in self.bands.values()):
+                if intervals and i1 <= intervals[-1][1]:
+                    intervals[-1] = (intervals[-1][0], max(intervals[-1][1], i2))
+                else:
+                    intervals.append((i1, i2))
+        step = max(1, CHUNK_BYTES // (ny * nx * itemsize))
+        return [(k, min(k + step, i2)) for i1, i2 in intervals for k in range(i1, i2, step)]
+
+
+def accumulate(block, k1, plan):
+    """band sums and aperture spectra of the channels [k1, k1 + len(block))"""
+    k2 = k1 + len(block)
+    good = np.isfinite(block)
+    zeroed = np.where(good, block, 0)
+    bands = {}
+    for key, (i1, i2, dl, w) in plan.bands.items():
+        j1, j2 = max(i1, k1), min(i2, k2)
+        if j1 >= j2:
+            continue
+        flux = np.einsum('kyx,k->yx', zeroed[j1 - k1:j2 - k1], w[j1 - i1:j2 - i1])
+        nvalid = good[j1 - k1:j2 - k1].sum(axis=0)
+        bands[key] = (flux, nvalid)
+
+    spectra = {}
+    flat = block.reshape(len(block), -1)
+    for name, groups in plan.apertures.items():
+        spectra[name] = groups.means(flat)
+    return k1, k2, bands, spectra
+
+
+# --- process pool ---------------------------------------------------------
+
+_state = None
+
+
+def _init_worker(ifile, extn, plan):
+    global _state
+    cube = read(ifile, extn=extn)
+    _state = (cube.data, plan)
+
+
+def _process_chunk(k1, k2, state=None):
+    data, plan = state or _state
+    return accumulate(np.asarray(data[k1:k2], dtype=float), k1, plan)
+
+
+def run_batch(jobs, cube=None, ifile=None, extn=1, unit=u.AA, output_dir=None, workers=None, overwrite=True):
+    """
+    Run a list of jobs (see the module docstring) on a DataCube, or on the
+    cube in the extension `extn` of `ifile`, in one pass over the channels.
+
+    Blocks of channels are processed in a pool of processes (each one
+    memory-mapping the FITS file), or of threads for cubes not read from a
+    file.  Returns a dict job name -> image or (nsource, nchannel) spectra;
+    with output_dir every product is also written to <name>.fits.
+    """
+    if cube is None:
+        cube = read(ifile, extn=extn)
+    plan = BatchPlan(cube, jobs, unit=unit)
+    nz, ny, nx = cube.shape
+
+    flux = {k: np.zeros((ny, nx)) for k in plan.bands}
+    nvalid = {k: np.zeros((ny, nx), dtype=int) for k in plan.bands}
+    spectra = {name: np.full((g.n, nz), np.nan) for name, g in plan.apertures.items()}
+
+    workers = workers or os.cpu_count()
+    chunks = plan.chunks(cube.data.dtype.itemsize)
+    if cube.filename is not None:
+        # spawned, not forked: every read() starts a channel prefetch thread
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker, initargs=(cube.filename, cube.extn, plan))
+        state = None
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+        state = (cube.data, plan)
+
+    with pool:
+        futures = [pool.submit(_process_chunk, k1, k2, state) for k1, k2 in chunks]
+        for f in futures:
+            k1, k2, bands, spec = f.result()
+            for key, (fl, nv) in bands.items():
+                flux[key] += fl
+                nvalid[key] += nv
+            for name, s in spec.items():
+                spectra[name][:, k1:k2] = s
+
+    images = {}
+    for key, (i1, i2, dl, w) in plan.bands.items():
+        img = flux[key]
+        img[nvalid[key] == 0] = np.nan
+        images[key] = img / dl
+
+    def band(b):
+        return images[tuple(float(v) for v in b)]
+
+    results = {}
+    for job in jobs:
+        if job['type'] == 'band':
+            results[job['name']] = band(job['band'])
+        elif job['type'] == 'continuum_subtracted':
+            line, blue, red = (plan.quantity(job[k]) for k in ('line', 'blue', 'red'))
+            cont = interpolate_continuum(line, blue, red, band(job['blue']), band(job['red']))
+            results[job['name']] = band(job['line']) - cont
+        else:
+            results[job['name']] = spectra[job['name']]
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        for job in jobs:
+            path = os.path.join(output_dir, job['name'] + '.fits')
+            products_hdul(cube, job, results[job['name']], plan.unit).writeto(path, overwrite=overwrite)
+    return results
+
+
+def fits_unit(unit):
+    """unit in the FITS format (the generic format if it has no FITS form)"""
+    try:
+        return unit.to_string('fits')
+    except ValueError:
+        return unit.to_string()
+
+
+def products_hdul(cube, job, result, unit):
+    """the FITS file of the product of a job"""
+    if job['type'] == 'spectra':
+        from astropy.table import Table
+        h = cube.spectral_wcs.to_header()
+        # axis 2: the row of the source in the SOURCES table, from 0
+        h['WCSAXES'] = 2
+        h['CTYPE2'] = ('SOURCE', 'Source index')
+        h['CRPIX2'] = 1
+        h['CRVAL2'] = 0
+        h['CDELT2'] = 1
+        h['BUNIT'] = fits_unit(cube.unit)
+        h['JOB'] = job['name']
+        xy = np.asarray(job['positions'], dtype=int).reshape(-1, 2)
+        ra, dec = cube.wcs.pixel_to_world_values(xy[:, 0], xy[:, 1])
+        r = np.broadcast_to(np.asarray(job.get('r', 0), dtype=float), len(xy))
+        sources = Table([xy[:, 0], xy[:, 1], r, ra, dec], names=['x', 'y', 'r', 'ra', 'dec'])
+        table = fits.table_to_hdu(sources)
+        table.name = 'SOURCES'
+        return fits.HDUList([fits.PrimaryHDU(result.astype('f4'), header=h), table])
+
+    h = cube.wcs.to_header()
+    h['BUNIT'] = fits_unit(cube.unit)
+    h['JOB'] = job['name']
+    h['JOBTYPE'] = job['type']
+    for k in ('band', 'line', 'blue', 'red'):
+        if k in job:
+            h[k.upper() + '1'] = (job[k][0], unit.to_string())
+            h[k.upper() + '2'] = (job[k][1], unit.to_string())
+    return fits.HDUList([fits.PrimaryHDU(result.astype('f4'), header=h)])
+
+
+def run_jobfile(ifile, cube_file=None, extn=None, output_dir=None, workers=None):
+    """run the jobs of a job file; cube_file, extn and output_dir override the file"""
+    spec = load_jobs(ifile)
+    cube_file = cube_file or spec.get('cube')
+    if cube_file is None:
+        raise ValueError("no cube given in %s or on the command line" % ifile)
+    extn = extn if extn is not None else spec.get('extn', 1)
+    output_dir = output_dir or spec.get('output_dir', '.')
+    return run_batch(spec['jobs'], ifile=cube_file, extn=extn, unit=u.Unit(spec.get('unit', 'Angstrom')),
+                     output_dir=output_dir, workers=workers)
@@ -0,0 +1,154 @@
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ChannelCache:
+    """
+    Bounded LRU cache of channel images with a background prefetcher.
+
+    get(i) returns the (read-only) image of channel i, loading it with
+    loader(i) on a miss.  After each get the prefetcher loads the next
+    `prefetch` channels in the direction the user is stepping, so holding
+    Left/Right keeps hitting the cache.
+
+    A bound method loader is held by a weak reference, so the cache does
+    not keep its owner (the DataCube) alive; the prefetch thread stops on
+    close() or when the cache is garbage collected.
+    """
+
+    def __init__(self, loader, nchan, max_bytes=256 * 2 ** 20, prefetch=8):
+        self.__loader = weakref.WeakMethod(loader) if hasattr(loader, '__self__') else (lambda: loader)
+        self.nchan = nchan
+        self.max_bytes = max_bytes
+        self.prefetch = prefetch
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+
+        self.__images = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__last = None
+        self.__direction = 1
+
+        # (i, direction) to prefetch from, and the stop flag, shared with the
+        # prefetch thread, which does not hold a reference to the cache
+        self.__cond = threading.Condition()
+        self.__state = dict(wanted=None, stop=False)
+        self.__thread = threading.Thread(target=self.__prefetch_loop, daemon=True,
+                                         args=(weakref.ref(self), self.__cond, self.__state))
+        self.__thread.start()
+        weakref.finalize(self, self.__stop, self.__cond, self.__state)
+
+    @property
+    def loader(self):
+        loader = self.__loader()
+        if loader is None:
+            raise ReferenceError("the owner of the channel cache has been deleted")
+        return loader
+
+    @staticmethod
+    def __stop(cond, state):
+        with cond:
+            state['stop'] = True
+            cond.notify()
+
+    def close(self):
+        """stop the prefetch thread and empty the cache"""
+        self.__stop(self.__cond, self.__state)
+        self.__thread.join()
+        self.clear()
+
+    @property
+    def closed(self):
+        return self.__state['stop']
+
+    def __len__(self):
+        return len(self.__images)
+
+    def __contains__(self, i):
+        return i in self.__images
+
+    @property
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self), nbytes=self.nbytes)
+
+    def clear(self):
+        with self.__lock:
+            self.__images.clear()
+            self.nbytes = 0
+
+    def __lookup(self, i):
+        with self.__lock:
+            ima = self.__images.get(i)
+            if ima is not None:
+                self.__images.move_to_end(i)
+            return ima
+
+    def __store(self, i, ima):
+        ima.setflags(write=False)
+        with self.__lock:
+            if i in self.__images or ima.nbytes > self.max_bytes:
+                return
+            self.__images[i] = ima
+            self.nbytes += ima.nbytes
+            while self.nbytes > self.max_bytes:
+                _, old = self.__images.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+    def get(self, i) -> np.ndarray:
+        ima = self.__lookup(i)
+        if ima is None:
+            self.misses += 1
+            ima = self.loader(i)
+            self.__store(i, ima)
+        else:
+            self.hits += 1
+
+        if self.__last is not None and i != self.__last:
+            self.__direction = 1 if i > self.__last else -1
+        self.__last = i
+        if self.prefetch > 0 and not self.closed:
+            with self.__cond:
+                self.__state['wanted'] = (i, self.__direction)
+                self.__cond.notify()
+        return ima
+
+    @staticmethod
+    def __prefetch_loop(ref, cond, state):
+        while True:
+            with cond:
+                while state['wanted'] is None and not state['stop']:
+                    cond.wait()
+                if state['stop']:
+                    return
+                i0, d = state['wanted']
+                state['wanted'] = None
+            cache = ref()
+            if cache is None:
+                return
+            try:
+                cache.__prefetch(i0, d)
+            except ReferenceError:
+                return
+            del cache
+
+    def __prefetch(self, i0, d):
+        # do not let the prefetch evict more than half of the cache
+        budget = self.max_bytes // 2
+        for k in range(1, self.prefetch + 1):
+            i = i0 + d * k
+            if not 0 <= i < self.nchan:
+                break
+            if self.__state['wanted'] is not None or self.__state['stop']:
+                # a newer position supersedes this one
+                break
+            if i in self.__images:
+                continue
+            ima = self.loader(i)
+            budget -= ima.nbytes
+            if budget < 0:
+                break
+            self.__store(i, ima)
@@ -0,0 +1,78 @@
+import numpy as np
+
+from .Background import CHUNK_BYTES, BackgroundBuild
+from .Tracing import traced
+
+PERCENTILES = (0.5, 1, 5, 25, 50, 75, 95, 99, 99.5)
+
+
+def zscale_interval():
+    # astropy.visualization is slow to import, and only needed here
+    from astropy.visualization import ZScaleInterval
+    return ZScaleInterval()
+
+
+@traced(cat='zscale')
+def sampled_zscale(ima, nmax=20000):
+    """ZScale limits of a regular subsample of about nmax pixels of ima"""
+    ima = np.asarray(ima)
+    stride = max(1, int(np.sqrt(ima.size / nmax)))
+    return zscale_interval().get_limits(ima[::stride, ::stride])
+
+
+class ChannelStatistics(BackgroundBuild):
+    """
+    Per-channel statistics of a (nz, ny, nx) cube, collected in a single
+    streaming pass: min, max, number of NaN, approximate percentiles and
+    zscale limits, the last two measured on a fixed subsample of pixels.
+    """
+
+    def __init__(self, data, nsample=4096, seed=0):
+        super().__init__()
+        self.data = data
+
+        nz, ny, nx = data.shape
+        npix = ny * nx
+        rng = np.random.default_rng(seed)
+        self.sample_idx = np.sort(rng.choice(npix, size=min(nsample, npix), replace=False))
+
+        self.min = np.full(nz, np.nan)
+        self.max = np.full(nz, np.nan)
+        self.nnan = np.zeros(nz, dtype=int)
+        self.percentiles = np.full((nz, len(PERCENTILES)), np.nan)
+        self.zscale = np.full((nz, 2), np.nan)
+        self.global_levels = None
+
+    def build(self):
+        nz, ny, nx = self.data.shape
+        step = max(1, CHUNK_BYTES // (ny * nx * self.data.dtype.itemsize))
+        interval = zscale_interval()
+        # float32 is enough for the zscale of the whole cube, and half the size
+        samples = np.empty((nz, len(self.sample_idx)), dtype=np.float32)
+        for k1 in range(0, nz, step):
+            k2 = min(k1 + step, nz)
+            block = np.asarray(self.data[k1:k2]).reshape(k2 - k1, -1)
+            bad = ~np.isfinite(block)
+            self.nnan[k1:k2] = bad.sum(axis=1)
+            with np.errstate(invalid='ignore'):
+                self.min[k1:k2] = np.nanmin(block, axis=1)
+                self.max[k1:k2] = np.nanmax(block, axis=1)
+                sub = block[:, self.sample_idx]
+                samples[k1:k2] = sub
+                self.percentiles[k1:k2] = np.nanpercentile(sub, PERCENTILES, axis=1).T
+            for k in range(k1, k2):
+                s = sub[k - k1]
+                if np.isfinite(s).any():
+                    self.zscale[k] = interval.get_limits(s)
+            self.progress = k2 / nz
+
+        self.global_levels = tuple(float(v) for v in interval.get_limits(samples))
+        self.progress = 1.
+        self.ready = True
+        return self
+
+    def levels(self, i):
+        """zscale limits of channel i, None if not available (yet)"""
+        if not self.ready or not np.all(np.isfinite(self.zscale[i])):
+            return None
+        return tuple(float(v) for v in self.zscale[i])
@@ -171,7 +171,7 @@ class SliderText(QWidget):
     def __init__(self, label=None, vmin=None, vmax=None, step=None):
         super().__init__()
 
-        nsteps = int(np.float(vmax - vmin) / step) + 1
+        nsteps = int(float(vmax - vmin) / step) + 1
 
         self.__values = np.linspace(vmin, vmax, nsteps)
         mainbox = QHBoxLayout()
@@ -1,51 +1,582 @@
-from spectral_cube import SpectralCube
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+
 import astropy.units as u
 import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from .Aperture import ApertureEngine, PixelGroups
+from .Background import CHUNK_BYTES
+from .BandIndex import CumulativeBandIndex
+from .ChannelCache import ChannelCache
+from .ChannelStats import ChannelStatistics
+from .LineFit import fit_cube
+from .Moments import moment_maps
+from .Smoothing import gaussian_smooth_axis, gaussian_smooth_axis_variance
+from .SpecSidecar import SpectrumSidecar
+from .SpectralAxis import SpectralAxis
+from .Tracing import traced, traced_methods
+
+# bound of the temporaries of all the workers of DataCube.smoothed; one
+# worker needs about SMOOTH_TEMP_FACTOR float64 copies of its block of rows
+SMOOTH_MAX_BYTES = 8 * CHUNK_BYTES
+SMOOTH_TEMP_FACTOR = 7
+
+# names of the extensions looked up for the variance of the data
+# (STAT in MUSE cubes)
+VARIANCE_EXTNAMES = ('STAT', 'VARIANCE', 'VAR')
+
+
+@traced(cat='DataCube')
+def read(ifile, extn=1, memmap=True, variance='auto'):
+    """
+    Open a spectral cube stored in the extension `extn` of a FITS file.
+
+    With memmap=True (default) the data are memory-mapped and only the
+    channels or spectra actually requested are read from disk.
+    `variance` is the extension (name or number) with the variance of the
+    data; 'auto' attaches the first of VARIANCE_EXTNAMES with the shape of
+    the data, if any, and None none.
+    """
+    hdul = fits.open(ifile, memmap=memmap, lazy_load_hdus=True)
+    hdu = hdul[extn]
+    cube = DataCube(hdu.data, hdu.header)
+    cube.filename = ifile
+    cube.extn = extn
+    if variance == 'auto':
+        for name in VARIANCE_EXTNAMES:
+            try:
+                var = hdul[name]
+            except KeyError:
+                continue
+            if var.shape == cube.shape:
+                cube.attach_variance(var.data)
+                break
+    elif variance is not None:
+        cube.attach_variance(hdul[variance].data)
+    # keep the file open as long as the memory map is in use
+    cube._hdul = hdul
+    return cube
+
+
+def _native(a):
+    """copy `a` out of the memory map in native byte order"""
+    a = np.asarray(a)
+    return a.astype(a.dtype.newbyteorder('='))
+
 
+def interpolate_continuum(line, blue, red, fluxb, fluxr):
+    """continuum at the centre of `line` from the band images of `blue` and `red`"""
+    c = 0.5 * (line[0] + line[1])
+    b = 0.5 * (blue[0] + blue[1])
+    r = 0.5 * (red[0] + red[1])
+    k = ((c - b) / (r - b)).decompose().value
+    return k * fluxb + (1 - k) * fluxr
 
-def read(ifile, extn=1):
-    return DataCube(SpectralCube.read(ifile, hdu=extn))
 
+def interpolate_continuum_variance(line, blue, red, varb, varr):
+    """variance of interpolate_continuum from the variances of the band images"""
+    c = 0.5 * (line[0] + line[1])
+    b = 0.5 * (blue[0] + blue[1])
+    r = 0.5 * (red[0] + red[1])
+    k = ((c - b) / (r - b)).decompose().value
+    return k ** 2 * varb + (1 - k) ** 2 * varr
 
+
+@traced_methods('DataCube')
 class DataCube:
 
-    def __init__(self, cube: SpectralCube):
-        self.__cube = cube
+    def __init__(self, data, header):
+        """
+        data: array-like with shape (nz, ny, nx), usually a numpy.memmap
+        header: FITS header with the 3D WCS
+        """
+        self.__data = data
+        self.__variance = None
+        self.__header = header
+        self.__wcs = WCS(header)
+        self.filename = None
+        self.extn = None
+        self.__sidecar = None
+        self.__variance_sidecar = None
+        self.__band_index = None
+        self.__aperture = ApertureEngine(self.__spectral_block, self.shape)
+        self.__channels = ChannelCache(self.__read_channel, self.shape[0])
+        self.__smoothed = {}
+        # sigma -> Future of a smoothed() call in progress
+        self.__smoothing = {}
+        self.__smoothing_lock = threading.Lock()
+        self.__stats = None
+        self.__moments = OrderedDict()
+
+        bunit = header.get('BUNIT', '')
+        self.__unit = u.Unit(bunit, parse_strict='silent') if bunit else u.one
+
+        self.__axis = SpectralAxis.from_wcs(self.__wcs.spectral, self.shape[0], header.get('CUNIT3'))
+
+    @classmethod
+    def from_spectral_cube(cls, cube):
+        """wrap an (in memory) spectral_cube.SpectralCube"""
+        return cls(cube.unmasked_data[:].value, cube.header)
+
+    @property
+    def data(self):
+        return self.__data
+
+    @property
+    def variance(self):
+        """the variance cube (None if not attached)"""
+        return self.__variance
+
+    def attach_variance(self, variance):
+        """
+        attach the variance of the data (array-like with the shape of the
+        data, usually a numpy.memmap); the accessors called with
+        variance=True then propagate it, reading it in the same pass as the
+        data
+        """
+        if tuple(variance.shape) != self.shape:
+            raise ValueError("variance of shape %s for a cube of shape %s" % (tuple(variance.shape), self.shape))
+        self.__variance = variance
+        self.__variance_sidecar = None
+        self.__aperture.read_variance = self.__variance_block
+
+    def __require_variance(self):
+        if self.__variance is None:
+            raise ValueError("no variance attached to the cube")
+
+    @property
+    def header(self):
+        return self.__header
 
     @property
     def unit(self):
-        return self.__cube.unit
+        return self.__unit
 
     @property
     def shape(self):
-        return self.__cube.shape
+        return self.__data.shape
 
     @property
     def wavelenght(self):
-        return self.__cube.spectral_axis
+        return self.__axis.quantity
+
+    @property
+    def spectral_axis(self):
+        return self.__axis
 
     @property
     def wcs(self):
-        return self.__cube.wcs.celestial
+        return self.__wcs.celestial
+
+    @property
+    def spectral_wcs(self):
+        return self.__wcs.spectral
+
+    @property
+    def sidecar(self):
+        return self.__sidecar
+
+    @property
+    def variance_sidecar(self):
+        return self.__variance_sidecar
+
+    def build_spectrum_sidecar(self, cache=True, background=True):
+        """
+        build a spectrum-contiguous copy of the data (and of the variance,
+        if attached) used by get_1dSpec once it is ready.  With cache=True
+        it is stored next to the FITS file and reused the next time the
+        cube is opened.
+        """
+        cache = cache and self.filename is not None
+        path = SpectrumSidecar.default_path(self.filename, self.extn) if cache else None
+        self.__sidecar = SpectrumSidecar(self.__data, path=path, source=self.filename)
+        sidecars = [self.__sidecar]
+        if self.__variance is not None:
+            path = SpectrumSidecar.default_path(self.filename, self.extn, 'var') if cache else None
+            self.__variance_sidecar = SpectrumSidecar(self.__variance, path=path, source=self.filename)
+            sidecars.append(self.__variance_sidecar)
+        for sidecar in sidecars:
+            if background:
+                sidecar.build_in_background()
+            else:
+                sidecar.build()
+        return self.__sidecar
+
+    @property
+    def band_index(self):
+        return self.__band_index
+
+    @property
+    def band_index_ready(self):
+        return self.__band_index is not None and self.__band_index.ready
+
+    def build_band_index(self, cache=True, background=True):
+        """
+        build the cumulative sums along the spectral axis used by
+        get_image_band once they are ready (see CumulativeBandIndex).
+        With cache=True they are stored next to the FITS file.
+        """
+        path = None
+        if cache and self.filename is not None:
+            path = CumulativeBandIndex.default_path(self.filename, self.extn)
+        self.__band_index = CumulativeBandIndex(self.__data, self.__axis.edges, path=path, source=self.filename)
+        if background:
+            self.__band_index.build_in_background()
+        else:
+            self.__band_index.build()
+        return self.__band_index
+
+    def __spectral_block(self, x1, x2, y1, y2):
+        if self.__sidecar is not None and self.__sidecar.ready:
+            return self.__sidecar.block(x1, x2, y1, y2)
+        return _native(self.__data[:, y1:y2, x1:x2])
+
+    def __variance_block(self, x1, x2, y1, y2):
+        if self.__variance_sidecar is not None and self.__variance_sidecar.ready:
+            return self.__variance_sidecar.block(x1, x2, y1, y2)
+        return _native(self.__variance[:, y1:y2, x1:x2])
+
+    @property
+    def channel_stats(self):
+        return self.__stats
+
+    def build_channel_stats(self, background=True):
+        """one pass over the cube collecting per-channel statistics and zscale limits"""
+        self.__stats = ChannelStatistics(self.__data)
+        if background:
+            self.__stats.build_in_background()
+        else:
+            self.__stats.build()
+        return self.__stats
+
+    def channel_levels(self, i):
+        """precomputed zscale limits of channel i, None if not available"""
+        if self.__stats is None:
+            return None
+        return self.__stats.levels(i)
+
+    def global_levels(self):
+        """zscale limits of the whole cube, None if not available"""
+        if self.__stats is None or not self.__stats.ready:
+            return None
+        return self.__stats.global_levels
+
+    def smoothed(self, sigma, cache=True, workers=None, cancelled=None):
+        """
+        a new DataCube with every spectrum smoothed by a Gaussian of width
+        sigma (channels), and its variance propagated when one is attached,
+        computed in blocks of rows on `workers` threads
+        (fewer if their temporaries would exceed SMOOTH_MAX_BYTES).
+        The result is kept for the next call and, with cache=True, stored
+        in .npy files next to the FITS file.  Concurrent calls for the same
+        sigma share one computation; cancelled() is polled between blocks
+        and, when it returns True, the computation stops with CancelledError.
+        """
+        while True:
+            with self.__smoothing_lock:
+                if sigma in self.__smoothed:
+                    return self.__smoothed[sigma]
+                pending = self.__smoothing.get(sigma)
+                if pending is None:
+                    pending = self.__smoothing[sigma] = Future()
+                    break
+            try:
+                return pending.result()
+            except CancelledError:
+                # the call computing it was cancelled: compute it here
+                continue
+
+        try:
+            cube = self.__smooth(sigma, cache, workers, cancelled)
+        except BaseException as exc:
+            with self.__smoothing_lock:
+                del self.__smoothing[sigma]
+            pending.set_exception(exc)
+            raise
+        with self.__smoothing_lock:
+            self.__smoothed[sigma] = cube
+            del self.__smoothing[sigma]
+        pending.set_result(cube)
+        return cube
+
+    def __smooth(self, sigma, cache, workers, cancelled):
+        path = vpath = None
+        if cache and self.filename is not None:
+            path = "%s.%d.smooth%g.npy" % (self.filename, self.extn, sigma)
+            vpath = "%s.%d.smooth%g.var.npy" % (self.filename, self.extn, sigma)
+        cube = DataCube(self.__smooth_array(self.__data, gaussian_smooth_axis, sigma, path, workers, cancelled),
+                        self.__header)
+        # the variance follows, so that the S/N and errors of the smoothed cube are available
+        if self.__variance is not None:
+            cube.attach_variance(self.__smooth_array(self.__variance, gaussian_smooth_axis_variance, sigma, vpath,
+                                                     workers, cancelled))
+        return cube
+
+    def __smooth_array(self, data, smooth, sigma, path, workers, cancelled):
+        """smooth(data, sigma, axis=0) computed in blocks of rows, stored in path if not None"""
+        nz, ny, nx = self.shape
+        out = None
+        if path is not None and os.path.isfile(path) and \
+                os.path.getmtime(path) >= os.path.getmtime(self.filename):
+            out = np.load(path, mmap_mode='r')
+            if out.shape != self.shape:
+                out = None
+
+        if out is None:
+            dtype = data.dtype.newbyteorder('=')
+            tmp = None
+            if path is None:
+                out = np.empty(self.shape, dtype=dtype)
+            else:
+                # a unique temporary file: other processes may be smoothing the same cube
+                fd, tmp = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(path) + ".",
+                                           dir=os.path.dirname(os.path.abspath(path)))
+                os.close(fd)
+                out = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=self.shape)
+
+            # blocks of rows, and number of workers, within SMOOTH_MAX_BYTES of temporaries
+            workers = workers or os.cpu_count() or 1
+            row = nz * nx * 8
+            step = max(1, min(CHUNK_BYTES, SMOOTH_MAX_BYTES // (SMOOTH_TEMP_FACTOR * workers)) // row)
+            workers = max(1, min(workers, SMOOTH_MAX_BYTES // (SMOOTH_TEMP_FACTOR * step * row)))
+
+            def smooth_rows(y1):
+                if cancelled is not None and cancelled():
+                    raise CancelledError()
+                y2 = min(y1 + step, ny)
+                out[:, y1:y2] = smooth(data[:, y1:y2], sigma, axis=0)
+
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    list(pool.map(smooth_rows, range(0, ny, step)))
+            except BaseException:
+                if tmp is not None:
+                    del out
+                    os.remove(tmp)
+                raise
+
+            if tmp is not None:
+                out.flush()
+                del out
+                os.replace(tmp, path)
+                out = np.load(path, mmap_mode='r')
+
+        return out
+
+    def channel_chunks(self, i1, i2, narrays=1):
+        """
+        yield (k1, k2) blocks covering channels [i1, i2) within CHUNK_BYTES,
+        for `narrays` arrays read together (e.g. 2 for data and variance)
+        """
+        nz, ny, nx = self.shape
+        step = max(1, CHUNK_BYTES // (narrays * ny * nx * self.__data.dtype.itemsize))
+        for k in range(i1, i2, step):
+            yield k, min(k + step, i2)
+
+    def clear_caches(self):
+        """empty the channel cache and drop the cached moment maps and smoothed copies"""
+        self.__channels.clear()
+        self.__moments.clear()
+        with self.__smoothing_lock:
+            smoothed = list(self.__smoothed.values())
+            self.__smoothed.clear()
+        for cube in smoothed:
+            cube.close()
+
+    def close(self):
+        """stop the channel prefetcher of the cube and of its smoothed copies, and close the FITS file"""
+        self.__channels.close()
+        for cube in self.__smoothed.values():
+            cube.close()
+        hdul = getattr(self, '_hdul', None)
+        if hdul is not None:
+            hdul.close()
+
+    @property
+    def channel_cache(self):
+        """the ChannelCache behind get_channel (max_bytes, prefetch, hits, misses)"""
+        return self.__channels
+
+    def __read_channel(self, i):
+        return _native(self.__data[i])
 
     def get_channel(self, i) -> np.ndarray:
-        return self.__cube[i].value
+        return self.__channels.get(i)
+
+    def get_image_band(self, l1: u.Quantity, l2: u.Quantity, variance=False):
+        """
+        mean flux density between l1 and l2; with variance=True returns the
+        image and its variance, from one pass over the data and variance
+        """
+        dl = (l2 - l1).to(self.__axis.unit, equivalencies=u.spectral()).value
+        if variance:
+            self.__require_variance()
+        elif self.band_index_ready:
+            lam1 = l1.to(self.__axis.unit, equivalencies=u.spectral()).value
+            lam2 = l2.to(self.__axis.unit, equivalencies=u.spectral()).value
+            return self.__band_index.integral(lam1, lam2) / dl
+
+        # the same fractional edge channels as the band index
+        i1, i2, weights = self.__axis.band_weights(l1, l2)
+        nz, ny, nx = self.shape
+        flux = np.zeros((ny, nx))
+        nvalid = np.zeros((ny, nx), dtype=int)
+        if variance:
+            var = np.zeros((ny, nx))
+        for k1, k2 in self.channel_chunks(i1, i2, narrays=2 if variance else 1):
+            block = _native(self.__data[k1:k2])
+            width = weights[k1 - i1:k2 - i1]
+            good = np.isfinite(block)
+            if variance:
+                vblock = _native(self.__variance[k1:k2])
+                good &= np.isfinite(vblock)
+                var += np.einsum('kyx,k->yx', np.where(good, vblock, 0), width ** 2)
+            flux += np.einsum('kyx,k->yx', np.where(good, block, 0), width)
+            nvalid += good.sum(axis=0)
+        flux[nvalid == 0] = np.nan
+        if variance:
+            var[nvalid == 0] = np.nan
+            return flux / dl, var / dl ** 2
+        return flux / dl
+
+    def get_continuum(self, line, blue, red, variance=False):
+        """
+        continuum flux density at `line` interpolated from the `blue` and
+        `red` bands; each band is a (l1, l2) pair of Quantity.  With
+        variance=True returns the continuum and its variance.
+        """
+        if variance:
+            fluxb, varb = self.get_image_band(*blue, variance=True)
+            fluxr, varr = self.get_image_band(*red, variance=True)
+            return (interpolate_continuum(line, blue, red, fluxb, fluxr),
+                    interpolate_continuum_variance(line, blue, red, varb, varr))
+        fluxb = self.get_image_band(*blue)
+        fluxr = self.get_image_band(*red)
+        return interpolate_continuum(line, blue, red, fluxb, fluxr)
 
-    def get_image_band(self, l1: u.Quantity, l2: u.Quantity):
-        return (self.__cube.spectral_slab(l1, l2).moment0() / (l2 - l1)).to(self.unit).value
+    def get_image_continuum_subtracted(self, line, blue, red, variance=False):
+        """
+        band image of `line` minus the continuum from the `blue` and `red`
+        bands; with variance=True returns the image and its variance
+        (the bands are taken as independent)
+        """
+        if variance:
+            flux, var = self.get_image_band(*line, variance=True)
+            cont, cvar = self.get_continuum(line, blue, red, variance=True)
+            return flux - cont, var + cvar
+        return self.get_image_band(*line) - self.get_continuum(line, blue, red)
 
-    def get_1dSpec(self, x, y, r=0):
-        if r == 0:
-            return self.__cube[:, y, x].value
+    def get_image_snr(self, line, blue=None, red=None):
+        """
+        signal to noise ratio of the band image of `line` or, with `blue`
+        and `red` bands, of the continuum subtracted image
+        """
+        if blue is not None and red is not None:
+            flux, var = self.get_image_continuum_subtracted(line, blue, red, variance=True)
         else:
-            yy, xx = np.indices([r * 2 + 1, r * 2 + 1], dtype='float')
-            radiusw = ((yy - r) ** 2 + (xx - r) ** 2)
-            mask = radiusw <= r ** 2
+            flux, var = self.get_image_band(*line, variance=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(var > 0, flux / np.sqrt(var), np.nan)
 
-            subcube = self.__cube[:, y - r:y + r + 1, x - r:x + r + 1]
-            maskedsubcube = subcube.with_mask(mask)
-            spec = maskedsubcube.mean(axis=(1, 2))
-            return spec
+    def get_moments(self, l1: u.Quantity, l2: u.Quantity, lam_ref=None, blue=None, red=None):
+        """
+        flux (moment 0), velocity (moment 1, km/s) and dispersion (moment 2,
+        km/s) maps of the channels between l1 and l2, in one pass over the
+        data (see Moments.moment_maps).  Velocities are relative to lam_ref
+        (default: the centre of the band); with `blue` and `red` bands the
+        continuum is subtracted first.  The last results are cached.
+        """
+        wu = self.__axis.unit
+        if lam_ref is None:
+            lam_ref = 0.5 * (l1 + l2)
+        key = tuple(round(float(v.to(wu, equivalencies=u.spectral()).value), 6)
+                    for v in [l1, l2, lam_ref] + list(blue or []) + list(red or []))
+        if key in self.__moments:
+            self.__moments.move_to_end(key)
+            return self.__moments[key]
+
+        # the same fractional edge channels as the band images
+        i1, i2, widths = self.__axis.band_weights(l1, l2)
+        continuum = None
+        if blue is not None and red is not None:
+            continuum = self.get_continuum((l1, l2), blue, red)
+        maps = moment_maps(self.__data, self.__axis.values, widths, i1, i2,
+                           lam_ref.to(wu, equivalencies=u.spectral()).value, continuum=continuum)
+
+        self.__moments[key] = maps
+        while len(self.__moments) > 8:
+            self.__moments.popitem(last=False)
+        return maps
+
+    def get_moment(self, order, l1: u.Quantity, l2: u.Quantity, **kwargs):
+        """one of the maps of get_moments (order 0, 1 or 2)"""
+        return self.get_moments(l1, l2, **kwargs)[order]
+
+    def fit_lines(self, rest, z, halfwidth=1000., workers=None, progress=None):
+        """
+        fit Gaussian emission lines of rest wavelengths `rest` (Angstrom, air)
+        at redshift z in every spaxel (see LineFit.fit_cube); returns the
+        flux, velocity, sigma, continuum and chi2 maps
+        """
+        return fit_cube(self, rest, z, halfwidth=halfwidth, workers=workers, progress=progress)
+
+    @property
+    def aperture(self):
+        return self.__aperture
+
+    def get_1dSpec(self, x, y, r=0, annulus=None, variance=False):
+        """
+        spectrum of the pixel (x, y) or, for r > 0, the mean spectrum within
+        radius r (see ApertureEngine); annulus=(r_in, r_out) subtracts the
+        local background measured in that annulus.  With variance=True
+        returns the spectrum and its variance.
+        """
+        if variance:
+            self.__require_variance()
+        if r == 0 and annulus is None:
+            if self.__sidecar is not None and self.__sidecar.ready:
+                spec = self.__sidecar.spectrum(x, y)
+            else:
+                spec = _native(self.__data[:, y, x])
+            if not variance:
+                return spec
+            if self.__variance_sidecar is not None and self.__variance_sidecar.ready:
+                return spec, self.__variance_sidecar.spectrum(x, y)
+            return spec, _native(self.__variance[:, y, x])
+        return self.__aperture.spectrum(x, y, r, annulus=annulus, variance=variance)
+
+    def get_spectra(self, x=None, y=None, r=0, labels=None, exact=True, variance=False):
+        """
+        mean spectra of many apertures in one pass over the channels:
+        circular apertures of radius r (one, or one per source) centred on
+        the pixels (x, y), or the regions of a (ny, nx) label map (0 is
+        background, one spectrum per label value in increasing order).
+        Returns an (nsource, nz) array, with variance=True also its variance.
+        """
+        nz, ny, nx = self.shape
+        if variance:
+            self.__require_variance()
+        if labels is not None:
+            groups = PixelGroups.labels(labels)
+        else:
+            groups = PixelGroups.circles((ny, nx), x, y, r, exact=exact)
+        out = np.empty((groups.n, nz))
+        if variance:
+            out_var = np.empty((groups.n, nz))
+        for k1, k2 in self.channel_chunks(0, nz, narrays=2 if variance else 1):
+            # the groups read (and convert) only the windows they cover
+            if variance:
+                out[:, k1:k2], out_var[:, k1:k2] = groups.means(self.__data[k1:k2], self.__variance[k1:k2])
+            else:
+                out[:, k1:k2] = groups.means(self.__data[k1:k2])
+        if variance:
+            return out, out_var
+        return out
 
     def closest_spectral_channel(self, v):
-        return self.__cube.closest_spectral_channel(v)
+        return self.__axis.closest(v)
@@ -0,0 +1,105 @@
+import warnings
+
+import numpy as np
+import pyqtgraph as pg
+
+
+def minmax_decimate(x, y, nbins):
+    """
+    Peak preserving decimation of the curve (x, y) to at most 2 * nbins
+    points: the minimum and maximum of each bin of consecutive samples, in
+    their original order.  All-NaN bins give NaN points.
+    """
+    n = len(y)
+    k = int(np.ceil(n / nbins))
+    if k <= 2:
+        return x, y
+    nb = int(np.ceil(n / k))
+    pad = np.full(nb * k, np.nan)
+    pad[:n] = y
+    pad = pad.reshape(nb, k)
+    good = np.isfinite(pad)
+    imin = np.where(good, pad, np.inf).argmin(axis=1)
+    imax = np.where(good, pad, -np.inf).argmax(axis=1)
+    idx = np.sort(np.stack([imin, imax], axis=1), axis=1) + (np.arange(nb) * k)[:, None]
+    idx = np.minimum(idx.ravel(), n - 1)
+    yd = np.where(good.any(axis=1).repeat(2), y[idx], np.nan)
+    return x[idx], yd
+
+
+class DecimatedCurveItem(pg.PlotCurveItem):
+    """
+    PlotCurveItem for long spectra: only the samples within the visible x
+    range (plus one on each side) are drawn and, when there are more than
+    two per screen pixel, they are reduced with minmax_decimate.  The curve
+    is recomputed when the view range or size changes; x must be monotonic
+    (descending curves are stored reversed).
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.xFull = None
+        self.yFull = None
+        self.__key = None
+        self.__kwargs = {}
+        super().__init__(*args, **kwargs)
+
+    def setData(self, x=None, y=None, **kwargs):
+        self.xFull = None if x is None else np.asarray(x, dtype=float)
+        self.yFull = None if y is None else np.asarray(y, dtype=float)
+        # the binary searches of visibleSlice and dataBounds need ascending x
+        if self.xFull is not None and len(self.xFull) > 1 and self.xFull[0] > self.xFull[-1]:
+            self.xFull = self.xFull[::-1]
+            if self.yFull is not None:
+                self.yFull = self.yFull[::-1]
+        self.__key = None
+        self.__kwargs = kwargs
+        self.redecimate()
+
+    def visibleSlice(self):
+        vb = self.getViewBox()
+        x = self.xFull
+        if vb is None:
+            return 0, len(x), None
+        (x1, x2), _ = vb.viewRange()
+        i1 = max(int(np.searchsorted(x, x1)) - 1, 0)
+        i2 = min(int(np.searchsorted(x, x2, side='right')) + 1, len(x))
+        return i1, i2, max(int(vb.width()), 1)
+
+    def redecimate(self):
+        if self.xFull is None or self.yFull is None or len(self.xFull) == 0:
+            super().setData(x=self.xFull, y=self.yFull, **self.__kwargs)
+            return
+        i1, i2, width = self.visibleSlice()
+        key = (i1, i2, width)
+        if key == self.__key:
+            return
+        self.__key = key
+        x, y = self.xFull[i1:i2], self.yFull[i1:i2]
+        if width is not None:
+            x, y = minmax_decimate(x, y, width)
+        super().setData(x=x, y=y, **self.__kwargs)
+
+    def viewRangeChanged(self):
+        super().viewRangeChanged()
+        if self.xFull is not None:
+            self.redecimate()
+
+    def dataBounds(self, ax, frac=1.0, orthoRange=None):
+        # bounds of the whole curve, not of the part drawn
+        if self.xFull is None or len(self.xFull) == 0:
+            return None, None
+        x, y = self.xFull, self.yFull
+        if ax == 0:
+            return x[0], x[-1]
+        if orthoRange is not None:
+            i1 = np.searchsorted(x, orthoRange[0])
+            i2 = np.searchsorted(x, orthoRange[1], side='right')
+            y = y[i1:i2]
+        if len(y) == 0:
+            return None, None
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            b = (np.nanmin(y), np.nanmax(y))
+        if not (np.isfinite(b[0]) and np.isfinite(b[1])):
+            return None, None
+        return b
@@ -0,0 +1,59 @@
+import numpy as np
+
+
+def sexagesimal(v, precision=4, alwayssign=False):
+    """
+    format v (hours or degrees) as astropy's Angle.to_string(sep=":"),
+    e.g. "8:13:49.6294" or "-20:00:00.0000"
+    """
+    sign = "-" if v < 0 else ("+" if alwayssign else "")
+    scale = 10 ** precision
+    n = int(round(abs(v) * 3600 * scale))
+    s, n = n % (60 * scale), n // (60 * scale)
+    m, d = n % 60, n // 60
+    if precision > 0:
+        sec = "%02d.%0*d" % (s // scale, precision, s % scale)
+    else:
+        sec = "%02d" % s
+    return "%s%d:%02d:%s" % (sign, d, m, sec)
+
+
+class SkyGrid:
+    """
+    Celestial coordinates of an image interpolated from a coarse grid.
+
+    The WCS is evaluated once, vectorized, every `step` pixels; lookups
+    interpolate bilinearly the unit vectors of the grid nodes, which is
+    exact to well below a milliarcsecond for the small cells of an IFU
+    field and well behaved across RA=0 and near the poles.
+    """
+
+    def __init__(self, wcs, shape, step=16):
+        ny, nx = shape
+        self.shape = shape
+        self.step = step
+        gx = np.arange(0, nx + step, step, dtype=float)
+        gy = np.arange(0, ny + step, step, dtype=float)
+        X, Y = np.meshgrid(gx, gy)
+        ra, dec = wcs.pixel_to_world_values(X, Y)
+        ra = np.radians(ra)
+        dec = np.radians(dec)
+        self.__xyz = np.stack([np.cos(dec) * np.cos(ra),
+                               np.cos(dec) * np.sin(ra),
+                               np.sin(dec)], axis=-1)
+
+    def radec(self, x, y):
+        """(ra, dec) in degrees of the pixel position (x, y)"""
+        ny1, nx1 = self.__xyz.shape[:2]
+        fx = x / self.step
+        fy = y / self.step
+        i = min(max(int(np.floor(fx)), 0), nx1 - 2)
+        j = min(max(int(np.floor(fy)), 0), ny1 - 2)
+        fx -= i
+        fy -= j
+        g = self.__xyz
+        v = ((1 - fx) * (1 - fy) * g[j, i] + fx * (1 - fy) * g[j, i + 1] +
+             (1 - fx) * fy * g[j + 1, i] + fx * fy * g[j + 1, i + 1])
+        ra = np.degrees(np.arctan2(v[1], v[0])) % 360
+        dec = np.degrees(np.arctan2(v[2], np.hypot(v[0], v[1])))
+        return ra, dec
@@ -0,0 +1,123 @@
+import numpy as np
+import pyqtgraph as pg
+
+from .Tracing import traced
+
+
+class ImagePyramid:
+    """
+    Mip-map pyramid of an image: level k is the NaN-aware mean of 2^k x 2^k
+    blocks of pixels.  Levels are computed lazily, each from the previous one.
+    """
+
+    def __init__(self, data, min_size=32):
+        self.min_size = min_size
+        self.__levels = [np.asarray(data)]
+
+    def __len__(self):
+        return len(self.__levels)
+
+    def nlevels(self):
+        """number of levels down to min_size pixels per side"""
+        n = max(self.__levels[0].shape)
+        k = 1
+        while n > self.min_size:
+            n = (n + 1) // 2
+            k += 1
+        return k
+
+    def level(self, k):
+        k = min(max(k, 0), self.nlevels() - 1)
+        while len(self.__levels) <= k:
+            a = self.__levels[-1]
+            ny, nx = a.shape
+            pad = np.full((ny + ny % 2, nx + nx % 2), np.nan)
+            pad[:ny, :nx] = a
+            blocks = pad.reshape(pad.shape[0] // 2, 2, pad.shape[1] // 2, 2)
+            with np.errstate(invalid='ignore'):
+                good = np.isfinite(blocks)
+                n = good.sum(axis=(1, 3))
+                s = np.where(good, blocks, 0).sum(axis=(1, 3))
+                self.__levels.append(np.where(n > 0, s / np.maximum(n, 1), np.nan))
+        return self.__levels[k]
+
+    def level_for(self, factor):
+        """the level matching `factor` data pixels per screen pixel"""
+        if not factor > 1:
+            return 0
+        return min(int(np.floor(np.log2(factor))), self.nlevels() - 1)
+
+
+class SharedRenderer:
+    """
+    Maps an image to RGBA (levels + colour lookup table) once and shares the
+    result between the views showing it: the main image and the panner get
+    the pyramid level matching their zoom, the magnifier a full resolution
+    crop.  The RGBA image of each level is cached until the data, levels
+    or lookup table change.
+    """
+
+    def __init__(self):
+        self.data = None
+        self.pyramid = None
+        self.levels = None
+        self.lut = None
+        self.__rgba = {}
+
+    def __invalidate(self):
+        self.__rgba = {}
+
+    def setData(self, data):
+        self.data = data
+        self.pyramid = ImagePyramid(data) if data is not None else None
+        self.__invalidate()
+
+    def setLevels(self, levels):
+        if self.levels is not None and levels is not None and tuple(levels) == tuple(self.levels):
+            return
+        self.levels = levels
+        self.__invalidate()
+
+    def setLookupTable(self, lut):
+        self.lut = lut
+        self.__invalidate()
+
+    @traced(cat='render')
+    def rgba(self, level=0):
+        """the RGBA (ny, nx, 4) uint8 image of a pyramid level, NaN transparent"""
+        if self.data is None:
+            return None
+        level = self.pyramid.level_for(2 ** level)
+        if level not in self.__rgba:
+            levels = self.levels
+            if levels is None:
+                levels = (np.nanmin(self.data), np.nanmax(self.data))
+            data = self.pyramid.level(level)
+            self.__rgba[level], _ = pg.functions.makeARGB(data, lut=self.lut, levels=levels, useRGBA=True)
+        return self.__rgba[level]
+
+    def rect(self, level=0):
+        """the data coordinates covered by the RGBA image of a level"""
+        rgba = self.rgba(level)
+        k = 2 ** self.pyramid.level_for(2 ** level)
+        return 0, 0, rgba.shape[1] * k, rgba.shape[0] * k
+
+    def level_for(self, factor):
+        return self.pyramid.level_for(factor) if self.pyramid is not None else 0
+
+    def thumbnail(self, size):
+        """the smallest pyramid level with at least `size` pixels per side (or the full image)"""
+        if self.data is None:
+            return None, None
+        level = self.level_for(max(self.data.shape) / size)
+        return self.rgba(level), self.rect(level)
+
+    def crop(self, x1, x2, y1, y2):
+        """the RGBA pixels [y1:y2, x1:x2], clipped to the image, and the clipped bounds"""
+        rgba = self.rgba()
+        ny, nx = rgba.shape[:2]
+        x1, x2 = max(int(x1), 0), min(int(x2), nx)
+        y1, y2 = max(int(y1), 0), min(int(y2), ny)
+        if x1 >= x2 or y1 >= y2:
+            return None, None
+        return rgba[y1:y2, x1:x2], (x1, y1, x2 - x1, y2 - y1)
@@ -1,13 +1,15 @@
 import warnings
 
-import astropy.wcs.utils as wcsutils
 import pyqtgraph as pg
 from PyQt5 import QtCore
 from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QGridLayout, QLineEdit, QLabel, QCheckBox, \
-    QGraphicsRectItem
-from astropy import visualization as vis
+    QGraphicsRectItem, QApplication
 
+from .ChannelStats import sampled_zscale
 from .CustomWidgets import FloatLineEdit, ViewBoxKey
+from .FastWcs import SkyGrid, sexagesimal
+from .ImageRender import SharedRenderer
+from .Tracing import span, traced
 
 warnings.filterwarnings("ignore")
 
@@ -30,8 +32,15 @@ class MyQSimpleImage(pg.GraphicsLayoutWidget):
         self.vb.addItem(self.img)
         self.addItem(self.vb)
 
-    def setImage(self, ima):
-        self.img.setImage(ima)
+    def setImage(self, ima, rect=None):
+        # RGBA images from SharedRenderer are shown as they are (no levels, no LUT)
+        self.img.setImage(ima, autoLevels=False)
+        if rect is not None:
+            self.img.setRect(QtCore.QRectF(*rect))
+
+    def paintEvent(self, ev):
+        with span(type(self).__name__ + '.paint', cat='paint'):
+            super().paintEvent(ev)
 
 
 class MainImage(MyQSimpleImage):
@@ -58,15 +67,31 @@ class MagnifierImage(MyQSimpleImage):
         self.sizeZoom = 3
 
         self.markerColor = 'r'
+        self.renderer = None
+        self.pos = None
 
     def updatePos(self, x, y):
+        self.pos = (x, y)
         self.vb.setRange(
             xRange=(x - self.sizeZoom, x + self.sizeZoom),
             yRange=(y - self.sizeZoom, y + self.sizeZoom),
             padding=0
         )
-
-        self.img.setVisible(True)
+        self.refresh()
+
+    def refresh(self):
+        # only the pixels around the position are shown
+        if self.renderer is None or self.renderer.data is None:
+            return
+        if self.pos is None:
+            ny, nx = self.renderer.data.shape
+            self.pos = (nx / 2, ny / 2)
+        x, y = self.pos
+        d = self.sizeZoom + 2
+        crop, rect = self.renderer.crop(x - d, x + d + 1, y - d, y + d + 1)
+        self.img.setVisible(crop is not None)
+        if crop is not None:
+            self.setImage(crop, rect)
 
     @property
     def markerColor(self):
@@ -133,14 +158,29 @@ class ImageViewer(QWidget):
         super(ImageViewer, self).__init__()
         self.ima = None
         self.wcs = None
+        self.skyGrid = None
+        # precomputed display levels of the current image (None: zscale)
+        self.levels = None
 
         self.xCur = 0
         self.yCur = 0
 
+        # mouse moves are processed at most once per display frame
+        self.__mousePos = None
+        self.mouseTimer = QtCore.QTimer(self)
+        self.mouseTimer.setSingleShot(True)
+        self.mouseTimer.timeout.connect(self.flushMouse)
+
         self.wid_magnifier = MagnifierImage(parent=self)
         self.wid_image = MainImage(parent=self)
         self.wid_panner = PannerImage(parent=self)
 
+        # the image is mapped to RGBA once and shared by the three views
+        self.renderer = SharedRenderer()
+        self.wid_magnifier.renderer = self.renderer
+        # pyramid level displayed in the main view
+        self.mainLevel = 0
+
         self.le_x = QLineEdit()
         self.le_y = QLineEdit()
         self.le_ra = QLineEdit()
@@ -216,14 +256,36 @@ class ImageViewer(QWidget):
 
         self.wid_panner.setPanRect(xmin, ymin, dx, dy)
 
+        level = self.mainViewLevel()
+        if level != self.mainLevel:
+            self.mainLevel = level
+            self.renderMain()
+
+    def mainViewLevel(self):
+        """the pyramid level matching the zoom of the main view"""
+        try:
+            px, py = self.wid_image.vb.viewPixelSize()
+        except Exception:
+            return 0
+        return self.renderer.level_for(min(px, py))
+
+    def renderMain(self):
+        rgba = self.renderer.rgba(self.mainLevel)
+        if rgba is not None:
+            self.wid_image.setImage(rgba, rect=self.renderer.rect(self.mainLevel))
+
     def autoscaleToggled(self, state):
         self.le_zmin.setEnabled(not state)
         self.le_zmax.setEnabled(not state)
         if state:
             self.zautoscale()
 
+    @traced(cat='zscale')
     def zautoscale(self):
-        zmin, zmax = vis.ZScaleInterval().get_limits(self.ima)
+        if self.levels is not None:
+            zmin, zmax = self.levels
+        else:
+            zmin, zmax = sampled_zscale(self.ima)
         self.le_zmin.setText(str(zmin))
         self.le_zmax.setText(str(zmax))
         self.zvaluesChanged()
@@ -231,39 +293,67 @@ class ImageViewer(QWidget):
     def zvaluesChanged(self):
         zmin = float(self.le_zmin.text())
         zmax = float(self.le_zmax.text())
-        for w in [self.wid_image, self.wid_magnifier, self.wid_panner]:
-            w.img.setLevels((zmin, zmax))
+        self.renderer.setLevels((zmin, zmax))
+        self.renderImages()
+
+    @traced(cat='render')
+    def renderImages(self):
+        if self.renderer.data is None:
+            return
+        self.mainLevel = self.mainViewLevel()
+        self.renderMain()
+        self.wid_panner.setImage(*self.renderer.thumbnail(max(self.wid_panner.width(), self.wid_panner.height())))
+        self.wid_magnifier.refresh()
 
-    def mouseMoved(self, pos):
+    @property
+    def wcs(self):
+        return self._wcs
+
+    @wcs.setter
+    def wcs(self, w):
+        self._wcs = w
+        self.skyGrid = None
+
+    def frameInterval(self):
+        screen = QApplication.primaryScreen()
+        rate = screen.refreshRate() if screen is not None else 0
+        return int(1000 / rate) if rate > 0 else 16
 
-        x = self.wid_image.img.mapFromScene(pos).x()
-        y = self.wid_image.img.mapFromScene(pos).y()
+    def mouseMoved(self, pos):
+        # keep only the latest position, processed at the next frame
+        self.__mousePos = pos
+        if not self.mouseTimer.isActive():
+            self.mouseTimer.start(self.frameInterval())
+
+    @traced
+    def flushMouse(self):
+        self.mouseTimer.stop()
+        if self.__mousePos is None:
+            return
+        pos = self.__mousePos
+        self.__mousePos = None
+
+        p = self.wid_image.img.mapFromScene(pos)
+        x = p.x()
+        y = p.y()
         self.wid_magnifier.updatePos(x, y)
 
-        # #        set min max levels to the values around mouse pos
-        #         _x=int(x)
-        #         _y=int(y)
-        #         d=self.wid_magnifier.sizeZoom
-        #         _ima=self.ima[_y-d:_y+d,_x-d:_x+d]
-        #         #z1,z2=self.wid_image.img.levels
-        #         z1=_ima.min()
-        #         z2=_ima.max()
-        #         self.wid_magnifier.img.setLevels([z1,z2])
-        #         self.wid_image.img.setLevels([z1,z2])
-
-        if ((x >= 0) & (x <= self.ima.shape[1]) &
-                (y >= 0) & (y <= self.ima.shape[0])):
+        ny, nx = self.ima.shape
+        if (x >= 0) & (x < nx) & (y >= 0) & (y < ny):
             self.xCur = int(x)
             self.yCur = int(y)
             self.le_x.setText("%.1f" % x)
             self.le_y.setText("%.1f" % y)
             self.le_v.setText("%s" % self.ima[self.yCur, self.xCur])
             if self.wcs is not None:
-                coo = wcsutils.pixel_to_skycoord(x, y, wcs=self.wcs)
-                self.le_ra.setText(coo.ra.to_string(unit='hourangle', sep=":", precision=4))
-                self.le_de.setText(coo.dec.to_string(unit='deg', sep=":", precision=4, alwayssign=True))
-
-    def updateImage(self, ima, autorange=False):
+                with span('ImageViewer.radec', cat='wcs'):
+                    if self.skyGrid is None or self.skyGrid.shape != self.ima.shape:
+                        self.skyGrid = SkyGrid(self.wcs, self.ima.shape)
+                    ra, dec = self.skyGrid.radec(x, y)
+                self.le_ra.setText(sexagesimal(ra / 15, precision=4))
+                self.le_de.setText(sexagesimal(dec, precision=4, alwayssign=True))
+
+    def updateImage(self, ima, autorange=False, levels=None):
         # if this is the 1st time the Image is loaded
         # then activate some signals
         if self.ima is None:
@@ -273,18 +363,21 @@ class ImageViewer(QWidget):
         self.cb_autoscale.setEnabled(True)
 
         self.ima = ima
-        for i in (self.wid_image, self.wid_panner, self.wid_magnifier):
-            i.setImage(ima)
-            if (i != self.wid_image) | (autorange == True):
-                i.vb.autoRange(padding=0)
+        self.levels = levels
+        self.renderer.setData(ima)
 
+        # both end with renderImages()
         if self.cb_autoscale.checkState():
             self.zautoscale()
         else:
             self.zvaluesChanged()
 
+        self.wid_panner.vb.autoRange(padding=0)
+        if autorange:
+            self.wid_image.vb.autoRange(padding=0)
+
     def setColorMap(self, colormap):
         cm = pg.colormap.get(colormap)
         lut = cm.getLookupTable(nPts=256)
-        for i in (self.wid_image, self.wid_panner, self.wid_magnifier):
-            i.img.setLookupTable(lut)
+        self.renderer.setLookupTable(lut)
+        self.renderImages()
@@ -0,0 +1,224 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import astropy.units as u
+import numpy as np
+
+from .RestFrameRefLines import LineList
+
+vel_c = 299792.458
+
+# spaxels fitted together in one vectorized Levenberg-Marquardt run
+BATCH = 4096
+
+
+def select_lines(names=('Ha', '[NII]'), lmin=6500., lmax=6600., ifile=None):
+    """rest frame (air) wavelengths of the lines `names` within [lmin, lmax] of the line list"""
+    return LineList.read(ifile).query(lmin, lmax, names=names)['air']
+
+
+class GaussianLineModel:
+    """
+    Continuum plus Gaussian lines sharing velocity and dispersion:
+
+        f(lam) = c + sum_j A_j exp(-(lam - mu_j)^2 / (2 s_j^2))
+        mu_j = lam_j (1 + z) (1 + v / c),  s_j = lam_j (1 + z) sigma / c
+
+    with parameters (c, v, sigma, A_1..A_n), v and sigma in km/s.
+    """
+
+    def __init__(self, lam, rest, z):
+        self.lam = np.asarray(lam, dtype=float)
+        self.obs = np.asarray(rest, dtype=float) * (1 + z)
+        self.nlines = len(rest)
+        self.npar = 3 + self.nlines
+
+    def evaluate(self, p, jacobian=False):
+        """model (N, L) for the parameters p (N, npar) and optionally its jacobian (N, L, npar)"""
+        c, v, s, A = p[:, 0], p[:, 1], p[:, 2], p[:, 3:]
+        k = self.obs[None, :] / vel_c
+        mu = self.obs[None, :] + k * v[:, None]
+        sig = k * s[:, None]
+        d = self.lam[None, None, :] - mu[:, :, None]
+        g = np.exp(-0.5 * (d / sig[:, :, None]) ** 2)
+        Ag = A[:, :, None] * g
+        model = c[:, None] + Ag.sum(axis=1)
+        if not jacobian:
+            return model
+        J = np.empty(model.shape + (self.npar,))
+        J[..., 0] = 1
+        J[..., 1] = (Ag * d / sig[:, :, None] ** 2 * k[:, :, None]).sum(axis=1)
+        J[..., 2] = (Ag * d ** 2 / sig[:, :, None] ** 3 * k[:, :, None]).sum(axis=1)
+        J[..., 3:] = g.transpose(0, 2, 1)
+        return model, J
+
+    def sample(self, f, pos):
+        """linear interpolation of the spectra f (N, L) at the wavelengths pos (N, n)"""
+        i = np.clip(np.searchsorted(self.lam, pos), 1, len(self.lam) - 1)
+        l0, l1 = self.lam[i - 1], self.lam[i]
+        t = np.clip((pos - l0) / (l1 - l0), 0, 1)
+        return (1 - t) * np.take_along_axis(f, i - 1, axis=1) + t * np.take_along_axis(f, i, axis=1)
+
+    def initial_guess(self, y, w):
+        """moment based starting values for the spectra y (N, L) with weights w"""
+        N = len(y)
+        yy = np.where(w > 0, y, np.nan)
+        nedge = max(2, len(self.lam) // 10)
+        with np.errstate(all='ignore'):
+            c = np.nanmedian(np.concatenate([yy[:, :nedge], yy[:, -nedge:]], axis=1), axis=1)
+        c = np.where(np.isfinite(c), c, 0)
+        f = np.clip(np.nan_to_num(yy - c[:, None]), 0, None)
+        v = np.zeros(N)
+        s = np.full(N, 50.)
+        # velocity and dispersion from the moments of the strongest line
+        amp = self.sample(f, np.broadcast_to(self.obs, (N, self.nlines)))
+        j = np.argmax(amp.sum(axis=0)) if N else 0
+        win = np.abs(self.lam - self.obs[j]) < self.obs[j] * 300 / vel_c
+        if win.sum() >= 3:
+            fw = f[:, win]
+            tot = fw.sum(axis=1)
+            ok = tot > 0
+            lam = self.lam[win]
+            m1 = np.where(ok, (fw * lam).sum(axis=1) / np.where(ok, tot, 1), self.obs[j])
+            m2 = np.where(ok, (fw * (lam - m1[:, None]) ** 2).sum(axis=1) / np.where(ok, tot, 1), 0)
+            v = np.clip(vel_c * (m1 / self.obs[j] - 1), -300, 300)
+            s = np.clip(vel_c * np.sqrt(m2) / self.obs[j], 20, 300)
+        A = self.sample(f, self.obs[None, :] * (1 + v[:, None] / vel_c))
+        return np.column_stack([c, v, s, A])
+
+
+def levenberg_marquardt(model, y, w, p0, niter=40, smin=1., smax=1000., vmax=1000.):
+    """
+    Vectorized Levenberg-Marquardt fit of N spectra at once.
+    y, w: (N, L) data and weights (0 for NaN); p0: (N, npar) starting values.
+    Returns the parameters and the chi2 of each spectrum.
+    """
+    y = np.where(w > 0, y, 0)
+    p = p0.copy()
+    lm = np.full(len(p), 1e-3)
+    res = model.evaluate(p) - y
+    chi2 = (w * res ** 2).sum(axis=1)
+    eye = np.eye(model.npar)
+    for it in range(niter):
+        f, J = model.evaluate(p, jacobian=True)
+        JtW = J.transpose(0, 2, 1) * w[:, None, :]
+        H = JtW @ J
+        g = (JtW @ (y - f)[:, :, None])[..., 0]
+        Hd = H + lm[:, None, None] * H * eye
+        Hd += 1e-12 * eye
+        try:
+            dp = np.linalg.solve(Hd, g[:, :, None])[..., 0]
+        except np.linalg.LinAlgError:
+            dp = np.stack([np.linalg.lstsq(h, gi, rcond=None)[0] for h, gi in zip(Hd, g)])
+        pn = p + dp
+        pn[:, 1] = np.clip(pn[:, 1], -vmax, vmax)
+        pn[:, 2] = np.clip(pn[:, 2], smin, smax)
+        resn = model.evaluate(pn) - y
+        chi2n = (w * resn ** 2).sum(axis=1)
+        better = np.isfinite(chi2n) & (chi2n < chi2)
+        p[better] = pn[better]
+        lm = np.where(better, lm / 10, lm * 10)
+        rel = np.where(better, (chi2 - chi2n) / np.maximum(chi2, 1e-30), 0)
+        chi2 = np.where(better, chi2n, chi2)
+        if np.all((rel < 1e-6) | (lm > 1e8)):
+            break
+    return p, chi2
+
+
+def fit_spectra(lam, spectra, rest, z, weights=None, niter=40):
+    """
+    fit the (L, N) spectra sampled at lam; returns the (N, npar) parameters
+    (c, v, sigma, A_1..A_n) and the chi2
+    """
+    model = GaussianLineModel(lam, rest, z)
+    y = np.asarray(spectra, dtype=float).T
+    w = np.isfinite(y).astype(float)
+    if weights is not None:
+        w = w * np.nan_to_num(np.asarray(weights, dtype=float).T)
+    y = np.nan_to_num(y)
+    p0 = model.initial_guess(y, w)
+    # lines narrower than half a channel are not resolved
+    smin = 0.5 * vel_c * np.median(np.diff(model.lam)) / model.obs.mean()
+    return levenberg_marquardt(model, y, w, p0, niter=niter, smin=smin)
+
+
+# --- process pool ---------------------------------------------------------
+
+_data = None
+
+
+def _open(ifile, extn):
+    global _data
+    from astropy.io import fits
+    _data = fits.open(ifile, memmap=True)[extn].data
+
+
+def _fit_rows(args):
+    y1, y2, i1, i2, lam, rest, z, data = args
+    if data is None:
+        data = _data
+    block = np.asarray(data[i1:i2, y1:y2], dtype=float)
+    L, ny, nx = block.shape
+    spectra = block.reshape(L, -1)
+    good = np.isfinite(spectra).sum(axis=0) > L // 2
+    npar = 3 + len(rest)
+    p = np.full((ny * nx, npar), np.nan)
+    chi2 = np.full(ny * nx, np.nan)
+    idx = np.flatnonzero(good)
+    for k in range(0, len(idx), BATCH):
+        sel = idx[k:k + BATCH]
+        p[sel], chi2[sel] = fit_spectra(lam, spectra[:, sel], rest, z)
+    return y1, y2, p.reshape(ny, nx, npar), chi2.reshape(ny, nx)
+
+
+def fit_cube(cube, rest, z, halfwidth=1000., workers=None, progress=None):
+    """
+    Fit Gaussian lines of rest wavelengths `rest` (sharing velocity and
+    dispersion, plus a constant continuum) at every spaxel of a DataCube,
+    within `halfwidth` km/s of the outer lines at redshift z.
+
+    The cube is split in blocks of rows fitted in a pool of processes
+    (each one memory-mapping the FITS file), or of threads for cubes not
+    read from a file; progress(fraction) is called as blocks complete.
+
+    Returns a dict of maps: 'flux' (nlines, ny, nx), 'velocity' and
+    'sigma' (km/s, velocity relative to z), 'continuum' and 'chi2'.
+    """
+    rest = np.asarray(rest, dtype=float)
+    axis = cube.spectral_axis
+    lo = rest.min() * (1 + z) * (1 - halfwidth / vel_c)
+    hi = rest.max() * (1 + z) * (1 + halfwidth / vel_c)
+    i1, i2 = sorted([axis.closest(lo, unit=u.AA), axis.closest(hi, unit=u.AA)])
+    i2 += 1
+    lam = axis.to(u.AA)[i1:i2]
+
+    nz, ny, nx = cube.shape
+    workers = workers or os.cpu_count()
+    step = max(1, min(16, ny // (4 * workers) or 1))
+
+    if cube.filename is not None:
+        # spawned, not forked: the parent runs threads (Qt, query pool, channel prefetch)
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_open, initargs=(cube.filename, cube.extn))
+        data = None
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+        data = cube.data
+
+    npar = 3 + len(rest)
+    p = np.full((ny, nx, npar), np.nan)
+    chi2 = np.full((ny, nx), np.nan)
+    with pool:
+        futures = [pool.submit(_fit_rows, (y1, min(y1 + step, ny), i1, i2, lam, rest, z, data))
+                   for y1 in range(0, ny, step)]
+        for n, f in enumerate(as_completed(futures)):
+            y1, y2, pp, cc = f.result()
+            p[y1:y2] = pp
+            chi2[y1:y2] = cc
+            if progress is not None:
+                progress((n + 1) / len(futures))
+
+    sig = rest[:, None, None] * (1 + z) * p[..., 2][None] / vel_c
+    flux = p[..., 3:].transpose(2, 0, 1) * sig * np.sqrt(2 * np.pi)
+    return dict(flux=flux, velocity=p[..., 1], sigma=p[..., 2], continuum=p[..., 0], chi2=chi2, rest=rest, z=z)
@@ -0,0 +1,59 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .Background import CHUNK_BYTES
+
+vel_c = 299792.458
+
+
+def moment_maps(data, wav, widths, i1, i2, lam_ref, continuum=None, workers=None):
+    """
+    Moment 0, 1 and 2 maps of the channels [i1, i2) of a (nz, ny, nx) cube,
+    computed in one pass over blocks of rows on a pool of threads.
+
+    wav: channel centres
+    widths: width of each of the channels [i1, i2) inside the band (see
+            SpectralAxis.band_weights)
+    lam_ref: reference wavelength of the velocities
+    continuum: optional (ny, nx) flux density subtracted from every channel
+
+    Returns the integrated flux (moment 0), the velocity of the flux
+    weighted mean wavelength (moment 1) and the velocity dispersion
+    (square root of moment 2), both in km/s.
+    """
+    nz, ny, nx = data.shape
+    lam = np.asarray(wav[i1:i2], dtype=float)[:, None, None]
+    # wavelengths relative to lam_ref limit the cancellation in moment 2
+    dlam = lam - lam_ref
+    w = np.asarray(widths, dtype=float)[:, None, None]
+
+    m0 = np.full((ny, nx), np.nan)
+    m1 = np.full((ny, nx), np.nan)
+    m2 = np.full((ny, nx), np.nan)
+
+    step = max(1, CHUNK_BYTES // (max(i2 - i1, 1) * nx * 8))
+
+    def rows(y1):
+        y2 = min(y1 + step, ny)
+        block = np.asarray(data[i1:i2, y1:y2], dtype=float)
+        if continuum is not None:
+            block = block - continuum[None, y1:y2]
+        good = np.isfinite(block)
+        f = np.where(good, block, 0) * w
+        s0 = f.sum(axis=0)
+        s1 = (f * dlam).sum(axis=0)
+        s2 = (f * dlam ** 2).sum(axis=0)
+        valid = good.any(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = s1 / s0
+            var = s2 / s0 - mean ** 2
+        m0[y1:y2] = np.where(valid, s0, np.nan)
+        m1[y1:y2] = np.where(valid, mean, np.nan)
+        m2[y1:y2] = np.where(valid & (var >= 0), np.sqrt(np.abs(var)), np.nan)
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        list(pool.map(rows, range(0, ny, step)))
+
+    return m0, vel_c * m1 / lam_ref, vel_c * m2 / lam_ref
@@ -1,9 +1,10 @@
 import pyqtgraph as pg
 from PyQt5 import QtCore
-from PyQt5.QtWidgets import QHBoxLayout, QLabel, QComboBox, QSpinBox
-from astropy.convolution import convolve, Gaussian2DKernel
+from PyQt5.QtWidgets import QHBoxLayout, QLabel, QComboBox, QSpinBox, QCheckBox
 
 from .ImageViewer import ImageViewer
+from .Smoothing import SmoothingCache
+from .Tracing import span
 
 
 class PositionMarker(QtCore.QObject):
@@ -56,6 +57,8 @@ class PyCubeImageViewerPanel(ImageViewer):
     def __init__(self, colormap='inferno'):
         super().__init__()
         self.ima0 = None
+        self.levels0 = None
+        self.smoother = SmoothingCache()
         self.sb_smooth = QSpinBox()
         self.sb_smooth.setRange(0, 15)
         self.sb_smooth.setSingleStep(1)
@@ -64,6 +67,7 @@ class PyCubeImageViewerPanel(ImageViewer):
         cmaps = ["cividis", "viridis", "inferno", "magma", "plasma"]
         self.cb_cmap.addItems(cmaps)
         self.label_imagemode = QLabel("A")
+        self.cb_cubelevels = QCheckBox("cube levels")
 
         self.cb_cmap.setCurrentText(colormap)
         self.cbCmapChanged()
@@ -79,6 +83,8 @@ class PyCubeImageViewerPanel(ImageViewer):
         topLayout.addWidget(QLabel("cmap"))
         topLayout.addWidget(self.cb_cmap)
         topLayout.addSpacing(20)
+        topLayout.addWidget(self.cb_cubelevels)
+        topLayout.addSpacing(20)
         topLayout.addWidget(self.label_imagemode)
         topLayout.addStretch(1)
 
@@ -114,20 +120,24 @@ class PyCubeImageViewerPanel(ImageViewer):
         self.setColorMap(c)
 
     def updateImaSmo(self):
-        smo = self.sb_smooth.value()
-        if smo > 0:
-            kernel = Gaussian2DKernel(smo)
-            ima = convolve(self.ima0, kernel)
-        else:
-            ima = self.ima0
-        super().updateImage(ima)
-
-    def updateImage(self, ima, autorange=False):
+        # a slot of valueChanged(int): traced with a span, not a decorator
+        with span('PyCubeImageViewerPanel.updateImaSmo'):
+            if self.ima0 is None:
+                # no image yet: the window is interactive before the cube is loaded
+                return
+            smo = self.sb_smooth.value()
+            ima = self.smoother.smooth(self.ima0, smo)
+            # the precomputed levels refer to the unsmoothed image
+            super().updateImage(ima, levels=self.levels0 if smo == 0 else None)
+
+    def updateImage(self, ima, autorange=False, levels=None):
         self.ima0 = ima
+        self.levels0 = levels
         self.updateImaSmo()
 
     def keyPressed(self, ev):
         if ev.key() == QtCore.Qt.Key_Space:
+            self.flushMouse()
             x = self.xCur
             y = self.yCur
             self.posMarker.setPositon(x, y)
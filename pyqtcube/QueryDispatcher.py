@@ -0,0 +1,75 @@
+import os
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5 import QtCore
+from PyQt5.QtWidgets import QApplication
+
+
+class QueryDispatcher(QtCore.QObject):
+    """
+    Runs DataCube queries in a pool of worker threads and delivers the
+    results to the GUI thread.
+
+    Queries are grouped by target (e.g. 'image', 'spectrum'): submitting
+    a new query for a target cancels the previous one if it has not
+    started yet, and drops its result if it has, so only the latest
+    result of each target is ever applied.
+    """
+    sigFinished = QtCore.pyqtSignal(object)
+    sigBusy = QtCore.pyqtSignal(bool)
+
+    def __init__(self, max_workers=None):
+        super().__init__()
+        if max_workers is None:
+            max_workers = min(4, os.cpu_count() or 1)
+        self.__pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pycube-query")
+        self.__pending = {}
+        # emitted from the worker threads, delivered in the GUI thread
+        self.sigFinished.connect(self.__finished, QtCore.Qt.QueuedConnection)
+
+    @property
+    def busy(self):
+        return len(self.__pending) > 0
+
+    def submit(self, target, func, callback, errback=None):
+        old = self.__pending.pop(target, None)
+        if old is not None:
+            old[0].cancel()
+        future = self.__pool.submit(func)
+        self.__pending[target] = (future, callback, errback)
+        if old is None:
+            self.sigBusy.emit(True)
+        future.add_done_callback(self.sigFinished.emit)
+        return future
+
+    def __finished(self, future):
+        for target, (f, callback, errback) in self.__pending.items():
+            if f is future:
+                break
+        else:
+            # superseded by a newer query
+            return
+        del self.__pending[target]
+        if not self.__pending:
+            self.sigBusy.emit(False)
+
+        exc = future.exception()
+        if exc is None:
+            callback(future.result())
+        elif errback is not None:
+            errback(exc)
+        else:
+            traceback.print_exception(type(exc), exc, exc.__traceback__, file=sys.stderr)
+
+    def waitForDone(self):
+        """process events until all the pending results have been applied"""
+        while self.__pending:
+            QApplication.processEvents(QtCore.QEventLoop.AllEvents, 10)
+
+    def shutdown(self):
+        for f, _, _ in self.__pending.values():
+            f.cancel()
+        self.__pending.clear()
+        self.__pool.shutdown(wait=False)
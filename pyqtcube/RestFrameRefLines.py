@@ -1,34 +1,80 @@
-from astropy.io import ascii
-import astropy.units as u
-
 import os
 
+import numpy as np
+
+DEFAULT_LINELIST = os.path.join(os.path.dirname(__file__), 'linelist_vacuum_air.txt')
+
+# one record per line, sorted by air wavelength (Angstrom)
+LINE_DTYPE = np.dtype([('air', 'f8'), ('vacuum', 'f8'), ('label', 'U16'), ('view', '?')])
 
-class SpecLine:
-    def __init__(self, wavelenght: u.Quantity, name: str, flag: bool):
-        self.wavelenght = wavelenght
-        self.name = name
-        self.flag = flag
 
-    def wavelenght_at_z(self, z):
-        return self.rest_wavelenght * (1 + z)
+class LineList:
+    """
+    Rest frame reference lines stored in a NumPy structured array sorted by
+    wavelength, so that the lines in a wavelength range at redshift z are
+    found by binary search.
 
+    Lists are read from the text format of linelist_vacuum_air.txt
+    (air, vacuum, label, view) or from ECSV tables with the columns
+    wavelengt_air, name and flag.
+    """
 
-class SpecLineSet:
-    def from_file(ifile=None):
+    def __init__(self, lines: np.ndarray):
+        lines = np.asarray(lines, dtype=LINE_DTYPE)
+        self.lines = lines[np.argsort(lines['air'], kind='stable')]
+        # contiguous copy of the sort key for the binary searches
+        self.__air = np.ascontiguousarray(self.lines['air'])
+
+    @classmethod
+    def read(cls, ifile=None):
         if ifile is None:
-            ifile = os.path.join(
-                os.path.dirname(__file__),
-                'linelist_air.ecsv')
-        tab = ascii.read(ifile, format='ecsv')
-        r = tab[0]
-        l = [SpecLine(r['wavelengt_air'],
-                      name=r['name'],
-                      flag=r['flag'])
-             for r in tab]
-        return SpecLineSet(l)
-
-    def __init__(self, lines: list[SpecLine]):
-        self.z = 0
-        self.units = "AA"
-        self.lines = lines
+            ifile = DEFAULT_LINELIST
+        if ifile.endswith('.ecsv'):
+            from astropy.table import Table
+            tab = Table.read(ifile, format='ascii.ecsv')
+            lines = np.zeros(len(tab), dtype=LINE_DTYPE)
+            lines['air'] = tab['wavelengt_air']
+            lines['vacuum'] = np.nan
+            lines['label'] = tab['name']
+            lines['view'] = tab['flag']
+            return cls(lines)
+        tab = np.loadtxt(ifile, comments='#', ndmin=1,
+                         dtype=[('air', 'f8'), ('vacuum', 'f8'), ('label', 'U16'), ('view', 'i4')])
+        lines = np.zeros(len(tab), dtype=LINE_DTYPE)
+        for k in ['air', 'vacuum', 'label']:
+            lines[k] = tab[k]
+        lines['view'] = tab['view'] != 0
+        return cls(lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, item):
+        return self.lines[item]
+
+    @property
+    def air(self):
+        return self.__air
+
+    @property
+    def labels(self):
+        return self.lines['label']
+
+    @property
+    def view(self):
+        return self.lines['view']
+
+    def index_range(self, l1, l2, z=0.):
+        """indices [i1, i2) of the lines observed within [l1, l2] at redshift z"""
+        return (int(np.searchsorted(self.air, l1 / (1 + z))),
+                int(np.searchsorted(self.air, l2 / (1 + z), side='right')))
+
+    def query(self, l1, l2, z=0., names=None, visible=False):
+        """the records of the lines observed within [l1, l2] at redshift z"""
+        i1, i2 = self.index_range(l1, l2, z)
+        out = self.lines[i1:i2]
+        if names is not None:
+            out = out[np.isin(out['label'], list(names))]
+        if visible:
+            out = out[out['view']]
+        return out
@@ -0,0 +1,176 @@
+import weakref
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+
+from .Tracing import traced
+
+# above this kernel length the FFT is faster than the separable passes
+FFT_MIN_KERNEL = 25
+
+
+@lru_cache(maxsize=64)
+def gaussian_kernel_1d(sigma):
+    """normalized Gaussian sampled at the pixel centres, as astropy's Gaussian1DKernel(sigma)"""
+    n = int(np.ceil(8 * sigma))
+    if n % 2 == 0:
+        n += 1
+    h = n // 2
+    x = np.arange(-h, h + 1, dtype=float)
+    k = np.exp(-0.5 * (x / sigma) ** 2)
+    k /= k.sum()
+    k.setflags(write=False)
+    return k
+
+
+def convolve1d(a, k, axis, method='auto'):
+    """convolution of `a` along `axis` with the odd-sized kernel k, zero outside"""
+    if method == 'auto':
+        method = 'fft' if len(k) >= FFT_MIN_KERNEL else 'direct'
+    h = len(k) // 2
+    a = np.moveaxis(a, axis, -1)
+    n = a.shape[-1]
+    pad = np.zeros(a.shape[:-1] + (n + 2 * h,))
+    pad[..., h:h + n] = a
+    if method == 'fft':
+        out = np.fft.irfft(np.fft.rfft(pad, axis=-1) * _fft_kernel_1d(tuple(k), n + 2 * h), n + 2 * h, axis=-1)
+        out = out[..., h:h + n]
+    else:
+        out = np.zeros(a.shape)
+        for j, kj in enumerate(k[::-1]):
+            out += kj * pad[..., j:j + n]
+    return np.moveaxis(out, -1, axis)
+
+
+@lru_cache(maxsize=16)
+def _fft_kernel_1d(k, n):
+    h = len(k) // 2
+    k1 = np.zeros(n)
+    k1[np.arange(-h, h + 1) % n] = k
+    return np.fft.rfft(k1)
+
+
+@lru_cache(maxsize=16)
+def _fft_kernel(sigma, shape):
+    k = gaussian_kernel_1d(sigma)
+    h = len(k) // 2
+    k2 = np.zeros(shape)
+    ny, nx = shape
+    # kernel centred on the origin, wrapped around
+    idx = np.arange(-h, h + 1)
+    k2[np.ix_(idx % ny, idx % nx)] = np.outer(k, k)
+    return np.fft.rfft2(k2)
+
+
+def convolve2d_gaussian(a, sigma, method='auto'):
+    """convolution of the 2D array `a` with a Gaussian of width sigma, zero outside"""
+    k = gaussian_kernel_1d(sigma)
+    if method == 'auto':
+        method = 'fft' if len(k) >= FFT_MIN_KERNEL else 'separable'
+    if method == 'separable':
+        return convolve1d(convolve1d(a, k, 0, 'direct'), k, 1, 'direct')
+
+    h = len(k) // 2
+    ny, nx = a.shape
+    shape = (ny + 2 * h, nx + 2 * h)
+    pad = np.zeros(shape)
+    pad[h:h + ny, h:h + nx] = a
+    out = np.fft.irfft2(np.fft.rfft2(pad) * _fft_kernel(sigma, shape), s=shape)
+    return out[h:h + ny, h:h + nx]
+
+
+@traced(cat='smoothing')
+def gaussian_smooth(ima, sigma, method='auto'):
+    """
+    Gaussian smoothing of an image with the semantics of
+    astropy.convolution.convolve(ima, Gaussian2DKernel(sigma)):
+    zero padding at the edges and NaN values interpolated from the
+    surrounding valid pixels.
+    """
+    ima = np.asarray(ima, dtype=float)
+    bad = ~np.isfinite(ima)
+    num = convolve2d_gaussian(np.where(bad, 0, ima), sigma, method=method)
+    if not bad.any():
+        return num
+    den = 1 - convolve2d_gaussian(bad.astype(float), sigma, method=method)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(den > 1e-8, num / den, np.nan)
+
+
+@traced(cat='smoothing')
+def gaussian_smooth_axis(a, sigma, axis=0, method='auto'):
+    """
+    Gaussian smoothing along one axis of `a` (e.g. the spectral axis of a
+    block of spectra) with the semantics of astropy's
+    convolve(spec, Gaussian1DKernel(sigma)) applied to every 1-D slice
+    """
+    a = np.asarray(a, dtype=float)
+    k = gaussian_kernel_1d(sigma)
+    bad = ~np.isfinite(a)
+    num = convolve1d(np.where(bad, 0, a), k, axis, method=method)
+    if not bad.any():
+        return num
+    den = 1 - convolve1d(bad.astype(float), k, axis, method=method)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(den > 1e-8, num / den, np.nan)
+
+
+@traced(cat='smoothing')
+def gaussian_smooth_axis_variance(var, sigma, axis=0, method='auto'):
+    """
+    variance of gaussian_smooth_axis of data with independent errors of
+    variance `var` (NaN where the data are not valid)
+    """
+    var = np.asarray(var, dtype=float)
+    k = gaussian_kernel_1d(sigma)
+    bad = ~np.isfinite(var)
+    num = convolve1d(np.where(bad, 0, var), k * k, axis, method=method)
+    if not bad.any():
+        return num
+    den = 1 - convolve1d(bad.astype(float), k, axis, method=method)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(den > 1e-8, num / den ** 2, np.nan)
+
+
+class SmoothingCache:
+    """
+    Smoothed images cached per (source image, sigma).
+
+    Source images are identified by object: revisiting a channel served by
+    the channel cache, or toggling sigma back and forth, is free.
+    """
+
+    def __init__(self, max_bytes=128 * 2 ** 20, method='auto'):
+        self.max_bytes = max_bytes
+        self.method = method
+        self.nbytes = 0
+        self.__cache = OrderedDict()
+
+    def clear(self):
+        self.__cache.clear()
+        self.nbytes = 0
+
+    def smooth(self, ima, sigma):
+        if sigma <= 0:
+            return ima
+        key = (id(ima), sigma)
+        item = self.__cache.get(key)
+        if item is not None and item[0]() is ima:
+            self.__cache.move_to_end(key)
+            return item[1]
+
+        out = gaussian_smooth(ima, sigma, method=self.method)
+        out.setflags(write=False)
+        try:
+            ref = weakref.ref(ima)
+        except TypeError:
+            return out
+        if item is not None:
+            self.nbytes -= item[1].nbytes
+        self.__cache[key] = (ref, out)
+        self.nbytes += out.nbytes
+        while self.nbytes > self.max_bytes and self.__cache:
+            _, (_, old) = self.__cache.popitem(last=False)
+            self.nbytes -= old.nbytes
+        return out
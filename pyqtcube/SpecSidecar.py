@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+
+from .Background import CHUNK_BYTES, BackgroundBuild
+
+
+class SpectrumSidecar(BackgroundBuild):
+    """
+    A spectrum-contiguous copy of a (nz, ny, nx) cube stored as (ny, nx, nz).
+
+    In the native FITS layout a spectrum is a strided gather of one value
+    per channel; in the sidecar it is a single contiguous block.
+    The copy is kept in memory (path=None) or in a .npy file that is
+    reused as long as it is newer than the source file (see
+    BackgroundBuild for the files that cannot be written).
+    """
+
+    def __init__(self, data, path=None, source=None):
+        super().__init__()
+        self.data = data
+        self.path = path
+        self.source = source
+        self.__spec = None
+
+    @staticmethod
+    def default_path(ifile, extn=1, kind='spec'):
+        """kind: 'spec' for the data, 'var' for the variance"""
+        return "%s.%d.%s.npy" % (ifile, extn, kind)
+
+    @property
+    def shape(self):
+        nz, ny, nx = self.data.shape
+        return ny, nx, nz
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.data.dtype.itemsize
+
+    def __cached(self):
+        if self.path is None or not os.path.isfile(self.path):
+            return None
+        if self.source is not None and os.path.getmtime(self.path) < os.path.getmtime(self.source):
+            return None
+        try:
+            spec = np.load(self.path, mmap_mode='r')
+        except ValueError:
+            return None
+        if spec.shape != self.shape:
+            return None
+        return spec
+
+    def __transpose(self, stored):
+        nz, ny, nx = self.data.shape
+        dtype = self.data.dtype.newbyteorder('=')
+        path = self.path
+        if not stored:
+            spec = np.empty(self.shape, dtype=dtype)
+        else:
+            spec = np.lib.format.open_memmap(path + ".tmp", mode='w+', dtype=dtype, shape=self.shape)
+
+        # blocks of full rows: contiguous in both layouts
+        step = max(1, CHUNK_BYTES // (nz * nx * dtype.itemsize))
+        for y1 in range(0, ny, step):
+            y2 = min(y1 + step, ny)
+            spec[y1:y2] = np.asarray(self.data[:, y1:y2, :]).transpose(1, 2, 0)
+            self.progress = y2 / ny
+
+        if not stored:
+            return spec
+        spec.flush()
+        del spec
+        os.replace(path + ".tmp", path)
+        return np.load(path, mmap_mode='r')
+
+    def build(self):
+        spec = self.__cached()
+        if spec is None:
+            files = [self.path] if self.path is not None else None
+            spec = self._build_stored(self.__transpose, files, self.nbytes)
+
+        self.__spec = spec
+        self.progress = 1.
+        self.ready = True
+        return self
+
+    def spectrum(self, x, y):
+        return np.array(self.__spec[y, x])
+
+    def block(self, x1, x2, y1, y2):
+        """the (nz, y2-y1, x2-x1) sub cube, read from the sidecar"""
+        return np.array(self.__spec[y1:y2, x1:x2]).transpose(2, 0, 1)
@@ -1,14 +1,16 @@
-import os
 import warnings
 
-import astropy.units as u
 import numpy as np
 import pyqtgraph as pg
-from PyQt5 import QtCore
-from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QGridLayout, QLabel, QCheckBox, QSpinBox
-from astropy.convolution import convolve, Gaussian1DKernel
+from PyQt5 import QtCore, QtGui
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QLabel, QSpinBox, QTableView, QAbstractItemView, \
+    QCheckBox
 
 from .CustomWidgets import PlotItemKey, AutoScaleController
+from .Decimation import DecimatedCurveItem
+from .RestFrameRefLines import LineList, DEFAULT_LINELIST
+from .Smoothing import gaussian_smooth_axis, gaussian_smooth_axis_variance
+from .Tracing import traced
 
 warnings.filterwarnings("ignore")
 
@@ -18,64 +20,242 @@ pg.setConfigOptions(foreground='k')
 pg.setConfigOptions(background='w')
 
 
-class InfiniteZLine(pg.InfiniteLine):
-    def __init__(self, pos=None, lam0=None, lab="", flag=True):
-        pen = pg.mkPen((0, 0, 0, 50), width=1)
-        super().__init__(pos=pos, angle=90, movable=True, pen=pen, hoverPen='b')
-        self.lam0 = lam0
-        self.lab = lab
-        self.flag = bool(flag)
-        self.textItem = pg.TextItem(lab, angle=90, color='k', anchor=(0, 0.5))
-        self.textItem.setPos(pos, 0)
-        self.setVisible(flag)
-        self.textItem.setVisible(flag)
+class RefLinesItem(pg.GraphicsObject):
+    """
+    All the reference lines of a ZLineController drawn as one item.
 
-    def setVisible(self, b: bool):
-        super().setVisible(b)
-        self.textItem.setVisible(b)
-        self.flag = b
+    Lines are laid out at their rest frame wavelength and the item is
+    scaled by (1 + z), so a change of redshift is a single transform
+    update.  Only the lines within the visible range are drawn, as one
+    path; a line is dragged to change the redshift.
+    """
+    pen = pg.mkPen((0, 0, 0, 50), width=1)
+    hoverPen = pg.mkPen('b', width=1)
+    # pick distance for hover and drag (screen pixels)
+    pickPixels = 4
 
-
-class LineControllerWidget(QWidget):
-    def __init__(self, line: InfiniteZLine):
+    def __init__(self, controller):
+        super().__init__()
+        self.controller = controller
+        self.hoverIndex = None
+        self.dragIndex = None
+        self.__path = None
+        self.__pathKey = None
+        self.setAcceptHoverEvents(True)
+
+    def invalidate(self):
+        self.__pathKey = None
+        self.update()
+
+    def dataBounds(self, axis, frac=1.0, orthoRange=None):
+        # as pg.InfiniteLine: no x bounds, y=0 included in the auto range
+        return None if axis == 0 else (0, 0)
+
+    def viewRangeChanged(self):
+        self.prepareGeometryChange()
+        self.update()
+
+    def viewTransformChanged(self):
+        self.prepareGeometryChange()
+        self.update()
+
+    def boundingRect(self):
+        r = self.viewRect()
+        return QtCore.QRectF() if r is None else r.normalized()
+
+    def visibleRange(self, rect):
+        """indices [i1, i2) of the lines within the x range of rect (item coordinates)"""
+        return self.controller.lines.index_range(rect.left(), rect.right())
+
+    def paint(self, p, *args):
+        rect = self.boundingRect()
+        if rect.isEmpty():
+            return
+        i1, i2 = self.visibleRange(rect)
+        key = (i1, i2, rect.top(), rect.bottom(), self.controller.version)
+        if key != self.__pathKey:
+            c = self.controller
+            x = c.lam0[i1:i2][c.flags[i1:i2]]
+            y = np.tile([rect.top(), rect.bottom()], len(x))
+            self.__path = pg.arrayToQPath(np.repeat(x, 2), y, connect='pairs')
+            self.__pathKey = key
+        # vertical lines do not need antialiasing
+        p.setRenderHint(QtGui.QPainter.Antialiasing, False)
+        p.setPen(self.pen)
+        p.drawPath(self.__path)
+        i = self.hoverIndex if self.dragIndex is None else self.dragIndex
+        if i is not None:
+            p.setPen(self.hoverPen)
+            x = self.controller.lam0[i]
+            p.drawLine(QtCore.QLineF(x, rect.top(), x, rect.bottom()))
+
+    def pick(self, pos):
+        """the index of the visible line within pickPixels of pos (item coordinates), or None"""
+        c = self.controller
+        px = self.pixelWidth()
+        if not px:
+            return None
+        d = self.pickPixels * px
+        i1, i2 = self.visibleRange(QtCore.QRectF(pos.x() - d, 0, 2 * d, 0))
+        idx = np.flatnonzero(c.flags[i1:i2]) + i1
+        if len(idx) == 0:
+            return None
+        return int(idx[np.argmin(np.abs(c.lam0[idx] - pos.x()))])
+
+    def hoverEvent(self, ev):
+        i = None if ev.isExit() else self.pick(ev.pos())
+        if i is not None:
+            ev.acceptDrags(QtCore.Qt.LeftButton)
+        if i != self.hoverIndex:
+            self.hoverIndex = i
+            self.update()
+
+    def mouseDragEvent(self, ev):
+        if ev.button() != QtCore.Qt.LeftButton:
+            ev.ignore()
+            return
+        if ev.isStart():
+            self.dragIndex = self.pick(ev.buttonDownPos())
+        if self.dragIndex is None:
+            ev.ignore()
+            return
+        ev.accept()
+        x = self.getViewBox().mapSceneToView(ev.scenePos()).x()
+        self.controller.lineDragged(self.dragIndex, x)
+        if ev.isFinish():
+            self.dragIndex = None
+            self.update()
+
+
+class RefLabelsItem(pg.GraphicsObject):
+    """
+    The labels of the reference lines, drawn from cached pixmaps of the
+    rotated text; labels overlapping the previous one are skipped.
+    """
+
+    def __init__(self, controller):
         super().__init__()
+        self.controller = controller
+        self.font = QtGui.QFont()
+        self.__pixmaps = {}
+
+    def pixmap(self, text):
+        if text not in self.__pixmaps:
+            fm = QtGui.QFontMetrics(self.font)
+            w, h = fm.horizontalAdvance(text) + 2, fm.height()
+            pm = QtGui.QPixmap(h, w)
+            pm.fill(QtCore.Qt.transparent)
+            p = QtGui.QPainter(pm)
+            p.setFont(self.font)
+            p.setPen(QtCore.Qt.black)
+            p.translate(0, w)
+            p.rotate(-90)
+            p.drawText(1, fm.ascent(), text)
+            p.end()
+            self.__pixmaps[text] = pm
+        return self.__pixmaps[text]
+
+    def dataBounds(self, axis, frac=1.0, orthoRange=None):
+        return None
+
+    def viewRangeChanged(self):
+        self.prepareGeometryChange()
+        self.update()
+
+    def viewTransformChanged(self):
+        self.prepareGeometryChange()
+        self.update()
+
+    def boundingRect(self):
+        r = self.viewRect()
+        return QtCore.QRectF() if r is None else r.normalized()
+
+    def paint(self, p, *args):
+        rect = self.boundingRect()
+        if rect.isEmpty():
+            return
+        c = self.controller
+        i1, i2 = c.lines.index_range(rect.left(), rect.right())
+        idx = np.flatnonzero(c.flags[i1:i2]) + i1
+        if len(idx) == 0:
+            return
+        # device coordinates of the lines (the item transform is a scale and a shift)
+        tr = p.transform()
+        xs = tr.m11() * c.lam0[idx] + tr.dx()
+        y0 = tr.map(QtCore.QPointF(0, 0)).y()
+        p.resetTransform()
+        k = 0
+        while k < len(idx):
+            pm = self.pixmap(c.labels[idx[k]])
+            x = xs[k] - pm.width() / 2
+            p.drawPixmap(QtCore.QPointF(x, y0 - pm.height()), pm)
+            # next label not overlapping this one
+            k = max(k + 1, np.searchsorted(xs, x + 1.5 * pm.width()))
+
+
+class LineListModel(QtCore.QAbstractTableModel):
+    """table model of a LineList: show flag (checkable), wavelength and label"""
+    columns = ["show", "air", "vacuum", "line"]
+
+    def __init__(self, controller):
         super().__init__()
-        self.line = line
-        self.cb = QCheckBox()
-        self.cb.setChecked(line.flag)
-        t2 = QLabel("%4d" % line.lam0)
-        t1 = QLabel(line.lab)
-
-        layout = QHBoxLayout()
-        layout.addWidget(self.cb)
-        layout.addWidget(t2)
-        layout.addWidget(t1)
-        layout.addStretch(1)
-        layout.setContentsMargins(0, 0, 0, 0)
-        layout.setSpacing(3)
-        self.setLayout(layout)
-        self.cb.toggled.connect(self.toggled)
-
-    def toggled(self):
-        self.line.setVisible(self.cb.checkState())
+        self.controller = controller
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.controller.lines)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
+            return self.columns[section]
+        return None
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        line = self.controller.lines[index.row()]
+        col = index.column()
+        if role == QtCore.Qt.CheckStateRole and col == 0:
+            return QtCore.Qt.Checked if line['view'] else QtCore.Qt.Unchecked
+        if role == QtCore.Qt.DisplayRole:
+            if col == 1:
+                return "%.2f" % line['air']
+            if col == 2:
+                return "%.2f" % line['vacuum']
+            if col == 3:
+                return str(line['label'])
+        return None
+
+    def flags(self, index):
+        f = QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+        if index.column() == 0:
+            f |= QtCore.Qt.ItemIsUserCheckable
+        return f
+
+    def setData(self, index, value, role=QtCore.Qt.EditRole):
+        if role != QtCore.Qt.CheckStateRole or index.column() != 0:
+            return False
+        self.controller.setLineVisible(index.row(), value == QtCore.Qt.Checked)
+        self.dataChanged.emit(index, index, [role])
+        return True
 
 
 class ZlineSelectDialog(QWidget):
-    def __init__(self, lines: list[InfiniteZLine]):
+    def __init__(self, controller):
         super().__init__()
         mainbox = QVBoxLayout()
 
-        gridContainer = QWidget()
-        grid = QGridLayout(gridContainer)
-        grid.setContentsMargins(5, 5, 5, 5)
-        grid.setHorizontalSpacing(15)
-        grid.setVerticalSpacing(5)
-        ncol = 3
-        nrow = int(np.ceil(len(lines) / ncol))
-        for i, line in enumerate(lines):
-            grid.addWidget(LineControllerWidget(line), i % nrow, i // nrow)
-        mainbox.addWidget(gridContainer)
+        # rows are created by the view only when they are shown
+        self.model = LineListModel(controller)
+        self.view = QTableView()
+        self.view.setModel(self.model)
+        self.view.verticalHeader().setVisible(False)
+        self.view.verticalHeader().setDefaultSectionSize(self.view.fontMetrics().height() + 4)
+        self.view.horizontalHeader().setStretchLastSection(True)
+        self.view.setSelectionMode(QAbstractItemView.NoSelection)
+        mainbox.addWidget(self.view)
         self.setLayout(mainbox)
+        self.resize(320, 500)
 
 
 class ZLineController(QtCore.QObject):
@@ -84,38 +264,55 @@ class ZLineController(QtCore.QObject):
     def __init__(self, vbPlot, vbLab):
         super().__init__()
         self.z = 0
-        self.lines = []
+        # bumped when the visibility of the lines changes
+        self.version = 0
         self.vbLab = vbLab
         self.vbPlot = vbPlot
-        ifile = os.path.join(
-            os.path.dirname(__file__),
-            'linelist_vacuum_air.txt')
-
-        self.loadlineList(ifile)
-        self.dialog = ZlineSelectDialog(self.lines)
-
-    def lineDragged(self, line):
-        self.z = (line.value() - line.lam0) / line.lam0
-        for ll in self.lines:
-            ll.setValue(ll.lam0 * (1 + self.z))
-            ll.textItem.setPos(ll.lam0 * (1 + self.z), 0)
+
+        self.loadlineList(DEFAULT_LINELIST)
+
+        self.markers = RefLinesItem(self)
+        self.labelsItem = RefLabelsItem(self)
+        self.vbPlot.addItem(self.markers)
+        self.vbLab.addItem(self.labelsItem)
+        self.dialog = ZlineSelectDialog(self)
+
+    @property
+    def lam0(self):
+        return self.lines.air
+
+    @property
+    def labels(self):
+        return self.lines.labels
+
+    @property
+    def flags(self):
+        return self.lines.view
+
+    def setRedshift(self, z):
+        self.z = z
+        t = QtGui.QTransform.fromScale(1 + z, 1)
+        self.markers.setTransform(t)
+        self.labelsItem.setTransform(t)
         self.sigRedshiftChanged.emit(self.z)
 
-    def loadlineList(self, ifile):
+    def lineDragged(self, i, x):
+        self.setRedshift((x - self.lam0[i]) / self.lam0[i])
 
-        with open(ifile) as ff:
-            for l in ff.readlines():
-                if l.strip().startswith("#"): continue
-                if l.strip() == "": continue
-                vv = l.split()
-                lam = float(vv[0])
-                lab = vv[2]
-                flag = bool(vv[3])
-                l = InfiniteZLine(pos=lam, lam0=lam, lab=lab, flag=flag)
-                self.vbPlot.addItem(l)
-                self.vbLab.addItem(l.textItem)
-                l.sigDragged.connect(self.lineDragged)
-                self.lines.append(l)
+    def setLineVisible(self, i, b):
+        self.flags[i] = b
+        self.version += 1
+        self.markers.invalidate()
+        self.labelsItem.update()
+
+    def loadlineList(self, ifile):
+        self.lines = LineList.read(ifile)
+        self.version += 1
+        if hasattr(self, 'dialog'):
+            self.dialog.model.beginResetModel()
+            self.dialog.model.endResetModel()
+            self.markers.invalidate()
+            self.labelsItem.update()
 
     def showDialog(self):
         self.dialog.show()
@@ -125,28 +322,42 @@ class ZLineController(QtCore.QObject):
 
 class SpecViewer(QWidget):
     penSpec = pg.mkPen((0, 0, 0), width=1)
+    penError = pg.mkPen((120, 120, 120, 80), width=1)
+    brushError = pg.mkBrush((120, 120, 120, 60))
     penVline = pg.mkPen((0, 255, 0, 204), width=1)
     penZline = pg.mkPen((204, 204, 204, 124), width=1)
 
     background = 'w'
     sigSpecChange = QtCore.pyqtSignal(int)
     sigRadiusChanged = QtCore.pyqtSignal(int)
+    sigSmoothChanged = QtCore.pyqtSignal(int)
+    # the error band was switched on or off
+    sigErrorsToggled = QtCore.pyqtSignal(bool)
     sigSubplotDefined = QtCore.pyqtSignal(float, float)
+    # emitted while a band region is edited (False) and when editing ends (True)
+    sigBandRegionChanged = QtCore.pyqtSignal(bool)
 
     wav = None
     spec = None
+    # SpectralAxis of the cube, None until setWavelengts
+    axis = None
     redshift = 0
     idx = 0
 
     def __init__(self):
         super().__init__()
         self.spec = None
-        self.wavelenght_unit = u.AA
+        # variance of the spectrum, None when the cube has none
+        self.var = None
+        # Angstrom, unless set before the first cube (astropy is imported with it)
+        self.wavelenght_unit = None
         #        self.wav = None
 
         self.xMouse = None
         self.yMouse = None
         self.smooth = 0
+        # True when the spectra come from a spectrally smoothed cube
+        self.presmoothed = False
 
         self.sb_smoothSpe = QSpinBox()
         self.sb_smoothSpe.setRange(0, 15)
@@ -155,6 +366,11 @@ class SpecViewer(QWidget):
         self.sb_radiusSpe = QSpinBox()
         self.sb_radiusSpe.setRange(0, 15)
 
+        # the variance is only read while the error band is shown
+        self.cb_errors = QCheckBox("errors")
+        self.cb_errors.setEnabled(False)
+        self.cb_errors.setToolTip("+-1 sigma band from the variance of the cube")
+
         self.le_redshift = QLabel("%s" % self.redshift)
         self.le_redshift.setTextInteractionFlags(QtCore.Qt.TextSelectableByMouse)
 
@@ -181,7 +397,15 @@ class SpecViewer(QWidget):
         self.vb.getAxis('right').setStyle(showValues=False)
         self.vb0.setXLink(self.vb)
 
-        self.plotSpec = pg.PlotCurveItem(pen=self.penSpec)
+        # +-1 sigma band of the spectrum
+        self.plotErrLow = DecimatedCurveItem(pen=self.penError)
+        self.plotErrHigh = DecimatedCurveItem(pen=self.penError)
+        self.errorBand = pg.FillBetweenItem(self.plotErrLow, self.plotErrHigh, brush=self.brushError)
+        for item in (self.errorBand, self.plotErrLow, self.plotErrHigh):
+            item.setVisible(False)
+            self.vb.addItem(item)
+
+        self.plotSpec = DecimatedCurveItem(pen=self.penSpec)
         self.vb.addItem(self.plotSpec)
 
         self.zLineController = ZLineController(vbPlot=self.vb, vbLab=self.vb0)
@@ -208,11 +432,12 @@ class SpecViewer(QWidget):
         self.sb_smoothSpe.valueChanged.connect(self.smoothchange)
         self.zLineController.sigRedshiftChanged.connect(self.redshiftChanged)
         self.sb_radiusSpe.valueChanged.connect(self.specRadiuschange)
+        self.cb_errors.toggled.connect(self.errorsToggled)
         self.plotWidget.setContentsMargins(5, 5, 5, 5)
 
     @property
     def wav(self):
-        return (self._wav.to(self.wavelenght_unit)).value
+        return self.axis.to(self.wavelenght_unit)
 
     def initUI(self):
         mainbox = QVBoxLayout(self)
@@ -230,6 +455,8 @@ class SpecViewer(QWidget):
         topBox.addWidget(QLabel("radius"))
         topBox.addWidget(self.sb_radiusSpe)
         topBox.addSpacing(20)
+        topBox.addWidget(self.cb_errors)
+        topBox.addSpacing(20)
         topBox.addWidget(QLabel("z="))
         topBox.addWidget(self.le_redshift)
         topBox.addStretch(1)
@@ -246,15 +473,21 @@ class SpecViewer(QWidget):
         self.regionR.setVisible(self.viewRegionMode)
 
     def setWavelengts(self, w):
-        self._wav = w
+        # a SpectralAxis, or a Quantity array
+        import astropy.units as u
+        from .SpectralAxis import SpectralAxis
+        if self.wavelenght_unit is None:
+            self.wavelenght_unit = u.AA
+        self.axis = w if isinstance(w, SpectralAxis) else SpectralAxis(w.value, w.unit)
 
         self.vb.setLimits(xMin=self.wav.min(), xMax=self.wav.max())
 
     def updateLabelPos(self,s):
         self.label_position.setText(s)
 
-    def updateSpec(self, v):
+    def updateSpec(self, v, var=None):
         self.spec = v
+        self.var = var
         self.updateSpecPlot()
 
     #    def setSpec(self, x, y):
@@ -264,20 +497,50 @@ class SpecViewer(QWidget):
     #
     #        self.updateSpecPlot()
 
+    @traced
     def updateSpecPlot(self):
-        if self.smooth == 0:
+        # the window is interactive before the first cube is loaded
+        if self.spec is None or self.axis is None:
+            return
+        var = self.var
+        if self.smooth == 0 or self.presmoothed:
             y = self.spec
         else:
-            kernel = Gaussian1DKernel(self.smooth)
-            y = convolve(self.spec, kernel)
+            y = gaussian_smooth_axis(self.spec, self.smooth)
+            if var is not None:
+                var = gaussian_smooth_axis_variance(np.where(np.isfinite(self.spec), var, np.nan), self.smooth)
 
         self.plotSpec.setData(self.wav, y)
+        self.updateErrorBand(y, var)
 
         self.vb.setAutoVisible(y=True)
 
+    @property
+    def showErrors(self):
+        return self.cb_errors.isEnabled() and self.cb_errors.isChecked()
+
+    def setErrorsAvailable(self, b):
+        """enable the error band (when the cube has a variance)"""
+        self.cb_errors.setEnabled(b)
+
+    def errorsToggled(self, b):
+        self.updateSpecPlot()
+        self.sigErrorsToggled.emit(b)
+
+    def updateErrorBand(self, y, var):
+        show = var is not None and self.showErrors
+        if show:
+            with np.errstate(invalid='ignore'):
+                sigma = np.sqrt(var)
+            self.plotErrLow.setData(self.wav, y - sigma)
+            self.plotErrHigh.setData(self.wav, y + sigma)
+        for item in (self.errorBand, self.plotErrLow, self.plotErrHigh):
+            item.setVisible(show)
+
     def smoothchange(self):
         self.smooth = self.sb_smoothSpe.value()
         self.updateSpecPlot()
+        self.sigSmoothChanged.emit(self.smooth)
 
     def specRadiuschange(self):
         r = self.sb_radiusSpe.value()
@@ -291,6 +554,8 @@ class SpecViewer(QWidget):
         if self.editRegion is not None:
             r0 = self.editRegion.lines[0].value()
             self.editRegion.setRegion((r0, self.xMouse))
+            if self.editRegion is not self.regionZ:
+                self.sigBandRegionChanged.emit(False)
 
     def setVlineId(self, idx):
         self.idx = idx
@@ -306,10 +571,12 @@ class SpecViewer(QWidget):
 
     def keyPressed(self, ev):
         # print ("keyPressed",ev.key)
+        if self.axis is None:
+            return
 
         if not self.viewRegionMode:
             if (ev.key() == QtCore.Qt.Key_I):
-                idx = np.argmin(np.abs(self.wav - self.xMouse))
+                idx = self.axis.closest(self.xMouse, unit=self.wavelenght_unit)
                 if self.idx == idx: return
                 self.idx = idx
                 self.setVlineId(idx)
@@ -368,4 +635,6 @@ class SpecViewer(QWidget):
             if ev.key() == QtCore.Qt.Key_Z:
                 self.editRegion.setVisible(False)
                 self.sigSubplotDefined.emit(*self.regionZ.getRegion())
+            else:
+                self.sigBandRegionChanged.emit(True)
             self.editRegion = None
@@ -0,0 +1,126 @@
+import astropy.units as u
+import numpy as np
+
+vel_c = 299792.458
+
+
+class SpectralAxis:
+    """
+    The spectral coordinates of the channels of a cube.
+
+    Conversions to other spectral units (wavelength, frequency, energy) and
+    velocity axes are computed once and cached; channel lookups use binary
+    search, so they work for any monotonic grid (linear, log-lambda, ...)
+    and do not allocate Quantities for plain floats.
+    """
+
+    def __init__(self, values, unit):
+        self.unit = u.Unit(unit)
+        self.values = np.asarray(values, dtype=float)
+        self.values.flags.writeable = False
+        self.__quantity = None
+        self.__views = {self.unit: self.values}
+        self.__velocity = {}
+        self.__sorted = {}
+        self.__width = None
+
+    @classmethod
+    def from_wcs(cls, spec, nz, unit=None):
+        """axis of the nz channels of a 1D spectral WCS, optionally converted to unit"""
+        wav = spec.pixel_to_world_values(np.arange(nz)) * u.Unit(spec.world_axis_units[0])
+        if unit:
+            wav = wav.to(u.Unit(unit), equivalencies=u.spectral())
+        return cls(wav.value, wav.unit)
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def quantity(self):
+        if self.__quantity is None:
+            self.__quantity = self.values * self.unit
+        return self.__quantity
+
+    @property
+    def width(self):
+        """channel widths (absolute value of the gradient of the axis)"""
+        if self.__width is None:
+            n = len(self.values)
+            self.__width = np.abs(np.gradient(self.values)) if n > 1 else np.ones(n)
+            self.__width.flags.writeable = False
+        return self.__width
+
+    @property
+    def edges(self):
+        """the nz + 1 channel edges: midpoints between the channels, extrapolated at the ends"""
+        v = self.values
+        if len(v) == 1:
+            return np.array([v[0] - .5, v[0] + .5])
+        mid = 0.5 * (v[1:] + v[:-1])
+        return np.concatenate([[2 * v[0] - mid[0]], mid, [2 * v[-1] - mid[-1]]])
+
+    def band_weights(self, l1, l2):
+        """
+        (i1, i2, w): the channels [i1, i2) overlapping the band between l1
+        and l2 (Quantities, or floats in the axis unit) and the width of
+        each one inside the band, the edge channels counting fractionally
+        as in CumulativeBandIndex.integral
+        """
+        lo, hi = sorted([self.value(l1), self.value(l2)])
+        e = self.edges
+        w = np.clip(np.minimum(np.maximum(e[:-1], e[1:]), hi) - np.maximum(np.minimum(e[:-1], e[1:]), lo), 0, None)
+        idx = np.flatnonzero(w > 0)
+        if len(idx) == 0:
+            i = self.closest(0.5 * (lo + hi))
+            return i, i + 1, np.zeros(1)
+        i1, i2 = int(idx[0]), int(idx[-1]) + 1
+        return i1, i2, w[i1:i2]
+
+    def to(self, unit):
+        """the axis in `unit` (read-only array)"""
+        unit = u.Unit(unit)
+        if unit not in self.__views:
+            a = (self.values * self.unit).to_value(unit, equivalencies=u.spectral())
+            a.flags.writeable = False
+            self.__views[unit] = a
+        return self.__views[unit]
+
+    def value(self, v, unit=None):
+        """v (a Quantity, or a float in `unit`, default the axis unit) in the axis unit"""
+        if isinstance(v, u.Quantity):
+            return v.to_value(self.unit, equivalencies=u.spectral())
+        if unit is None or u.Unit(unit) == self.unit:
+            return float(v)
+        return (v * u.Unit(unit)).to_value(self.unit, equivalencies=u.spectral())
+
+    def __ascending(self, unit):
+        # contiguous ascending copy of the axis in unit, for the binary searches
+        if unit not in self.__sorted:
+            a = self.to(unit)
+            descending = len(a) > 1 and a[0] > a[-1]
+            self.__sorted[unit] = (np.ascontiguousarray(a[::-1]) if descending else a, descending)
+        return self.__sorted[unit]
+
+    def closest(self, v, unit=None):
+        """index of the channel closest to v (a Quantity or a float in `unit`)"""
+        if isinstance(v, u.Quantity):
+            v, unit = self.value(v), self.unit
+        unit = self.unit if unit is None else u.Unit(unit)
+        r, descending = self.__ascending(unit)
+        n = len(r)
+        if n == 1:
+            return 0
+        j = min(max(int(np.searchsorted(r, v)), 1), n - 1)
+        j = j - 1 if abs(r[j - 1] - v) <= abs(r[j] - v) else j
+        return n - 1 - j if descending else j
+
+    def velocity(self, rest):
+        """velocity axis (km/s, optical convention) relative to the rest wavelength `rest` (Quantity)"""
+        rest = rest.to_value(u.AA, equivalencies=u.spectral())
+        key = round(rest, 9)
+        if key not in self.__velocity:
+            lam = self.to(u.AA)
+            v = vel_c * (lam - rest) / rest
+            v.flags.writeable = False
+            self.__velocity[key] = v
+        return self.__velocity[key]
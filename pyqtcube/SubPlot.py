@@ -2,6 +2,7 @@ import pyqtgraph as pg
 from PyQt5.QtWidgets import QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QCheckBox
 
 from .CustomWidgets import SliderText
+from .Decimation import DecimatedCurveItem
 from .SpecViewer import SpecViewer
 
 pg.setConfigOptions(antialias=True)
@@ -99,8 +100,10 @@ class SubPlot(QMainWindow):
 
         pen1 = pg.mkPen(spec1Color, width=1)
         pen2 = pg.mkPen(spec2Color, width=1)
-        self.plot1 = self.p1.plot(pen=pen1)
-        self.plot2 = pg.PlotCurveItem(pen=pen2)
+        # only the part of the spectra within the window range is drawn
+        self.plot1 = DecimatedCurveItem(pen=pen1)
+        self.p1.addItem(self.plot1)
+        self.plot2 = DecimatedCurveItem(pen=pen2)
 
         self.p2.addItem(self.plot2)
 
@@ -0,0 +1,131 @@
+"""
+Lightweight timing spans of the hot paths of the viewer, exported in the
+Chrome trace event format (chrome://tracing, https://ui.perfetto.dev).
+
+Tracing is off unless the environment variable PYCUBE_TRACE is set (to
+the output file, or to 1 for pycube_trace.json), pycube is started with
+--trace, or tracer.enable() is called.  When off, a traced call costs one
+attribute test; when on, the trace is written at exit.
+"""
+import atexit
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from collections import deque
+
+DEFAULT_TRACE_FILE = 'pycube_trace.json'
+
+# oldest events are dropped beyond this number
+MAX_EVENTS = 10 ** 6
+
+
+class Tracer:
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.events = deque(maxlen=MAX_EVENTS)
+        # (name, duration) of the spans completed since the last take()
+        self.__recent = deque(maxlen=4096)
+        self.__t0 = time.perf_counter()
+        self.__atexit = False
+
+    def enable(self, path=DEFAULT_TRACE_FILE):
+        self.enabled = True
+        self.path = path
+        if not self.__atexit:
+            atexit.register(self.save)
+            self.__atexit = True
+
+    def disable(self):
+        self.enabled = False
+
+    def add(self, name, cat, t0, t1):
+        """a complete span from t0 to t1 (time.perf_counter) in the current thread"""
+        self.events.append((name, cat, t0, t1, threading.get_ident()))
+        self.__recent.append((name, t1 - t0))
+
+    def take(self):
+        """[(name, total seconds, calls)] of the spans completed since the last call, slowest first"""
+        total = {}
+        while self.__recent:
+            name, dt = self.__recent.popleft()
+            t, n = total.get(name, (0., 0))
+            total[name] = (t + dt, n + 1)
+        return sorted(((k, t, n) for k, (t, n) in total.items()), key=lambda a: -a[1])
+
+    def chrome_trace(self):
+        """the events as a Chrome trace / Perfetto JSON document"""
+        pid = os.getpid()
+        events = [dict(name=name, cat=cat, ph='X', pid=pid, tid=tid,
+                       ts=(t0 - self.__t0) * 1e6, dur=(t1 - t0) * 1e6)
+                  for name, cat, t0, t1, tid in list(self.events)]
+        for t in threading.enumerate():
+            events.append(dict(name='thread_name', ph='M', pid=pid, tid=t.ident, args=dict(name=t.name)))
+        return dict(traceEvents=events, displayTimeUnit='ms')
+
+    def save(self, path=None):
+        path = path or self.path or DEFAULT_TRACE_FILE
+        if not self.events:
+            return None
+        with open(path, 'w') as ff:
+            json.dump(self.chrome_trace(), ff)
+        return path
+
+
+tracer = Tracer()
+if os.environ.get('PYCUBE_TRACE'):
+    tracer.enable(DEFAULT_TRACE_FILE if os.environ['PYCUBE_TRACE'] == '1' else os.environ['PYCUBE_TRACE'])
+
+
+class span:
+    """context manager timing a block of code"""
+    __slots__ = ('name', 'cat', 't0')
+
+    def __init__(self, name, cat='pycube'):
+        self.name = name
+        self.cat = cat
+        self.t0 = None
+
+    def __enter__(self):
+        if tracer.enabled:
+            self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self.t0 is not None:
+            tracer.add(self.name, self.cat, self.t0, time.perf_counter())
+
+
+def traced(func=None, name=None, cat='pycube'):
+    """decorator timing every call of func (named by its qualified name)"""
+    if func is None:
+        return functools.partial(traced, name=name, cat=cat)
+    name = name or func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not tracer.enabled:
+            return func(*args, **kwargs)
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            tracer.add(name, cat, t0, time.perf_counter())
+
+    return wrapper
+
+
+def traced_methods(cat):
+    """class decorator tracing all the public methods defined in the class"""
+
+    def decorate(cls):
+        for k, v in list(vars(cls).items()):
+            if not k.startswith('_') and inspect.isfunction(v) and not inspect.isgeneratorfunction(v):
+                setattr(cls, k, traced(v, cat=cat))
+        return cls
+
+    return decorate
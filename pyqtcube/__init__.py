@@ -1,3 +1,38 @@
-from .pycubeApp import run
-from .DataCube import read
+import time
+
+# start of the session, for the time-to-first-pixel of the viewer
+STARTUP = time.perf_counter()
+
 __version__ = "0.9.1"
+
+# astropy, Qt and pyqtgraph are imported on first use, so that the
+# viewer can show its window before the cube and its WCS are read
+_LAZY = {
+    'read': ('DataCube', 'read'),
+    'run_batch': ('Batch', 'run_batch'),
+    'run_jobfile': ('Batch', 'run_jobfile'),
+}
+
+
+def __getattr__(name):
+    import importlib
+    import importlib.util
+    if name not in _LAZY:
+        # submodules, e.g. pyqtcube.DataCube.read
+        if importlib.util.find_spec('.' + name, __name__) is None:
+            raise AttributeError("module %r has no attribute %r" % (__name__, name))
+        return importlib.import_module('.' + name, __name__)
+    module, attr = _LAZY[name]
+    value = getattr(importlib.import_module('.' + module, __name__), attr)
+    globals()[name] = value
+    return value
+
+
+def run(cube=None, ifile=None, extn=1, setup=None):
+    """
+    start the GUI (Qt is imported only here, so batch runs need no display)
+    on a DataCube, or on the cube in the extension `extn` of `ifile`, opened
+    after the window is shown; setup(cube) is called once it is open
+    """
+    from .pycubeApp import run as _run
+    return _run(cube, ifile=ifile, extn=extn, setup=setup)
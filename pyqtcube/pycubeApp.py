@@ -1,18 +1,21 @@
 import signal
 import sys
+import time
+from concurrent.futures import CancelledError
 from functools import partial
 
-import astropy.units as u
 import numpy as np
-from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, \
     QVBoxLayout, QSplitter, QAction, \
-    QMessageBox
+    QMessageBox, QProgressBar
 
-from .DataCube import DataCube
+from . import STARTUP
 from .PyCubeImageViewer import PyCubeImageViewerPanel
+from .QueryDispatcher import QueryDispatcher
 from .SpecViewer import SpecViewer
 from .SubPlot import SubplotController
+from .Tracing import span, tracer, traced
 
 
 def __sigint_handler(*args):
@@ -22,10 +25,14 @@ def __sigint_handler(*args):
 
 
 class Window(QMainWindow):
+    sigFitProgress = pyqtSignal(float)
+
     def __init__(self, parent=None):
         super().__init__()
         self.title = "PyCube"
         self.cube = None
+        self.cube0 = None
+        self.smoothCube = False
         self.x = None
         self.y = None
         self.z = None
@@ -36,9 +43,25 @@ class Window(QMainWindow):
         self.imageModes = [
             'Single Line',
             'Line band',
-            'Line band - continuum'
+            'Line band - continuum',
+            'Moment 0 (flux)',
+            'Moment 1 (velocity)',
+            'Moment 2 (dispersion)',
+            'Fit flux (Ha)',
+            'Fit velocity',
+            'Fit dispersion',
+            'Line S/N',
         ]
         self.imageMode = 0
+        # mode of the image currently displayed
+        self.imageMode0 = 0
+        self.ima = None
+        # maps of the last emission line fit
+        self.lineFit = None
+        # seconds from the start of the session to the first image shown
+        self.timeToFirstPixel = None
+
+        self.queries = QueryDispatcher()
 
         self.subplotController = SubplotController()
         self.subplotController.linkTo(self.specviewer)
@@ -59,6 +82,34 @@ class Window(QMainWindow):
 
         self.specviewer.sigSpecChange.connect(self.specChanged)
         self.specviewer.sigRadiusChanged.connect(self.radiusChanged)
+        self.specviewer.sigSmoothChanged.connect(self.updateCubeSmoothing)
+        self.specviewer.sigErrorsToggled.connect(self.requestSpectrum)
+        # the whole cube is smoothed once the spinbox has settled; the
+        # computation of a superseded width is cancelled
+        self.cubeSmoothingTimer = QTimer(self)
+        self.cubeSmoothingTimer.setSingleShot(True)
+        self.cubeSmoothingTimer.setInterval(400)
+        self.cubeSmoothingTimer.timeout.connect(self.submitCubeSmoothing)
+        self.cubeSmoothingJob = 0
+        self.imageviewer.cb_cubelevels.toggled.connect(self.cubeLevelsToggled)
+        self.specviewer.sigBandRegionChanged.connect(self.bandRegionChanged)
+        # progress is emitted from the fitting thread
+        self.sigFitProgress.connect(self.fitProgress, Qt.QueuedConnection)
+
+        # progress of the background indexing of the cube
+        self.progressBar = QProgressBar()
+        self.progressBar.setMaximumWidth(250)
+        self.progressBar.setVisible(False)
+        self.statusBar().addPermanentWidget(self.progressBar)
+        self.loadTimer = QTimer(self)
+        self.loadTimer.timeout.connect(self.updateLoadProgress)
+        # background jobs whose error has been reported
+        self.loadErrors = []
+
+        if tracer.enabled:
+            self.traceTimer = QTimer(self)
+            self.traceTimer.timeout.connect(self.showTrace)
+            self.traceTimer.start(500)
 
     #    @property
     #    def ima(self):
@@ -91,7 +142,7 @@ class Window(QMainWindow):
 
         for i, m in enumerate(self.imageModes):
             modeButton = QAction(m, self)
-            modeButton.setShortcut('Ctrl+%d' % (i + 1))
+            modeButton.setShortcut('Ctrl+%d' % ((i + 1) % 10))
             modeButton.triggered.connect(partial(self.setmode, i))
             modeMenu.addAction(modeButton)
 
@@ -105,6 +156,16 @@ class Window(QMainWindow):
         subsource.triggered.connect(self.setSubplotSource)
         specMenu.addAction(subsource)
 
+        a = QAction("Smooth the whole cube spectrally", self)
+        a.setCheckable(True)
+        a.toggled.connect(self.setCubeSmoothing)
+        specMenu.addAction(a)
+
+        a = QAction("Fit emission lines (Ha + [NII])", self)
+        a.setShortcut("Ctrl+F")
+        a.triggered.connect(self.fitLines)
+        specMenu.addAction(a)
+
         a = QAction("Show All Spectal Zooom Plots", self)
         a.triggered.connect(self.subplotController.showAll)
         specMenu.addAction(a)
@@ -113,6 +174,7 @@ class Window(QMainWindow):
         specMenu.addAction(a)
 
     def setWavelenghtUnit(self, s):
+        import astropy.units as u
         if type(s) == str:
             ss = u.Unit(s)
         elif type(s) == u.Unit:
@@ -122,29 +184,120 @@ class Window(QMainWindow):
 
         self.specviewer.wavelenght_unit = ss
 
+    def bandRegions(self, names="CBR"):
+        wu = self.specviewer.wavelenght_unit
+        regions = dict(C=self.specviewer.regionC, B=self.specviewer.regionB, R=self.specviewer.regionR)
+        return [tuple(v * wu for v in regions[n].getRegion()) for n in names]
+
+    def imageQuery(self, m):
+        """the DataCube query computing the image of mode m with the current settings"""
+        if m == 0:
+            return partial(self.cube.get_channel, self.z)
+        elif m == 1:
+            return partial(self.cube.get_image_band, *self.bandRegions("C")[0])
+        elif m == 2:
+            return partial(self.cube.get_image_continuum_subtracted, *self.bandRegions("CBR"))
+        elif 6 <= m < 9:
+            return partial(self.fitImage, m)
+        elif m == 9:
+            # S/N of the line band, continuum subtracted when the blue and red bands are defined
+            line, blue, red = self.bandRegions("CBR")
+            if blue[0] == blue[1] or red[0] == red[1]:
+                blue = red = None
+            return partial(self.cube.get_image_snr, line, blue=blue, red=red)
+        else:
+            # moments of the line band, continuum subtracted when the blue and red bands are defined
+            line, blue, red = self.bandRegions("CBR")
+            if blue[0] == blue[1] or red[0] == red[1]:
+                blue = red = None
+            return partial(self.cube.get_moment, m - 3, *line, blue=blue, red=red)
+
+    def fitImage(self, m):
+        if self.lineFit is None:
+            raise ValueError("no line fit: run Spectra > Fit emission lines first")
+        if m == 6:
+            rest = self.lineFit['rest']
+            return self.lineFit['flux'][np.argmin(np.abs(rest - 6562.80))]
+        return self.lineFit['velocity' if m == 7 else 'sigma']
+
+    def fitLines(self):
+        if self.cube is None:
+            return
+        from .LineFit import select_lines
+        rest = select_lines()
+        z = self.specviewer.redshift
+        self.statusBar().showMessage("Fitting %d lines at z=%.5f ..." % (len(rest), z))
+        query = partial(self.cube.fit_lines, rest, z, progress=self.sigFitProgress.emit)
+        self.queries.submit('fit', query, self.fitReady, self.queryFailed)
+
+    def fitProgress(self, f):
+        self.statusBar().showMessage("Fitting emission lines: %d%%" % (100 * f))
+
+    def fitReady(self, maps):
+        self.lineFit = maps
+        self.statusBar().showMessage("Emission line fit done", 5000)
+        if 6 <= self.imageMode < 9:
+            self.requestImage()
+
+    def showTrace(self):
+        # breakdown of the spans completed since the last readout
+        spans = tracer.take()
+        if spans:
+            self.statusBar().showMessage("  ".join("%s %.1f ms" % (name, t * 1e3)
+                                                   for name, t, n in spans[:6]))
+
     def imageSingleLine(self):
-        return self.cube.get_channel(self.z)
+        return self.imageQuery(0)()
 
     def imageBand(self):
-        wu = self.specviewer.wavelenght_unit
-        c1, c2 = self.specviewer.regionC.getRegion()
-        return self.cube.get_image_band(c1 * wu, c2 * wu)
+        return self.imageQuery(1)()
 
     def imageBandContinummSubtracted(self):
-        wu = self.specviewer.wavelenght_unit
-        c1, c2 = self.specviewer.regionC.getRegion()
-        b1, b2 = self.specviewer.regionB.getRegion()
-        r1, r2 = self.specviewer.regionR.getRegion()
-
-        fluxc = self.cube.get_image_band(c1 * wu, c2 * wu)
-        fluxb = self.cube.get_image_band(b1 * wu, b2 * wu)
-        fluxr = self.cube.get_image_band(r1 * wu, r2 * wu)
+        return self.imageQuery(2)()
+
+    def requestImage(self, m=None):
+        if self.cube is None:
+            return
+        if m is None:
+            m = self.imageMode
+        self.queries.submit('image', self.imageQuery(m), partial(self.imageReady, m=m), self.queryFailed)
+
+    def requestSpectrum(self):
+        if self.cube is None:
+            return
+        # the variance only for the error band
+        variance = self.specviewer.showErrors and self.cube.variance is not None
+        query = partial(self.cube.get_1dSpec, self.x, self.y, r=self.r, variance=variance)
+        self.queries.submit('spectrum', query, self.spectrumReady, self.queryFailed)
+
+    def imageLevels(self, m):
+        """precomputed display levels for an image of mode m, None to use zscale"""
+        if self.imageviewer.cb_cubelevels.isChecked() and m in (0, 1):
+            return self.cube.global_levels()
+        if m == 0:
+            return self.cube.channel_levels(self.z)
+        return None
+
+    @traced
+    def imageReady(self, ima, m=0):
+        self.ima = ima
+        self.imageMode0 = m
+        self.imageviewer.updateImage(self.ima, levels=self.imageLevels(m))
+
+    def cubeLevelsToggled(self):
+        if self.ima is not None:
+            self.imageReady(self.ima, self.imageMode0)
+
+    @traced
+    def spectrumReady(self, spec):
+        var = None
+        if isinstance(spec, tuple):
+            spec, var = spec
+        self.specviewer.updateSpec(spec, var)
+        self.subplotController.setData1()
 
-        c = 0.5 * (c1 + c2)
-        r = 0.5 * (r1 + r2)
-        b = 0.5 * (b1 + b2)
-        k = (c - b) / (r - b)
-        return fluxc - (k * fluxb + (1 - k) * fluxr)
+    def queryFailed(self, exc):
+        self.showError("%s: %s" % (type(exc).__name__, exc))
 
     def showError(self, s):
         msg = QMessageBox()
@@ -160,81 +313,188 @@ class Window(QMainWindow):
         return c1 == c2
 
     def setmode(self, m):
-        self.specviewer.viewRegionMode = m != 0
-        self.specviewer.applyRegionMode()
+        # called through partial() by the menu actions: traced with a span
+        with span('Window.setmode'):
+            self.specviewer.viewRegionMode = 0 < m < 6 or m == 9
+            self.specviewer.applyRegionMode()
+
+            if m == 1 or 3 <= m < 6 or m == 9:
+                if self.checkBand(self.specviewer.regionC, "Line band"): return
+            elif m == 2:
+                if self.checkBand(self.specviewer.regionC, "Line band"): return
+                if self.checkBand(self.specviewer.regionB, "Blue band"): return
+                if self.checkBand(self.specviewer.regionR, "Red band"): return
+            self.imageMode = m
+            self.imageviewer.label_imagemode.setText(self.imageModes[m])
+            self.requestImage()
+
+    def bandRegionChanged(self, final):
+        # live refresh only when band images are cheap (band index ready)
+        if self.imageMode == 0 or 6 <= self.imageMode < 9:
+            return
+        if not (final or (self.imageMode in (1, 2) and self.cube.band_index_ready)):
+            return
+        sv = self.specviewer
+        regions = [sv.regionC, sv.regionB, sv.regionR] if self.imageMode == 2 else [sv.regionC]
+        for r in regions:
+            c1, c2 = r.getRegion()
+            if c1 == c2: return
+        self.requestImage()
+
+    def setCubeSmoothing(self, on):
+        self.smoothCube = on
+        self.updateCubeSmoothing()
+
+    def updateCubeSmoothing(self):
+        # images and spectra from a copy of the cube smoothed with the
+        # width of the spectrum smoothing
+        sigma = self.specviewer.smooth if self.smoothCube else 0
+        if self.cube0 is None:
+            return
+        self.cubeSmoothingJob += 1
+        if sigma == 0:
+            self.cubeSmoothingTimer.stop()
+            if self.cube is not self.cube0:
+                self.useCube(self.cube0)
+        else:
+            self.cubeSmoothingTimer.start()
 
-        if m == 0:
-            self.ima = self.imageSingleLine()
-            self.imageviewer.updateImage(self.ima)
-        elif m == 1:
-            if self.checkBand(self.specviewer.regionC, "Line band"): return
-            self.ima = self.imageBand()
-            self.imageviewer.updateImage(self.ima)
-        elif m == 2:
-            if self.checkBand(self.specviewer.regionC, "Line band"): return
-            if self.checkBand(self.specviewer.regionB, "Blue band"): return
-            if self.checkBand(self.specviewer.regionR, "Red band"): return
-            self.ima = self.imageBandContinummSubtracted()
-            self.imageviewer.updateImage(self.ima)
-        self.imageMode = m
-        self.imageviewer.label_imagemode.setText(self.imageModes[m])
+    def submitCubeSmoothing(self):
+        sigma = self.specviewer.smooth if self.smoothCube else 0
+        if self.cube0 is None or sigma == 0:
+            return
+        job = self.cubeSmoothingJob
+
+        def cancelled():
+            return self.cubeSmoothingJob != job
+
+        self.queries.submit('cube', partial(self.cube0.smoothed, sigma, cancelled=cancelled), self.useCube,
+                            self.cubeSmoothingFailed)
+
+    def cubeSmoothingFailed(self, exc):
+        if not isinstance(exc, CancelledError):
+            self.queryFailed(exc)
+
+    def useCube(self, cube):
+        self.cube = cube
+        self.specviewer.presmoothed = cube is not self.cube0
+        self.requestImage()
+        self.requestSpectrum()
 
     def setSubplotSource(self):
         self.subplotController.setData2()
         self.imageviewer.setPosMarker2()
 
+    @traced
     def posChanged(self, x, y):
         self.x = x
         self.y = y
-        # self.specviewer.updateSpec(self.cube.get_1dSpec(self.x, self.y))
-        self.specviewer.updateSpec(self.cube.get_1dSpec(self.x, self.y, r=self.r))
         self.specviewer.updateLabelPos("%d, %d"%(x,y))
-        
-        self.subplotController.setData1()
+        self.requestSpectrum()
 
     def radiusChanged(self, r):
         self.imageviewer.posMarker.setRadius(r)
         self.r = r
-        self.specviewer.updateSpec(self.cube.get_1dSpec(self.x, self.y, r=r))
-        self.subplotController.setData1()
+        self.requestSpectrum()
 
+    @traced
     def specChanged(self, idx):
         self.z = idx
-
-        self.ima = self.imageSingleLine()
-        self.imageviewer.updateImage(self.ima)
-
-    def setCube(self, cube: DataCube):
+        self.requestImage(0)
+
+    def openCube(self, ifile, extn=1, setup=None):
+        """
+        open the cube in the extension `extn` of `ifile` in the background
+        (header, WCS and memory map only); setup(cube) is called before it
+        is shown
+        """
+        self.statusBar().showMessage("Opening %s ..." % ifile)
+        from .DataCube import read
+        self.queries.submit('open', partial(read, ifile, extn=extn), partial(self.cubeOpened, setup=setup),
+                            self.queryFailed)
+
+    def cubeOpened(self, cube, setup=None):
+        self.setCube(cube)
+        # background indexing starts after the first image
+        if setup is not None:
+            setup(cube)
+        self.loadTimer.start(200)
+
+    def updateLoadProgress(self):
+        """progress of the indexes of the cube built in the background"""
+        cube = self.cube0
+        jobs = [(name, job) for name, job in [('statistics', cube.channel_stats), ('spectra', cube.sidecar),
+                                              ('variance spectra', cube.variance_sidecar),
+                                              ('band index', cube.band_index)]
+                if job is not None]
+        errors = []
+        for name, job in jobs:
+            if job.error is not None and not any(job is j for j in self.loadErrors):
+                self.loadErrors.append(job)
+                if job.failed:
+                    errors.append("indexing %s failed: %s" % (name, job.error))
+                else:
+                    errors.append("could not cache %s (%s), kept in memory" % (name, job.error))
+        if errors:
+            failed = any(job.failed for name, job in jobs)
+            msg = "; ".join(errors)
+            self.statusBar().showMessage(msg[0].upper() + msg[1:], 0 if failed else 10000)
+        jobs = [(name, job) for name, job in jobs if not job.ready and not job.failed]
+        if not jobs:
+            self.progressBar.setVisible(False)
+            self.loadTimer.stop()
+            return
+        self.progressBar.setVisible(True)
+        self.progressBar.setFormat("Indexing %s: %%p%%" % ", ".join(name for name, job in jobs))
+        self.progressBar.setValue(int(100 * sum(job.progress for name, job in jobs) / len(jobs)))
+
+    def setCube(self, cube: 'DataCube'):
         self.cube = cube
+        self.cube0 = cube
         nz, ny, nx = cube.shape
         self.z = nz // 2
         #        self.z=self.cube.closest_spectral_channel(6842*u.AA)
+        # preview: one channel is a single contiguous read
         ima = cube.get_channel(self.z)
         self.y, self.x = np.unravel_index(np.nanargmax(ima, axis=None), ima.shape)
 
         self.imageviewer.wcs = cube.wcs.celestial
-        self.setmode(0)
+        self.imageMode = 0
+        self.imageviewer.label_imagemode.setText(self.imageModes[0])
+        self.imageReady(ima)
         self.imageviewer.wid_image.vb.autoRange(padding=0)
+        if self.timeToFirstPixel is None:
+            self.imageviewer.wid_image.repaint()
+            t = time.perf_counter()
+            self.timeToFirstPixel = t - STARTUP
+            if tracer.enabled:
+                tracer.add('time to first pixel', 'startup', STARTUP, t)
+            self.statusBar().showMessage("First image in %.2f s" % self.timeToFirstPixel, 5000)
         self.imageviewer.posMarker.setPositon(self.x, self.y)
         self.specviewer.updateLabelPos("%d, %d"%(self.x,self.y))
-        self.specviewer.setWavelengts(self.cube.wavelenght)
-        self.specviewer.updateSpec(self.cube.get_1dSpec(self.x, self.y))
+        self.specviewer.setWavelengts(self.cube.spectral_axis)
+        self.specviewer.setErrorsAvailable(cube.variance is not None)
         self.specviewer.setVlineId(self.z)
+        # the spectrum is a strided read of the whole cube: in the background
+        self.requestSpectrum()
 
     #        self.imageviewer.updateImage(ima)
     #        self.imageviewer.setPosMarker(x,y)
 
     def closeEvent(self, *args) -> None:
         super(Window, self).closeEvent(*args)
+        self.queries.shutdown()
         app = QApplication.instance()
         app.closeAllWindows()
 
 
-def run(cube: DataCube = None):
+def run(cube: 'DataCube' = None, ifile=None, extn=1, setup=None):
     signal.signal(signal.SIGINT, __sigint_handler)
 
     app = QApplication(sys.argv)
     window = Window()
+    rec = window.screen().availableGeometry()
+    window.resize(min(1000, rec.width()), min(1000, rec.height()))
 
     s = """
 
@@ -259,12 +519,11 @@ def run(cube: DataCube = None):
     #    apply_stylesheet(app, theme='dark_teal.xml',save_as="ccc.css")
 
     #    window.setWavelenghtUnit("nm")
-    window.setCube(cube)
-
-    rec = window.screen().availableGeometry()
-    w = min(1000, rec.width())
-    h = min(1000, rec.height())
-    window.resize(w, h)
+    if cube is not None:
+        window.cubeOpened(cube, setup=setup)
+    elif ifile is not None:
+        # once the window is on screen
+        QTimer.singleShot(0, partial(window.openCube, ifile, extn, setup))
 
     timer = QTimer()
     timer.start(100)  # You may change this if you wish.
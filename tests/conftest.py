@@ -0,0 +1,57 @@
+import shutil
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+
+def cube_header(nz, ny, nx, extname):
+    h = fits.Header()
+    h['EXTNAME'] = extname
+    h['BUNIT'] = '10**(-20)*erg/(s*cm**2*Angstrom)'
+    h['CTYPE1'] = 'RA---TAN'
+    h['CTYPE2'] = 'DEC--TAN'
+    h['CTYPE3'] = 'AWAV'
+    h['CUNIT1'] = 'deg'
+    h['CUNIT2'] = 'deg'
+    h['CUNIT3'] = 'Angstrom'
+    h['CRPIX1'] = nx / 2
+    h['CRPIX2'] = ny / 2
+    h['CRPIX3'] = 1.
+    h['CRVAL1'] = 150.
+    h['CRVAL2'] = 2.
+    h['CRVAL3'] = 6500.
+    h['CD1_1'] = -5.55555555555556E-05
+    h['CD2_2'] = 5.55555555555556E-05
+    h['CD3_3'] = 1.25
+    return h
+
+
+@pytest.fixture(scope='session')
+def cube_file(tmp_path_factory):
+    """a small (120, 18, 22) cube with an emission line, NaN and a STAT extension"""
+    nz, ny, nx = 120, 18, 22
+    rng = np.random.default_rng(0)
+    wav = 6500 + 1.25 * np.arange(nz)
+    yy, xx = np.mgrid[:ny, :nx]
+    src = 20 * np.exp(-((xx - 8) ** 2 + (yy - 9) ** 2) / 8.)
+    data = 1 + rng.normal(0, 0.1, (nz, ny, nx)) + np.exp(-0.5 * ((wav[:, None, None] - 6570) / 2.5) ** 2) * src
+    data[:, :2, :2] = np.nan
+    data[40:45, 5, 6] = np.nan
+    var = rng.uniform(0.005, 0.02, (nz, ny, nx))
+    path = tmp_path_factory.mktemp('cube') / 'cube.fits'
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.ImageHDU(data.astype('>f4'), header=cube_header(nz, ny, nx, 'DATA')),
+                  fits.ImageHDU(var.astype('>f4'), header=cube_header(nz, ny, nx, 'STAT'))]).writeto(path)
+    return str(path)
+
+
+@pytest.fixture
+def cube(cube_file, tmp_path):
+    """the cube opened from a copy in tmp_path, where its caches are written"""
+    from pyqtcube.DataCube import read
+    path = tmp_path / 'cube.fits'
+    shutil.copy(cube_file, path)
+    cube = read(str(path))
+    yield cube
+    cube.close()
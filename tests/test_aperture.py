@@ -0,0 +1,147 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pyqtcube.Aperture import ApertureEngine, PixelGroups, circular_weights
+from pyqtcube.DataCube import read
+
+from conftest import cube_header
+
+
+@pytest.mark.parametrize('r', [0.5, 1, 2.3, 3, 7.5])
+def test_circular_weights_area(r):
+    w = circular_weights(r)
+    assert w.shape == (2 * int(np.ceil(r)) + 1,) * 2
+    assert np.all((w > -1e-12) & (w < 1 + 1e-12))
+    assert w.sum() == pytest.approx(np.pi * r ** 2, rel=1e-9)
+    assert np.allclose(w, w.T) and np.allclose(w, w[::-1])
+
+
+def test_circular_weights_centres():
+    w = circular_weights(3, exact=False)
+    n = np.arange(-3, 4)
+    assert np.array_equal(w, (n[:, None] ** 2 + n[None, :] ** 2 <= 9).astype(float))
+    assert np.array_equal(circular_weights(0), np.ones((1, 1)))
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(1)
+    d = rng.normal(size=(50, 20, 24))
+    d[3, 5, 5] = np.nan
+    d[4, 10, 10] = np.inf
+    d[:, 0, 0] = np.nan
+    return d
+
+
+def engine(d, exact=True):
+    return ApertureEngine(lambda x1, x2, y1, y2: d[:, y1:y2, x1:x2], d.shape, exact=exact)
+
+
+def brute_force(d, x, y, w):
+    """weighted mean of the valid pixels of d under the weights w centred on (x, y)"""
+    nz, ny, nx = d.shape
+    n = w.shape[0] // 2
+    full = np.zeros((ny, nx))
+    for j in range(-n, n + 1):
+        for i in range(-n, n + 1):
+            if 0 <= y + j < ny and 0 <= x + i < nx:
+                full[y + j, x + i] = w[j + n, i + n]
+    good = np.isfinite(d)
+    return np.where(good, d, 0).reshape(nz, -1) @ full.ravel() / (good.reshape(nz, -1) @ full.ravel())
+
+
+@pytest.mark.parametrize('x, y, r', [(10, 10, 2.5), (5, 5, 1), (0, 0, 3), (23, 19, 4), (12, 1, 7)])
+@pytest.mark.parametrize('exact', [True, False])
+def test_spectrum_matches_brute_force(data, x, y, r, exact):
+    spec = engine(data, exact).spectrum(x, y, r)
+    assert np.allclose(spec, brute_force(data, x, y, circular_weights(r, exact)), equal_nan=True)
+    # NaN and inf pixels are ignored
+    assert np.isfinite(spec).all()
+
+
+def test_annulus(data):
+    e = engine(data)
+    ann = e.annulus_kernel(3, 5)
+    assert ann.sum() == pytest.approx(np.pi * (25 - 9))
+    ref = brute_force(data, 12, 10, circular_weights(2)) - brute_force(data, 12, 10, ann)
+    assert np.allclose(e.spectrum(12, 10, 2, annulus=(3, 5)), ref)
+
+
+def test_kernels_are_cached(data):
+    e = engine(data)
+    assert e.kernel(2.5) is e.kernel(2.5)
+    assert not e.kernel(2.5).flags.writeable
+
+
+@pytest.mark.parametrize('dtype', ['>i2', '>i4'])
+def test_integer_cube(tmp_path, dtype):
+    rng = np.random.default_rng(6)
+    ints = rng.integers(0, 1000, (3, 12, 12)).astype(dtype)
+    spec = []
+    for name, a in [('int', ints), ('float', ints.astype('>f4'))]:
+        path = tmp_path / ('%s.fits' % name)
+        fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(a, header=cube_header(3, 12, 12, 'DATA'))]).writeto(path)
+        cube = read(str(path))
+        assert cube.data.dtype.kind == name[0]
+        spec.append(cube.get_1dSpec(6, 6, r=2.5))
+        cube.close()
+    assert np.allclose(spec[0], spec[1])
+    assert np.allclose(spec[0], brute_force(ints.astype(float), 6, 6, circular_weights(2.5)))
+
+
+def test_pixel_groups_match_aperture_engine(data):
+    nz, ny, nx = data.shape
+    rng = np.random.default_rng(2)
+    x = np.concatenate([[5, 10, 0, nx - 1], rng.integers(0, nx, 40)])
+    y = np.concatenate([[5, 10, 0, ny - 1], rng.integers(0, ny, 40)])
+    r = rng.choice([0, 1, 2.5, 4], len(x))
+    e = engine(data)
+    groups = PixelGroups.circles((ny, nx), x, y, r)
+    means = groups.means(data.reshape(nz, -1))
+    for i in range(len(x)):
+        assert np.allclose(means[i], e.spectrum(x[i], y[i], r[i]), equal_nan=True)
+    # NaN and inf pixels are masked, not propagated
+    assert np.isfinite(means[:2]).all()
+    # (nz, ny, nx) blocks of any dtype are read window by window
+    assert np.allclose(groups.means(data.astype('>f4')), means, rtol=1e-5, equal_nan=True)
+
+
+@pytest.mark.parametrize('tiles', [(1,), (64,)])
+def test_pixel_groups_tiling(data, monkeypatch, tiles):
+    import pyqtcube.Aperture
+    nz, ny, nx = data.shape
+    x, y = [5, 12, 20, 6, 40], [5, 8, 15, 6, 40]
+    ref = PixelGroups.circles((ny, nx), x, y, 3).means(data)
+    monkeypatch.setattr(pyqtcube.Aperture, 'TILES', tiles)
+    groups = PixelGroups.circles((ny, nx), x, y, 3)
+    assert len(groups.windows) == (4 if tiles == (1,) else 1)
+    assert np.allclose(groups.means(data), ref, equal_nan=True)
+    # the aperture outside the image has no pixels
+    assert np.isnan(ref[-1]).all()
+
+
+def test_pixel_groups_labels(data):
+    nz = len(data)
+    labels = np.zeros(data.shape[1:], dtype=int)
+    labels[2:6, 3:9] = 7
+    labels[10:, 12:] = 2
+    labels[0, :] = 5
+    groups = PixelGroups.labels(labels)
+    assert list(groups.values) == [2, 5, 7]
+    means = groups.means(data.reshape(nz, -1))
+    for i, value in enumerate(groups.values):
+        block = data[:, labels == value]
+        good = np.isfinite(block)
+        assert np.allclose(means[i], np.where(good, block, 0).sum(axis=1) / good.sum(axis=1))
+
+
+def test_get_spectra_match_get_1dSpec(cube):
+    x, y, r = [3, 8, 15, 21, 0], [4, 9, 12, 0, 0], [0, 2, 3.5, 1, 1]
+    spectra = cube.get_spectra(x, y, r=r)
+    for i in range(len(x)):
+        assert np.allclose(spectra[i], cube.get_1dSpec(x[i], y[i], r=r[i]), equal_nan=True)
+    labels = np.zeros(cube.shape[1:], dtype=int)
+    labels[5:9, 4:10] = 1
+    block = np.asarray(cube.data[:, 5:9, 4:10], dtype=float)
+    assert np.allclose(cube.get_spectra(labels=labels)[0], np.nanmean(block, axis=(1, 2)), equal_nan=True)
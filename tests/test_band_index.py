@@ -0,0 +1,82 @@
+import astropy.units as u
+import numpy as np
+import pytest
+
+import pyqtcube.Background
+from pyqtcube.BandIndex import CumulativeBandIndex
+
+BANDS = [(6520, 6540), (6510.3, 6531.9), (6600.6, 6601.1), (6540, 6520)]
+
+
+def direct_integral(cube, l1, l2):
+    data = np.asarray(cube.data, dtype=float)
+    i1, i2, w = cube.spectral_axis.band_weights(l1, l2)
+    good = np.isfinite(data[i1:i2])
+    flux = np.einsum('kyx,k->yx', np.where(good, data[i1:i2], 0), w)
+    return np.where(good.any(axis=0), flux, np.nan)
+
+
+@pytest.mark.parametrize('band', BANDS)
+def test_integral_matches_direct_sum(cube, band):
+    index = CumulativeBandIndex(cube.data, cube.spectral_axis.edges).build()
+    assert np.allclose(index.integral(*band), direct_integral(cube, *band), equal_nan=True)
+
+
+def test_integral_of_one_channel(cube):
+    axis = cube.spectral_axis
+    index = CumulativeBandIndex(cube.data, axis.edges).build()
+    e = axis.edges
+    assert np.allclose(index.integral(e[30], e[31]), np.asarray(cube.data[30]) * axis.width[30], equal_nan=True)
+    # half of the channel
+    assert np.allclose(index.integral(e[30], 0.5 * (e[30] + e[31])),
+                       np.asarray(cube.data[30]) * axis.width[30] / 2, equal_nan=True)
+
+
+@pytest.mark.parametrize('band', BANDS)
+def test_band_image_with_and_without_index(cube, band):
+    l1, l2 = (v * u.AA for v in band)
+    direct = cube.get_image_band(l1, l2)
+    cube.build_band_index(cache=False, background=False)
+    assert cube.band_index_ready
+    assert np.allclose(cube.get_image_band(l1, l2), direct, equal_nan=True)
+
+
+def test_band_image_is_mean_flux_density(cube):
+    data = np.asarray(cube.data, dtype=float)
+    # channels 16..31 entirely
+    lam = cube.spectral_axis.values
+    l1, l2 = lam[16] - 0.625, lam[31] + 0.625
+    good = np.isfinite(data[16:32])
+    with np.errstate(invalid='ignore'):
+        ref = np.where(good, data[16:32], 0).sum(axis=0) / good.sum(axis=0)
+    assert np.allclose(cube.get_image_band(l1 * u.AA, l2 * u.AA), ref, equal_nan=True)
+
+
+def test_index_cache_files(cube):
+    index = cube.build_band_index(cache=True, background=False)
+    assert index.ready and index.error is None
+    again = cube.build_band_index(cache=True, background=False)
+    assert np.array_equal(again.integral(6520, 6540), index.integral(6520, 6540), equal_nan=True)
+
+
+def test_index_falls_back_to_memory(cube, tmp_path):
+    cube.filename = str(tmp_path / 'missing' / 'cube.fits')
+    index = cube.build_band_index(cache=True, background=True)
+    index.wait()
+    assert index.ready and not index.failed and isinstance(index.error, OSError)
+
+
+def test_index_too_large_for_memory(cube, tmp_path, monkeypatch):
+    monkeypatch.setattr(pyqtcube.Background, 'MEMORY_FALLBACK_BYTES', index_bytes(cube) - 1)
+    ref = cube.get_image_band(6520 * u.AA, 6540 * u.AA)
+    cube.filename = str(tmp_path / 'missing' / 'cube.fits')
+    index = cube.build_band_index(cache=True, background=True)
+    index.wait()
+    assert index.failed and not cube.band_index_ready and isinstance(index.error, OSError)
+    # band images are summed directly
+    assert np.array_equal(cube.get_image_band(6520 * u.AA, 6540 * u.AA), ref, equal_nan=True)
+
+
+def index_bytes(cube):
+    nz, ny, nx = cube.shape
+    return (nz + 1) * ny * nx * (8 + 2)
@@ -0,0 +1,64 @@
+import json
+
+import astropy.units as u
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pyqtcube.Batch import run_batch, run_jobfile
+from pyqtcube.DataCube import DataCube
+
+JOBS = [
+    {"type": "band", "name": "ha", "band": [6560.3, 6580.9]},
+    {"type": "continuum_subtracted", "name": "ha_net",
+     "line": [6560, 6580], "blue": [6510, 6525], "red": [6610, 6630]},
+    {"type": "spectra", "name": "sources", "positions": [[8, 9], [3, 4], [20, 1]], "r": [2, 0, 3]},
+]
+
+
+def quantity(band):
+    return tuple(v * u.AA for v in band)
+
+
+def check_results(cube, results):
+    assert np.allclose(results['ha'], cube.get_image_band(*quantity(JOBS[0]['band'])), equal_nan=True)
+    net = cube.get_image_continuum_subtracted(*(quantity(JOBS[1][k]) for k in ('line', 'blue', 'red')))
+    assert np.allclose(results['ha_net'], net, equal_nan=True)
+    xy = np.array(JOBS[2]['positions'])
+    assert np.allclose(results['sources'], cube.get_spectra(xy[:, 0], xy[:, 1], r=JOBS[2]['r']), equal_nan=True)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_batch_matches_accessors(cube, tmp_path, workers):
+    results = run_batch(JOBS, ifile=cube.filename, output_dir=str(tmp_path), workers=workers)
+    check_results(cube, results)
+
+    with fits.open(tmp_path / 'sources.fits') as hdul:
+        h = hdul[0].header
+        assert h['WCSAXES'] == 2 and hdul[0].data.shape == (3, cube.shape[0])
+        assert u.Unit(h['BUNIT'], format='fits') == cube.unit
+        assert len(hdul['SOURCES'].data) == 3
+    with fits.open(tmp_path / 'ha.fits') as hdul:
+        assert np.allclose(hdul[0].data, results['ha'], equal_nan=True)
+        assert hdul[0].header['CTYPE1'] == 'RA---TAN'
+
+
+def test_batch_in_memory_cube(cube):
+    memory = DataCube(np.array(cube.data), cube.header)
+    check_results(cube, run_batch(JOBS, cube=memory, workers=2))
+
+
+def test_batch_in_blocks(cube, monkeypatch):
+    import pyqtcube.Batch
+    nz, ny, nx = cube.shape
+    monkeypatch.setattr(pyqtcube.Batch, 'CHUNK_BYTES', 7 * ny * nx * 4)
+    check_results(cube, run_batch(JOBS, cube=cube, workers=1))
+
+
+def test_jobfile(cube, tmp_path):
+    jobfile = tmp_path / 'jobs.json'
+    jobfile.write_text(json.dumps({"cube": cube.filename, "unit": "nm", "output_dir": str(tmp_path / 'out'),
+                                   "jobs": [{"type": "band", "name": "ha", "band": [656.03, 658.09]}]}))
+    results = run_jobfile(str(jobfile), workers=1)
+    assert np.allclose(results['ha'], cube.get_image_band(*quantity(JOBS[0]['band'])), equal_nan=True)
+    assert (tmp_path / 'out' / 'ha.fits').exists()
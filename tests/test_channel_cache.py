@@ -0,0 +1,123 @@
+import gc
+import time
+
+import numpy as np
+import pytest
+
+from pyqtcube.ChannelCache import ChannelCache
+
+
+class Loader:
+    """channel i is a (4, 8) float64 image (256 bytes) filled with i"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, i):
+        self.calls.append(i)
+        return np.full((4, 8), float(i))
+
+
+@pytest.fixture
+def loader():
+    return Loader()
+
+
+def make_cache(loader, nimages, prefetch=0, nchan=100):
+    return ChannelCache(loader, nchan, max_bytes=nimages * 256, prefetch=prefetch)
+
+
+def test_hits_and_misses(loader):
+    cache = make_cache(loader, 4)
+    assert cache.get(3)[0, 0] == 3
+    cache.get(3)
+    cache.get(5)
+    cache.get(3)
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert loader.calls == [3, 5]
+    assert cache.stats == dict(hits=2, misses=2, size=2, nbytes=512)
+    cache.close()
+
+
+def test_lru_eviction_order(loader):
+    cache = make_cache(loader, 3)
+    for i in (1, 2, 3):
+        cache.get(i)
+    # 1 becomes the most recently used: 2 is evicted first
+    cache.get(1)
+    cache.get(4)
+    assert 2 not in cache and all(i in cache for i in (1, 3, 4))
+    cache.get(5)
+    assert 3 not in cache and all(i in cache for i in (1, 4, 5))
+    cache.close()
+
+
+def test_byte_limit(loader):
+    cache = make_cache(loader, 3)
+    for i in range(10):
+        cache.get(i)
+        assert cache.nbytes <= cache.max_bytes
+    assert len(cache) == 3 and cache.nbytes == 3 * 256
+    # an image larger than the cache is returned but not kept
+    small = ChannelCache(loader, 10, max_bytes=100, prefetch=0)
+    assert small.get(2).shape == (4, 8) and len(small) == 0 and small.nbytes == 0
+    cache.close()
+    small.close()
+
+
+def test_images_are_read_only(loader):
+    cache = make_cache(loader, 3)
+    ima = cache.get(1)
+    with pytest.raises(ValueError):
+        ima[0, 0] = 0
+    assert cache.get(1) is ima
+    cache.close()
+
+
+def test_get_channel_is_read_only(cube):
+    ima = cube.get_channel(10)
+    assert np.array_equal(ima, np.asarray(cube.data[10]), equal_nan=True)
+    assert not ima.flags.writeable
+    with pytest.raises(ValueError):
+        ima += 1
+    # a writable copy is one np.array away
+    np.array(ima)[0, 0] = 0
+
+
+def wait_for(condition, timeout=5.):
+    t0 = time.perf_counter()
+    while not condition():
+        assert time.perf_counter() - t0 < timeout
+        time.sleep(0.005)
+
+
+def test_prefetch_follows_the_direction(loader):
+    cache = make_cache(loader, 16, prefetch=3)
+    cache.get(10)
+    wait_for(lambda: all(i in cache for i in (11, 12, 13)))
+    cache.get(9)
+    wait_for(lambda: all(i in cache for i in (8, 7, 6)))
+    hits = cache.hits
+    cache.get(8)
+    assert cache.hits == hits + 1
+    # the prefetch stops at the ends of the cube
+    cache.get(1)
+    wait_for(lambda: 0 in cache)
+    assert -1 not in loader.calls
+    cache.close()
+    assert cache.closed and len(cache) == 0
+
+
+def test_cache_does_not_keep_its_owner(loader):
+    class Owner:
+        def read(self, i):
+            return loader(i)
+
+    owner = Owner()
+    cache = ChannelCache(owner.read, 10, prefetch=2)
+    cache.get(1)
+    del owner
+    gc.collect()
+    with pytest.raises(ReferenceError):
+        cache.get(5)
+    cache.close()
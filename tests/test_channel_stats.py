@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+from astropy.visualization import ZScaleInterval
+
+import pyqtcube.ChannelStats
+from pyqtcube.ChannelStats import PERCENTILES, ChannelStatistics, sampled_zscale
+
+# channel 5 is all NaN
+pytestmark = pytest.mark.filterwarnings('ignore:All-NaN slice')
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(7)
+    d = rng.normal(size=(12, 30, 40)) * np.arange(1, 13)[:, None, None]
+    d[2, :5] = np.nan
+    d[5] = np.nan
+    return d.astype(np.float32)
+
+
+def test_channel_statistics(data):
+    stats = ChannelStatistics(data, nsample=500).build()
+    assert stats.ready and stats.progress == 1
+    flat = data.reshape(len(data), -1)
+    sub = flat[:, stats.sample_idx]
+    assert len(stats.sample_idx) == 500 and np.all(np.diff(stats.sample_idx) > 0)
+    assert np.array_equal(stats.nnan, np.isnan(flat).sum(axis=1))
+    with np.errstate(invalid='ignore'):
+        assert np.array_equal(stats.min, np.nanmin(flat, axis=1), equal_nan=True)
+        assert np.array_equal(stats.max, np.nanmax(flat, axis=1), equal_nan=True)
+        ref = np.nanpercentile(sub, PERCENTILES, axis=1).T
+    assert np.allclose(stats.percentiles, ref, equal_nan=True)
+
+
+def test_zscale_limits(data):
+    stats = ChannelStatistics(data, nsample=500).build()
+    sub = data.reshape(len(data), -1)[:, stats.sample_idx]
+    interval = ZScaleInterval()
+    for k in range(len(data)):
+        if k == 5:
+            assert stats.levels(k) is None
+            continue
+        assert np.allclose(stats.levels(k), interval.get_limits(sub[k]))
+    assert np.allclose(stats.global_levels, interval.get_limits(sub), rtol=1e-5)
+
+
+def test_levels_before_build(data):
+    stats = ChannelStatistics(data)
+    assert stats.levels(0) is None
+    stats.build_in_background().wait()
+    assert stats.ready and stats.levels(0) is not None
+
+
+def test_blocks_of_channels(data, monkeypatch):
+    ref = ChannelStatistics(data, nsample=500).build()
+    monkeypatch.setattr(pyqtcube.ChannelStats, 'CHUNK_BYTES', 5 * data[0].nbytes)
+    stats = ChannelStatistics(data, nsample=500).build()
+    assert np.array_equal(stats.zscale, ref.zscale, equal_nan=True)
+    assert stats.global_levels == ref.global_levels
+
+
+def test_failed_build():
+    stats = ChannelStatistics(np.zeros((2, 3, 4), dtype=[('a', 'f4')]))
+    stats.build_in_background().wait()
+    assert stats.failed and not stats.ready and stats.error is not None
+
+
+def test_sampled_zscale(data):
+    ima = np.nan_to_num(data[3])
+    assert np.allclose(sampled_zscale(ima, nmax=ima.size), ZScaleInterval().get_limits(ima))
+    assert np.allclose(sampled_zscale(ima, nmax=300), ZScaleInterval().get_limits(ima[::2, ::2]))
+
+
+def test_cube_levels(cube):
+    assert cube.channel_levels(3) is None and cube.global_levels() is None
+    cube.build_channel_stats(background=False)
+    assert cube.channel_levels(3) == cube.channel_stats.levels(3)
+    assert cube.global_levels() == cube.channel_stats.global_levels
@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+import pytest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+from pyqtcube.Decimation import DecimatedCurveItem, minmax_decimate  # noqa: E402
+
+
+def buckets(n, nbins):
+    k = int(np.ceil(n / nbins))
+    return [slice(i, min(i + k, n)) for i in range(0, n, k)]
+
+
+@pytest.mark.parametrize('n, nbins', [(10000, 300), (10001, 300), (999, 100), (5000, 7)])
+def test_min_and_max_of_every_bucket(n, nbins):
+    rng = np.random.default_rng(13)
+    x = np.linspace(4750, 9350, n)
+    y = rng.normal(size=n).cumsum()
+    xd, yd = minmax_decimate(x, y, nbins)
+    assert len(xd) <= 2 * nbins
+    assert np.all(np.diff(xd) >= 0)
+    for b, (i, j) in zip(buckets(n, nbins), zip(range(0, len(xd), 2), range(1, len(xd), 2))):
+        assert {yd[i], yd[j]} == {y[b].min(), y[b].max()}
+        assert xd[i] <= xd[j] and b.start <= np.searchsorted(x, xd[i]) < b.stop
+    # the peaks are kept
+    assert yd.max() == y.max() and yd.min() == y.min()
+
+
+def test_short_input_is_unchanged():
+    x = np.arange(50.)
+    y = np.sin(x)
+    for nbins in (50, 25, 100):
+        xd, yd = minmax_decimate(x, y, nbins)
+        assert xd is x and yd is y
+
+
+def test_nan():
+    x = np.arange(100.)
+    y = np.arange(100.)
+    y[3] = np.nan
+    y[20:30] = np.nan
+    xd, yd = minmax_decimate(x, y, 10)
+    assert len(xd) == 20
+    # NaN samples are skipped, all-NaN buckets give NaN points
+    assert (yd[0], yd[1]) == (0, 9)
+    assert np.isnan(yd[4:6]).all()
+    assert np.isfinite(np.delete(yd, [4, 5])).all()
+    assert np.all(np.diff(xd) >= 0)
+
+
+def test_curve_item_descending_x():
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication([])  # noqa: F841
+    x = np.linspace(9000, 5000, 5000)
+    y = np.random.default_rng(14).normal(size=5000)
+    item = DecimatedCurveItem()
+    item.setData(x, y)
+    assert np.array_equal(item.xFull, x[::-1]) and np.array_equal(item.yFull, y[::-1])
+    assert item.dataBounds(0) == (5000, 9000)
+    assert item.dataBounds(1) == (y.min(), y.max())
@@ -0,0 +1,67 @@
+import astropy.units as u
+import numpy as np
+import pytest
+from astropy.coordinates import Angle, SkyCoord
+from astropy.wcs import WCS
+
+from pyqtcube.FastWcs import SkyGrid, sexagesimal
+
+
+def tan_wcs(ra, dec, scale=0.2 / 3600):
+    w = WCS(naxis=2)
+    w.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    w.wcs.crval = [ra, dec]
+    w.wcs.crpix = [150, 160]
+    w.wcs.cdelt = [-scale, scale]
+    return w
+
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    return SkyCoord(ra1, dec1, unit='deg').separation(SkyCoord(ra2, dec2, unit='deg')).to_value(u.arcsec)
+
+
+@pytest.mark.parametrize('ra, dec', [(150.1, 2.2), (0.005, -30), (359.99, 45), (12, 89.99)])
+def test_sky_grid(ra, dec):
+    shape = (320, 300)
+    w = tan_wcs(ra, dec)
+    grid = SkyGrid(w, shape)
+    rng = np.random.default_rng(8)
+    # random positions, the corners and the edges of the image
+    xs = np.concatenate([rng.uniform(-0.5, 299.5, 100), [0, 299, 0, 299, 299.49, 150]])
+    ys = np.concatenate([rng.uniform(-0.5, 319.5, 100), [0, 0, 319, 319, 160, 319.49]])
+    for x, y in zip(xs, ys):
+        r, d = grid.radec(x, y)
+        r0, d0 = w.pixel_to_world_values(x, y)
+        assert 0 <= r < 360
+        assert angular_separation(r, d, r0, d0) < 1e-6
+
+
+def test_sky_grid_across_ra_zero():
+    w = tan_wcs(0.005, 10)
+    grid = SkyGrid(w, (320, 300))
+    ras = [grid.radec(x, 160)[0] for x in range(300)]
+    # the field crosses RA=0: both sides are present, in [0, 360)
+    assert max(ras) > 359.9 and min(ras) < 0.1
+    assert all(0 <= r < 360 for r in ras)
+
+
+@pytest.mark.parametrize('deg', [0, 1e-7, 15.123456789, 123.4567891, 359.99999999, 359.9999999999, 211.8])
+def test_sexagesimal_hours(deg):
+    ref = Angle(deg, u.deg).to_string(unit='hourangle', sep=':', precision=4)
+    assert sexagesimal(deg / 15, precision=4) == ref
+
+
+@pytest.mark.parametrize('deg', [0, -0.00001, 2.5, -20, -20.0000001, 45.999999999, -89.123456, 89.99999999])
+def test_sexagesimal_degrees(deg):
+    ref = Angle(deg, u.deg).to_string(unit='deg', sep=':', precision=4, alwayssign=True)
+    assert sexagesimal(deg, precision=4, alwayssign=True) == ref
+
+
+def test_sexagesimal_matches_skycoord():
+    rng = np.random.default_rng(9)
+    for ra, dec in zip(rng.uniform(0, 360, 200), rng.uniform(-90, 90, 200)):
+        coo = SkyCoord(ra, dec, unit='deg')
+        assert sexagesimal(ra / 15) == coo.ra.to_string(unit='hourangle', sep=':', precision=4)
+        assert sexagesimal(dec, alwayssign=True) == coo.dec.to_string(unit='deg', sep=':', precision=4,
+                                                                       alwayssign=True)
+    assert sexagesimal(2.5, precision=0) == Angle(2.5, u.hourangle).to_string(sep=':', precision=0)
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+import pytest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+from pyqtcube.ImageRender import ImagePyramid  # noqa: E402
+
+
+def test_level_shapes():
+    pyramid = ImagePyramid(np.zeros((150, 301)), min_size=32)
+    assert len(pyramid) == 1
+    assert pyramid.nlevels() == 5
+    shapes = [pyramid.level(k).shape for k in range(pyramid.nlevels())]
+    assert shapes == [(150, 301), (75, 151), (38, 76), (19, 38), (10, 19)]
+    # levels are computed on demand and clipped to the available ones
+    assert len(pyramid) == 5
+    assert pyramid.level(10).shape == (10, 19) and pyramid.level(-1).shape == (150, 301)
+
+
+def test_small_image_has_one_level():
+    pyramid = ImagePyramid(np.ones((20, 30)))
+    assert pyramid.nlevels() == 1 and pyramid.level(3).shape == (20, 30)
+
+
+def test_block_means():
+    rng = np.random.default_rng(10)
+    a = rng.normal(size=(64, 96))
+    pyramid = ImagePyramid(a, min_size=8)
+    for k in range(1, 4):
+        n = 2 ** k
+        ref = a.reshape(64 // n, n, 96 // n, n).mean(axis=(1, 3))
+        assert np.allclose(pyramid.level(k), ref)
+
+
+def test_nan_handling():
+    a = np.arange(36, dtype=float).reshape(6, 6)
+    a[0, 0] = np.nan
+    a[2:4, 2:4] = np.nan
+    a[4, 5] = np.inf
+    pyramid = ImagePyramid(a, min_size=1)
+    lev = pyramid.level(1)
+    # the mean of the valid pixels of each block
+    assert lev[0, 0] == pytest.approx(np.mean([1, 6, 7]))
+    assert np.isnan(lev[1, 1])
+    assert lev[2, 2] == pytest.approx(np.mean([28, 34, 35]))
+    assert lev[0, 1] == np.mean(a[:2, 2:4])
+    # odd sizes: the padding is not counted
+    lev2 = pyramid.level(2)
+    assert lev2.shape == (2, 2)
+    assert lev2[1, 1] == pytest.approx(lev[2, 2])
+    assert np.isfinite(lev2).all()
+
+
+@pytest.mark.parametrize('factor, level', [(0.25, 0), (1, 0), (1.9, 0), (2, 1), (3.9, 1), (4, 2), (7, 2),
+                                           (8, 3), (1000, 4)])
+def test_level_for(factor, level):
+    pyramid = ImagePyramid(np.zeros((300, 512)), min_size=32)
+    assert pyramid.nlevels() == 5
+    assert pyramid.level_for(factor) == level
+
+
+def test_level_for_nan_factor():
+    assert ImagePyramid(np.zeros((300, 512))).level_for(np.nan) == 0
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pyqtcube.DataCube import DataCube, read
+from pyqtcube.LineFit import fit_spectra, vel_c
+
+from conftest import cube_header
+
+REST = np.array([6548.05, 6562.80, 6583.45])
+Z = 0.01
+
+
+def line_data(ny=6, nx=5, seed=12):
+    """Halpha and [NII] of known velocity and dispersion, with noise"""
+    nz = 200
+    rng = np.random.default_rng(seed)
+    wav = 6500 + 1.25 * np.arange(nz)
+    vel = rng.uniform(-150, 150, (ny, nx))
+    disp = rng.uniform(50, 120, (ny, nx))
+    amp = rng.uniform(5, 10, (ny, nx))
+    data = np.full((nz, ny, nx), 1.)
+    for rest, ratio in zip(REST, (0.1, 1, 0.3)):
+        mu = rest * (1 + Z) * (1 + vel / vel_c)
+        sigma = rest * (1 + Z) * disp / vel_c
+        data += ratio * amp * np.exp(-0.5 * ((wav[:, None, None] - mu) / sigma) ** 2)
+    data += rng.normal(0, 0.05, data.shape)
+    return data, vel, disp
+
+
+def test_fit_spectra():
+    data, vel, disp = line_data()
+    lam = 6500 + 1.25 * np.arange(len(data))
+    p, chi2 = fit_spectra(lam, data.reshape(len(data), -1), REST, Z)
+    assert np.median(np.abs(p[:, 1] - vel.ravel())) < 1
+    assert np.median(np.abs(p[:, 2] - disp.ravel())) < 1
+    assert np.allclose(p[:, 0], 1, atol=0.02)
+
+
+@pytest.mark.parametrize('from_file', [False, True])
+def test_fit_cube(tmp_path, from_file):
+    data, vel, disp = line_data()
+    nz, ny, nx = data.shape
+    data[:, 0, 0] = np.nan
+    header = cube_header(nz, ny, nx, 'DATA')
+    if from_file:
+        path = tmp_path / 'lines.fits'
+        fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data.astype('>f4'), header=header)]).writeto(path)
+        cube = read(str(path))
+    else:
+        cube = DataCube(data, header)
+    fractions = []
+    maps = cube.fit_lines(REST, Z, workers=2, progress=fractions.append)
+    good = np.ones((ny, nx), dtype=bool)
+    good[0, 0] = False
+    assert np.median(np.abs(maps['velocity'] - vel)[good]) < 1
+    assert np.median(np.abs(maps['sigma'] - disp)[good]) < 1
+    assert np.isnan(maps['velocity'][0, 0])
+    assert maps['flux'].shape == (3, ny, nx)
+    # [NII] 6583 / Halpha
+    assert np.allclose(np.median((maps['flux'][2] / maps['flux'][1])[good]), 0.3 * 6583.45 / 6562.80, rtol=0.02)
+    assert fractions and fractions[-1] == 1
+    cube.close()
@@ -0,0 +1,66 @@
+import os
+
+import numpy as np
+import pytest
+
+from pyqtcube.RestFrameRefLines import DEFAULT_LINELIST, LINE_DTYPE, LineList
+
+
+@pytest.fixture
+def lines():
+    records = [(6583.45, 6585.27, '[NII]', True), (4861.33, 4862.68, 'Hb', True),
+               (6562.80, 6564.61, 'Ha', True), (6548.05, 6549.86, '[NII]', False),
+               (5006.84, 5008.24, '[OIII]', True), (6562.80, 6564.61, 'Ha2', False)]
+    return LineList(np.array(records, dtype=LINE_DTYPE))
+
+
+def test_sorted(lines):
+    assert np.all(np.diff(lines.air) >= 0)
+    # stable: equal wavelengths keep their order
+    assert list(lines.labels[3:5]) == ['Ha', 'Ha2']
+
+
+def test_index_range(lines):
+    assert lines.index_range(4000, 9000) == (0, 6)
+    assert lines.index_range(6500, 6570) == (2, 5)
+    # the limits are included
+    assert lines.index_range(6548.05, 6583.45) == (2, 6)
+    assert lines.index_range(6548.06, 6583.44) == (3, 5)
+    assert lines.index_range(6562.80, 6562.80) == (3, 5)
+
+
+def test_index_range_redshift(lines):
+    z = 0.1
+    assert lines.index_range(6562.80 * (1 + z), 6583.45 * (1 + z), z=z) == (3, 6)
+    assert lines.index_range(6500, 6600, z=z) == (2, 2)
+
+
+def test_empty_result(lines):
+    assert lines.index_range(3000, 4000) == (0, 0)
+    assert lines.index_range(9000, 9500) == (6, 6)
+    assert lines.index_range(5100, 6500) == (2, 2)
+    out = lines.query(5100, 6500)
+    assert len(out) == 0 and out.dtype == LINE_DTYPE
+    assert len(lines.query(6500, 6600, names=['Hb'])) == 0
+
+
+def test_query(lines):
+    out = lines.query(6540, 6590)
+    assert list(out['label']) == ['[NII]', 'Ha', 'Ha2', '[NII]']
+    assert list(lines.query(6540, 6590, visible=True)['label']) == ['Ha', '[NII]']
+    assert list(lines.query(6540, 6590, names=['[NII]'])['air']) == [6548.05, 6583.45]
+    assert list(lines.query(6540, 6590, names=('Ha', '[NII]'), visible=True)['air']) == [6562.80, 6583.45]
+    z = 0.05
+    assert list(lines.query(4861.33 * (1 + z), 5006.84 * (1 + z), z=z)['label']) == ['Hb', '[OIII]']
+
+
+def test_read_ecsv():
+    lines = LineList.read(os.path.join(os.path.dirname(DEFAULT_LINELIST), 'linelist_air.ecsv'))
+    assert len(lines) > 0 and np.all(np.diff(lines.air) >= 0) and np.isnan(lines[0]['vacuum'])
+
+
+def test_read_default_list():
+    lines = LineList.read()
+    assert len(lines) > 10 and np.all(np.diff(lines.air) >= 0)
+    ha = lines.query(6560, 6565, names=['Ha'])
+    assert len(ha) == 1
@@ -0,0 +1,83 @@
+import astropy.units as u
+import numpy as np
+import pytest
+
+from pyqtcube.DataCube import DataCube
+from pyqtcube.Moments import moment_maps, vel_c
+
+from conftest import cube_header
+
+REST = 6562.8
+
+
+@pytest.fixture(scope='module')
+def line_cube():
+    """Gaussian lines of known flux, velocity and dispersion on a constant continuum"""
+    nz, ny, nx = 240, 6, 7
+    rng = np.random.default_rng(11)
+    wav = 6500 + 1.25 * np.arange(nz)
+    flux = rng.uniform(20, 80, (ny, nx))
+    vel = rng.uniform(-300, 300, (ny, nx))
+    disp = rng.uniform(60, 150, (ny, nx))
+    centre = REST * (1 + vel / vel_c)
+    sigma = REST * disp / vel_c
+    data = 2. + flux / (np.sqrt(2 * np.pi) * sigma) * \
+        np.exp(-0.5 * ((wav[:, None, None] - centre) / sigma) ** 2)
+    data[100, 0, 0] = np.nan
+    return DataCube(data, cube_header(nz, ny, nx, 'DATA')), flux, vel, disp
+
+
+def band(l1, l2):
+    return l1 * u.AA, l2 * u.AA
+
+
+def test_recovers_the_injected_line(line_cube):
+    cube, flux, vel, disp = line_cube
+    m0, m1, m2 = cube.get_moments(*band(REST - 30, REST + 30), lam_ref=REST * u.AA,
+                                  blue=band(6510, 6520), red=band(6620, 6640))
+    good = np.ones(flux.shape, dtype=bool)
+    good[0, 0] = False
+    assert np.allclose(m0[good], flux[good], rtol=2e-3)
+    assert np.abs(m1 - vel)[good].max() < 1.
+    assert np.abs(m2 - disp)[good].max() < 1.
+    # the NaN channel is skipped
+    assert np.isfinite([m0[0, 0], m1[0, 0], m2[0, 0]]).all()
+
+
+def test_velocities_relative_to_the_band_centre(line_cube):
+    cube, flux, vel, disp = line_cube
+    m1 = cube.get_moment(1, *band(REST - 30, REST + 30), blue=band(6510, 6520), red=band(6620, 6640))
+    ref = cube.get_moment(1, *band(REST - 30, REST + 30), lam_ref=REST * u.AA,
+                          blue=band(6510, 6520), red=band(6620, 6640))
+    # relative to REST: the velocity of the band centre is 0
+    assert np.allclose(m1, ref)
+
+
+@pytest.mark.parametrize('l1, l2', [(6540, 6580), (6540.3, 6581.9), (6581.9, 6540.3), (6560.1, 6560.9)])
+def test_moment0_matches_band_image(line_cube, l1, l2):
+    cube, flux, vel, disp = line_cube
+    m0 = cube.get_moment(0, *band(l1, l2))
+    assert np.allclose(m0, cube.get_image_band(*band(l1, l2)) * (l2 - l1), equal_nan=True)
+    blue, red = band(6510, 6520), band(6620, 6640)
+    lo, hi = sorted([l1, l2])
+    net = cube.get_image_continuum_subtracted(band(lo, hi), blue, red)
+    assert np.allclose(cube.get_moment(0, *band(lo, hi), blue=blue, red=red), net * (hi - lo))
+
+
+def test_moment_maps_in_blocks(line_cube, monkeypatch):
+    import pyqtcube.Moments
+    cube, flux, vel, disp = line_cube
+    wav = cube.spectral_axis.values
+    widths = cube.spectral_axis.width[20:120]
+    ref = moment_maps(cube.data, wav, widths, 20, 120, REST, workers=1)
+    monkeypatch.setattr(pyqtcube.Moments, 'CHUNK_BYTES', 100 * 7 * 8)
+    out = moment_maps(cube.data, wav, widths, 20, 120, REST, workers=3)
+    for a, b in zip(ref, out):
+        assert np.allclose(a, b)
+
+
+def test_moments_are_cached(line_cube):
+    cube = line_cube[0]
+    maps = cube.get_moments(*band(6550, 6570))
+    assert cube.get_moments(655 * u.nm, 657 * u.nm) is maps
+    assert cube.get_moments(*band(6550, 6570)) is maps
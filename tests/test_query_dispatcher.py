@@ -0,0 +1,90 @@
+import os
+import threading
+
+import pytest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+from PyQt5.QtWidgets import QApplication  # noqa: E402
+
+from pyqtcube.QueryDispatcher import QueryDispatcher  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def app():
+    return QApplication.instance() or QApplication([])
+
+
+@pytest.fixture
+def dispatcher(app):
+    d = QueryDispatcher(max_workers=2)
+    yield d
+    d.shutdown()
+
+
+def test_result_is_delivered(dispatcher):
+    results, busy = [], []
+    dispatcher.sigBusy.connect(busy.append)
+    dispatcher.submit('image', lambda: 42, results.append)
+    assert dispatcher.busy
+    dispatcher.waitForDone()
+    assert results == [42] and busy == [True, False] and not dispatcher.busy
+
+
+def test_superseded_result_is_dropped(dispatcher):
+    started, release = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return 'old'
+
+    results = []
+    first = dispatcher.submit('image', slow, results.append)
+    started.wait(5)
+    dispatcher.submit('image', lambda: 'new', results.append)
+    release.set()
+    dispatcher.waitForDone()
+    first.result(5)
+    QApplication.processEvents()
+    assert results == ['new']
+
+
+def test_superseded_query_is_cancelled_before_it_starts(app):
+    dispatcher = QueryDispatcher(max_workers=1)
+    release = threading.Event()
+    calls, results = [], []
+    dispatcher.submit('spectrum', lambda: release.wait(5), results.append)
+    queued = dispatcher.submit('image', lambda: calls.append('old'), results.append)
+    dispatcher.submit('image', lambda: 'new', results.append)
+    release.set()
+    dispatcher.waitForDone()
+    assert queued.cancelled() and calls == []
+    assert results == [True, 'new']
+    dispatcher.shutdown()
+
+
+def test_targets_are_independent(dispatcher):
+    results = []
+    dispatcher.submit('image', lambda: 'image', results.append)
+    dispatcher.submit('spectrum', lambda: 'spectrum', results.append)
+    dispatcher.waitForDone()
+    assert sorted(results) == ['image', 'spectrum']
+
+
+def test_error_is_reported(dispatcher):
+    def fail():
+        raise ValueError("no variance attached to the cube")
+
+    results, errors = [], []
+    dispatcher.submit('image', fail, results.append, errors.append)
+    dispatcher.waitForDone()
+    assert results == [] and len(errors) == 1 and isinstance(errors[0], ValueError)
+
+
+def test_error_without_errback_is_printed(dispatcher, capsys):
+    def fail():
+        raise ValueError("bad band")
+
+    dispatcher.submit('image', fail, lambda result: None)
+    dispatcher.waitForDone()
+    assert "ValueError: bad band" in capsys.readouterr().err
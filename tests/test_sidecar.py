@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+
+import pyqtcube.Background
+from pyqtcube.SpecSidecar import SpectrumSidecar
+
+
+def test_sidecar_layout(cube):
+    sidecar = SpectrumSidecar(cube.data).build()
+    data = np.asarray(cube.data)
+    assert sidecar.ready and sidecar.shape == data.shape[1:] + data.shape[:1]
+    assert np.array_equal(sidecar.spectrum(7, 3), data[:, 3, 7], equal_nan=True)
+    assert np.array_equal(sidecar.block(2, 9, 4, 6), data[:, 4:6, 2:9], equal_nan=True)
+
+
+def test_sidecar_cache_file(cube):
+    path = SpectrumSidecar.default_path(cube.filename, cube.extn)
+    SpectrumSidecar(cube.data, path=path, source=cube.filename).build()
+    mtime = os.path.getmtime(path)
+    sidecar = SpectrumSidecar(cube.data, path=path, source=cube.filename).build()
+    # reused, not written again
+    assert os.path.getmtime(path) == mtime and not os.path.exists(path + ".tmp")
+    assert np.array_equal(sidecar.spectrum(5, 6), np.asarray(cube.data[:, 6, 5]), equal_nan=True)
+
+
+def test_sidecar_spectra(cube):
+    ref = [cube.get_1dSpec(8, 9, r=r, variance=True) for r in (0, 3)]
+    cube.build_spectrum_sidecar(cache=False, background=False)
+    assert cube.sidecar.ready and cube.variance_sidecar.ready
+    for r, (s, v) in zip((0, 3), ref):
+        s2, v2 = cube.get_1dSpec(8, 9, r=r, variance=True)
+        assert np.allclose(s, s2, equal_nan=True) and np.allclose(v, v2, equal_nan=True)
+
+
+def test_sidecar_falls_back_to_memory(cube, tmp_path):
+    cube.filename = str(tmp_path / 'missing' / 'cube.fits')
+    sidecar = cube.build_spectrum_sidecar(cache=True, background=True)
+    sidecar.wait()
+    assert sidecar.ready and not sidecar.failed and isinstance(sidecar.error, OSError)
+
+
+def test_sidecar_too_large_for_memory(cube, tmp_path, monkeypatch):
+    monkeypatch.setattr(pyqtcube.Background, 'MEMORY_FALLBACK_BYTES', 1000)
+    ref = cube.get_1dSpec(8, 9, variance=True)
+    cube.filename = str(tmp_path / 'missing' / 'cube.fits')
+    sidecar = cube.build_spectrum_sidecar(cache=True, background=True)
+    sidecar.wait()
+    cube.variance_sidecar.wait()
+    assert sidecar.failed and not sidecar.ready and isinstance(sidecar.error, OSError)
+    assert cube.variance_sidecar.failed
+    # the spectra are still read from the cube
+    for a, b in zip(ref, cube.get_1dSpec(8, 9, variance=True)):
+        assert np.array_equal(a, b, equal_nan=True)
@@ -0,0 +1,82 @@
+import os
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from astropy.convolution import Gaussian1DKernel, convolve
+
+import pyqtcube.DataCube
+from pyqtcube.Smoothing import gaussian_smooth_axis
+
+
+@pytest.fixture
+def spectra():
+    rng = np.random.default_rng(4)
+    a = rng.normal(size=(30, 200))
+    a[3, 50:53] = np.nan
+    a[7, 0] = np.nan
+    return a
+
+
+@pytest.mark.parametrize('method', ['auto', 'direct', 'fft'])
+@pytest.mark.parametrize('sigma', [1, 3, 5])
+def test_gaussian_smooth_axis(spectra, sigma, method):
+    out = gaussian_smooth_axis(spectra, sigma, axis=1, method=method)
+    for spec, smoothed in zip(spectra, out):
+        assert np.allclose(smoothed, convolve(spec, Gaussian1DKernel(sigma)), equal_nan=True)
+    assert np.allclose(gaussian_smooth_axis(spectra.T, sigma, axis=0, method=method), out.T, equal_nan=True)
+
+
+def test_smoothed_cube(cube):
+    smoothed = cube.smoothed(2, cache=False)
+    assert smoothed.shape == cube.shape and smoothed.header is cube.header
+    ref = gaussian_smooth_axis(np.asarray(cube.data, dtype=float), 2, axis=0)
+    assert np.allclose(smoothed.data, ref, equal_nan=True, atol=1e-5)
+    assert cube.smoothed(2, cache=False) is smoothed
+
+
+def test_smoothed_cube_in_blocks(cube, monkeypatch):
+    ref = cube.smoothed(1.5, cache=False).data
+    cube.clear_caches()
+    monkeypatch.setattr(pyqtcube.DataCube, 'CHUNK_BYTES', 3 * cube.shape[0] * cube.shape[2] * 8)
+    out = cube.smoothed(1.5, cache=False, workers=3)
+    assert np.array_equal(out.data, ref, equal_nan=True)
+
+
+def test_smoothed_cache_file(cube):
+    cube.smoothed(2)
+    path = "%s.%d.smooth2.npy" % (cube.filename, cube.extn)
+    assert os.path.isfile(path)
+    assert not [f for f in os.listdir(os.path.dirname(path)) if f.endswith('.tmp')]
+    cube.clear_caches()
+    mtime = os.path.getmtime(path)
+    assert isinstance(cube.smoothed(2).data, np.memmap) and os.path.getmtime(path) == mtime
+
+
+def test_concurrent_calls_share_one_computation(cube, monkeypatch):
+    calls = []
+    release = threading.Event()
+
+    def slow(a, sigma, axis=0):
+        calls.append(sigma)
+        release.wait(5)
+        return gaussian_smooth_axis(a, sigma, axis=axis)
+
+    monkeypatch.setattr(pyqtcube.DataCube, 'gaussian_smooth_axis', slow)
+    with ThreadPoolExecutor(4) as pool:
+        futures = [pool.submit(cube.smoothed, 2, cache=False, workers=1) for _ in range(4)]
+        release.set()
+        results = [f.result(10) for f in futures]
+    assert all(r is results[0] for r in results)
+    # one block of rows, smoothed once
+    assert calls == [2]
+
+
+def test_cancelled_smoothing(cube, monkeypatch):
+    monkeypatch.setattr(pyqtcube.DataCube, 'CHUNK_BYTES', 2 * cube.shape[0] * cube.shape[2] * 8)
+    with pytest.raises(CancelledError):
+        cube.smoothed(2, cancelled=lambda: True)
+    assert not [f for f in os.listdir(os.path.dirname(cube.filename)) if 'smooth' in f]
+    # not cached: the next call computes it
+    assert cube.smoothed(2, cache=False).shape == cube.shape
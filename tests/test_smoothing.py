@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from astropy.convolution import Gaussian2DKernel, convolve
+
+from pyqtcube.Smoothing import SmoothingCache, gaussian_smooth
+
+
+@pytest.fixture
+def image():
+    rng = np.random.default_rng(3)
+    ima = rng.normal(size=(40, 57))
+    ima[10:13, 20] = np.nan
+    ima[0, 0] = np.nan
+    return ima
+
+
+@pytest.mark.parametrize('method', ['auto', 'separable', 'fft'])
+@pytest.mark.parametrize('sigma', [1, 2.5, 4])
+def test_gaussian_smooth(image, sigma, method):
+    ref = convolve(image, Gaussian2DKernel(sigma))
+    assert np.allclose(gaussian_smooth(image, sigma, method=method), ref, equal_nan=True)
+
+
+def test_gaussian_smooth_without_nan(image):
+    ima = np.nan_to_num(image)
+    assert np.allclose(gaussian_smooth(ima, 2), convolve(ima, Gaussian2DKernel(2)))
+
+
+def test_smoothing_cache(image):
+    cache = SmoothingCache()
+    out = cache.smooth(image, 2)
+    assert cache.smooth(image, 2) is out and not out.flags.writeable
+    assert cache.smooth(image, 3) is not out
+    assert cache.smooth(image, 0) is image
+    # another image with the same content is smoothed again
+    assert cache.smooth(image.copy(), 2) is not out
+    assert np.allclose(out, gaussian_smooth(image, 2), equal_nan=True)
+
+
+def test_smoothing_cache_is_bounded(image):
+    cache = SmoothingCache(max_bytes=2 * image.nbytes)
+    images = [image + i for i in range(5)]
+    for ima in images:
+        cache.smooth(ima, 2)
+    assert cache.nbytes == 2 * image.nbytes
+    cache.clear()
+    assert cache.nbytes == 0
@@ -0,0 +1,77 @@
+import astropy.units as u
+import numpy as np
+import pytest
+
+from pyqtcube.SpectralAxis import SpectralAxis
+
+
+def test_edges():
+    axis = SpectralAxis(np.exp(np.linspace(np.log(4000), np.log(9000), 50)), u.AA)
+    e = axis.edges
+    assert len(e) == 51 and np.all(np.diff(e) > 0)
+    assert np.allclose(e[1:-1], 0.5 * (axis.values[1:] + axis.values[:-1]))
+    assert np.array_equal(SpectralAxis([5000.], u.AA).edges, [4999.5, 5000.5])
+
+
+def test_band_weights():
+    axis = SpectralAxis(6500 + 1.25 * np.arange(100), u.AA)
+    i1, i2, w = axis.band_weights(6510.3 * u.AA, 6530.1 * u.AA)
+    assert w.sum() == pytest.approx(6530.1 - 6510.3)
+    assert np.all(w[1:-1] == 1.25) and 0 < w[0] < 1.25 and 0 < w[-1] < 1.25
+    assert (i1, i2) == (axis.closest(6510.3), axis.closest(6530.1) + 1)
+    # same band in nm, and with reversed limits
+    j1, j2, wn = axis.band_weights(653.01 * u.nm, 651.03 * u.nm)
+    assert (j1, j2) == (i1, i2) and np.allclose(wn, w)
+
+    descending = SpectralAxis((6500 + 1.25 * np.arange(100))[::-1], u.AA)
+    j1, j2, wd = descending.band_weights(6530.1, 6510.3)
+    assert (j1, j2) == (100 - i2, 100 - i1)
+    assert np.allclose(wd, w[::-1])
+
+
+def test_band_weights_outside_the_axis():
+    axis = SpectralAxis(6500 + 1.25 * np.arange(100), u.AA)
+    i1, i2, w = axis.band_weights(6400, 6450)
+    assert (i1, i2) == (0, 1) and np.array_equal(w, [0])
+    i1, i2, w = axis.band_weights(6490, 6502)
+    assert i1 == 0 and w.sum() == pytest.approx(6502 - (6500 - 0.625))
+
+
+@pytest.mark.parametrize('values', [
+    6500 + 1.25 * np.arange(200),
+    np.exp(np.linspace(np.log(4000), np.log(9000), 300)),
+    (6500 + 1.25 * np.arange(200))[::-1],
+])
+def test_closest(values):
+    axis = SpectralAxis(values, u.AA)
+    rng = np.random.default_rng(5)
+    for v in np.concatenate([rng.uniform(values.min() - 10, values.max() + 10, 200), values[:5]]):
+        assert axis.closest(v) == np.argmin(np.abs(values - v))
+    assert axis.closest(values[7] / 10 * u.nm) == 7
+    nu = (values[12] * u.AA).to(u.GHz, equivalencies=u.spectral())
+    assert axis.closest(nu) == 12
+    assert axis.closest(nu.value, unit=u.GHz) == 12
+
+
+def test_closest_single_channel():
+    assert SpectralAxis([5000.], u.AA).closest(7000) == 0
+
+
+def test_unit_views():
+    axis = SpectralAxis(6500 + 1.25 * np.arange(10), u.AA)
+    nm = axis.to(u.nm)
+    assert np.allclose(nm, axis.values / 10) and axis.to(u.nm) is nm
+    assert not nm.flags.writeable and not axis.values.flags.writeable
+    assert np.allclose(axis.width, 1.25) and len(axis) == 10
+    assert axis.value(650 * u.nm) == pytest.approx(6500)
+    v = axis.velocity(6501.25 * u.AA)
+    assert v[1] == pytest.approx(0) and v[2] == pytest.approx(299792.458 * 1.25 / 6501.25)
+    assert axis.velocity(650.125 * u.nm) is v
+
+
+def test_cube_axis(cube):
+    axis = cube.spectral_axis
+    assert np.allclose(axis.values, 6500 + 1.25 * np.arange(cube.shape[0]))
+    assert np.array_equal(cube.wavelenght, axis.quantity)
+    assert cube.closest_spectral_channel(6550.4 * u.AA) == 40
+    assert cube.closest_spectral_channel(655.04 * u.nm) == 40
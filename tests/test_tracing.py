@@ -0,0 +1,87 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from pyqtcube.Tracing import span, traced, tracer
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+SCRIPT = """
+from pyqtcube.Tracing import span, traced, tracer
+
+@traced
+def outer(x):
+    with span('inner'):
+        return 2 * x
+
+assert outer(3) == 6
+print(tracer.enabled, len(tracer.events))
+"""
+
+
+def run_script(trace):
+    env = {k: v for k, v in os.environ.items() if k != 'PYCUBE_TRACE'}
+    env['PYTHONPATH'] = ROOT
+    if trace is not None:
+        env['PYCUBE_TRACE'] = trace
+    return subprocess.run([sys.executable, '-c', SCRIPT], env=env, capture_output=True, text=True, check=True).stdout
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(tracer, 'enabled', True)
+    tracer.events.clear()
+    tracer.take()
+    yield tracer
+    tracer.events.clear()
+    tracer.take()
+
+
+def test_traced_is_a_noop_without_pycube_trace(monkeypatch):
+    assert run_script(None).split() == ['False', '0']
+    monkeypatch.setattr(tracer, 'enabled', False)
+    n = len(tracer.events)
+
+    @traced(name='f')
+    def f(a, b=1):
+        """doc"""
+        return a + b
+
+    assert f(1, b=2) == 3 and f.__doc__ == "doc" and f.__name__ == 'f'
+    with span('s'):
+        pass
+    assert len(tracer.events) == n and tracer.take() == []
+
+
+def test_chrome_trace_nested_spans(enabled, tmp_path):
+    @traced
+    def outer():
+        with span('inner', cat='test'):
+            return 1
+
+    outer()
+    path = tracer.save(str(tmp_path / 'trace.json'))
+    with open(path) as ff:
+        doc = json.load(ff)
+    events = {e['name']: e for e in doc['traceEvents'] if e['ph'] == 'X'}
+    name = 'test_chrome_trace_nested_spans.<locals>.outer'
+    assert set(events) == {name, 'inner'}
+    o, i = events[name], events['inner']
+    assert i['cat'] == 'test' and o['cat'] == 'pycube'
+    assert o['tid'] == i['tid'] and o['pid'] == i['pid'] == os.getpid()
+    # the inner span begins after and ends before the outer one
+    assert o['ts'] <= i['ts'] and i['ts'] + i['dur'] <= o['ts'] + o['dur']
+    assert any(e['ph'] == 'M' and e['tid'] == o['tid'] for e in doc['traceEvents'])
+    assert [n for n, t, calls in tracer.take()] == [name, 'inner']
+
+
+def test_trace_written_at_exit(tmp_path):
+    path = tmp_path / 'trace.json'
+    assert run_script(str(path)).split() == ['True', '2']
+    with open(path) as ff:
+        names = [e['name'] for e in json.load(ff)['traceEvents'] if e['ph'] == 'X']
+    # spans are recorded when they end
+    assert names == ['inner', 'outer']
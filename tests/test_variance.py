@@ -0,0 +1,93 @@
+import os
+
+import astropy.units as u
+import numpy as np
+import pytest
+
+from pyqtcube.Aperture import ApertureEngine
+from pyqtcube.DataCube import read
+from pyqtcube.Smoothing import gaussian_smooth_axis, gaussian_smooth_axis_variance
+
+
+def test_variance_is_attached(cube_file):
+    cube = read(cube_file)
+    assert cube.variance is not None and cube.variance.shape == cube.shape
+    assert read(cube_file, variance=None).variance is None
+    with pytest.raises(ValueError):
+        read(cube_file, variance=None).get_1dSpec(3, 4, variance=True)
+
+
+def test_propagated_variance(cube):
+    data = np.asarray(cube.data, dtype=float)
+    var = np.asarray(cube.variance, dtype=float)
+    s, v = cube.get_1dSpec(7, 8, variance=True)
+    assert np.allclose(s, data[:, 8, 7]) and np.allclose(v, var[:, 8, 7])
+
+    lam = cube.spectral_axis.values
+    l1, l2 = lam[16] - 0.625, lam[31] + 0.625
+    flux, fvar = cube.get_image_band(l1 * u.AA, l2 * u.AA, variance=True)
+    good = np.isfinite(data[16:32])
+    n = good.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        assert np.allclose(fvar, np.where(good, var[16:32], 0).sum(axis=0) / n ** 2 * (n > 0) / (n > 0),
+                           equal_nan=True)
+
+    line, blue, red = [(lam[a] * u.AA, lam[b] * u.AA) for a, b in [(50, 66), (10, 20), (90, 100)]]
+    net, nvar = cube.get_image_continuum_subtracted(line, blue, red, variance=True)
+    assert np.allclose(net, cube.get_image_continuum_subtracted(line, blue, red), equal_nan=True)
+    with np.errstate(invalid='ignore'):
+        assert np.allclose(cube.get_image_snr(line, blue, red), net / np.sqrt(nvar), equal_nan=True)
+
+
+def test_get_spectra_variance_match_get_1dSpec(cube):
+    x, y, r = [3, 8, 15, 21], [4, 9, 12, 0], [0, 2, 3.5, 1]
+    spectra, var = cube.get_spectra(x, y, r=r, variance=True)
+    for i in range(len(x)):
+        s, v = cube.get_1dSpec(x[i], y[i], r=r[i], variance=True)
+        assert np.allclose(spectra[i], s, equal_nan=True)
+        assert np.allclose(var[i], v, equal_nan=True)
+
+
+def test_annulus_variance():
+    rng = np.random.default_rng(1)
+    d = rng.normal(size=(50, 20, 24))
+    d[3, 5, 5] = np.nan
+    v = rng.uniform(0.5, 2, d.shape)
+    e = ApertureEngine(lambda x1, x2, y1, y2: d[:, y1:y2, x1:x2], d.shape,
+                       read_variance=lambda x1, x2, y1, y2: v[:, y1:y2, x1:x2])
+    s, sv = e.spectrum(12, 10, 2, annulus=(3, 5), variance=True)
+    m, mv = e.spectrum(12, 10, 2, variance=True)
+    assert np.allclose(s, e.spectrum(12, 10, 2, annulus=(3, 5)))
+    # the background subtraction adds its own variance
+    assert np.all(sv > mv)
+
+
+def test_gaussian_smooth_axis_variance():
+    rng = np.random.default_rng(4)
+    sigma = 2
+    noise = rng.normal(size=(20000, 60))
+    smoothed = gaussian_smooth_axis(noise, sigma, axis=1)
+    var = gaussian_smooth_axis_variance(np.ones(60), sigma)
+    assert np.allclose(smoothed.var(axis=0)[10:50], var[10:50], rtol=0.05)
+    # invalid channels are interpolated over: the variance grows
+    v = np.ones(60)
+    v[30] = np.nan
+    assert gaussian_smooth_axis_variance(v, sigma)[30] > var[30]
+
+
+@pytest.mark.parametrize('cache', [False, True])
+def test_smoothed_cube_variance(cube, cache):
+    smoothed = cube.smoothed(2, cache=cache)
+    ref = gaussian_smooth_axis_variance(np.asarray(cube.variance[:, 8, 7], dtype=float), 2)
+    s, v = smoothed.get_1dSpec(7, 8, variance=True)
+    assert np.allclose(v, ref, rtol=1e-6)
+    assert np.all(v < np.asarray(cube.variance[:, 8, 7]))
+    lam = cube.spectral_axis.values
+    line, blue, red = [(lam[a] * u.AA, lam[b] * u.AA) for a, b in [(50, 66), (10, 20), (90, 100)]]
+    snr = smoothed.get_image_snr(line, blue, red)
+    assert snr.shape == cube.shape[1:] and np.isfinite(snr[5:, 5:]).all()
+    if cache:
+        # the smoothed variance is read back from its cache file
+        assert os.path.isfile("%s.%d.smooth2.var.npy" % (cube.filename, cube.extn))
+        cube.clear_caches()
+        assert np.array_equal(cube.smoothed(2).get_1dSpec(7, 8, variance=True)[1], v)